@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Compare the dispatch of the triples of a delta to their handlers: three
+scans filtering the subjects with startswith followed by a chain of
+predicate comparisons (previous implementation) against a single pass on a
+dict indexed by resource type and predicate.
+
+Usage: python benchmarks/delta_dispatch.py [number of triples]
+"""
+import random
+import sys
+import timeit
+
+from muswarmadmin import delta
+from muswarmadmin.main import Application
+from muswarmadmin.prefixes import Dct, Mu, SwarmUI
+
+
+PREDICATES = [
+    SwarmUI.requestedStatus, SwarmUI.restartRequested,
+    SwarmUI.requestedScaling, SwarmUI.deleteRequested,
+    SwarmUI.updateRequested, SwarmUI.pipelines, SwarmUI.status,
+    SwarmUI.scaling, Mu.uuid, Dct.title,
+]
+RESOURCE_TYPES = ["stacks/", "pipeline-instances/", "services/", "other/"]
+
+
+def make_delta(size, seed=0):
+    rand = random.Random(seed)
+    base = Application.base_resource.value
+    triples = [
+        {
+            "s": {"type": "uri", "value": "%s%s%d" % (
+                base, rand.choice(RESOURCE_TYPES), rand.randrange(size // 4))},
+            "p": {"type": "uri",
+                  "value": rand.choice(PREDICATES).iri().value},
+            "o": {"type": "literal", "value": "true"},
+        }
+        for i in range(size)
+    ]
+    return delta.UpdateData({
+        "graph": "http://mu.semte.ch/application",
+        "inserts": triples,
+        "deletes": [],
+    })
+
+
+def filter_inserts(data, func):
+    """
+    Filter inserts that func(x) match where x is a singe triple of the update
+    """
+    assert callable(func)
+    return (x for x in data.inserts if func(x))
+
+
+def filter_deletes(data, func):
+    """
+    Filter deletes that func(x) match where x is a singe triple of the update
+    """
+    assert callable(func)
+    return (x for x in data.deletes if func(x))
+
+
+def filter_updates(data, resource_type):
+    inserts = delta.groupby_subject(filter_inserts(
+        data, lambda x: x.s.value.startswith(resource_type.value)))
+    deletes = delta.groupby_subject(filter_deletes(
+        data, lambda x: x.s.value.startswith(resource_type.value)))
+    return (inserts, deletes)
+
+
+def scan_dispatch(data):
+    routed = []
+    for resource_type, module in delta.RESOURCE_TYPES:
+        inserts, deletes = filter_updates(
+            data, Application.base_resource + resource_type)
+        predicates = list(module.handlers)
+        for subject, triples in inserts.items():
+            for triple in triples:
+                for predicate in predicates:
+                    if triple.p == predicate:
+                        routed.append((module.handlers[predicate], triple))
+                        break
+    return routed
+
+
+def single_pass_dispatch(data, handlers):
+    return delta.route(handlers, data.inserts)
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    data = make_delta(size)
+    handlers = delta.get_handlers(Application.base_resource)
+    print("%d triples, %d routed by the single pass" % (
+        size, len(single_pass_dispatch(data, handlers))))
+    for name, func in [
+        ("startswith scans", lambda: scan_dispatch(data)),
+        ("single pass", lambda: single_pass_dispatch(data, handlers)),
+    ]:
+        number = 10
+        best = min(timeit.repeat(func, number=number, repeat=5)) / number
+        print("%-20s %8.2f ms per delta" % (name, best * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Compare the peak memory and the time needed to parse a large Delta service
+payload: decoding the whole body with json.loads then building the UpdateData
+of every graph (previous implementation) against the streaming parser that
+skips the other graphs.
+
+Usage: python benchmarks/delta_parsing.py [number of triples per graph]
+"""
+import asyncio
+import json
+import sys
+import time
+import tracemalloc
+
+from muswarmadmin import delta
+from muswarmadmin.jsonstream import JSONStream
+
+
+GRAPH = "http://mu.semte.ch/application"
+
+
+class ChunkReader:
+    """
+    Return a body in chunks like the content of an aiohttp request
+    """
+    def __init__(self, body):
+        self.body = memoryview(body)
+        self.pos = 0
+
+    async def read(self, n):
+        chunk = bytes(self.body[self.pos:self.pos + n])
+        self.pos += len(chunk)
+        return chunk
+
+
+def make_body(size):
+    def triples(graph):
+        return [
+            {
+                "s": {"type": "uri", "value": "%s/s%d" % (graph, i)},
+                "p": {"type": "uri", "value": "http://example.org/p%d" % (
+                    i % 10)},
+                "o": {"type": "literal", "value": "value %d" % i},
+            }
+            for i in range(size)
+        ]
+    return json.dumps({"delta": [
+        {"graph": "http://example.org/other1", "inserts": [],
+         "deletes": triples("http://example.org/other1")},
+        {"graph": GRAPH, "inserts": triples(GRAPH), "deletes": []},
+        {"graph": "http://example.org/other2",
+         "inserts": triples("http://example.org/other2"), "deletes": []},
+    ]}).encode()
+
+
+def load_whole(body):
+    data = json.loads(body.decode())
+    updates = [delta.UpdateData(x) for x in data['delta']]
+    return [x for x in updates if x.graph == GRAPH]
+
+
+def load_stream(body, loop):
+    return loop.run_until_complete(delta.parse_payload(
+        JSONStream(ChunkReader(body)), GRAPH))
+
+
+def measure(func):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    duration = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(result) == 1
+    return peak, duration
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    loop = asyncio.get_event_loop()
+    body = make_body(size)
+    print("payload of %.1f MiB, %d triples per graph" % (
+        len(body) / 2 ** 20, size))
+    for name, func in [
+        ("json.loads", lambda: load_whole(body)),
+        ("streaming", lambda: load_stream(body, loop)),
+    ]:
+        peak, duration = measure(func)
+        print("%-12s %8.1f MiB peak, %8.2f ms" % (
+            name, peak / 2 ** 20, duration * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Compare the grouping of the triples of a large delta by subject: the former
+itertools.groupby (which loses the triples of the subjects that are not
+adjacent), itertools.groupby on sorted triples and the hash-based grouping of
+delta.groupby_subject.
+
+Usage: python benchmarks/groupby_subject.py [number of triples]
+"""
+import random
+import sys
+import timeit
+from itertools import groupby
+
+from muswarmadmin import delta
+
+
+def make_triples(size, seed=0):
+    rand = random.Random(seed)
+    # NOTE: a few triples per subject, interleaved like the triples of an
+    #       UpdateData that come from a set
+    triples = [
+        delta.Triple({
+            "s": {"type": "uri",
+                  "value": "http://example.org/s%d" % (i // 5)},
+            "p": {"type": "uri", "value": "http://example.org/p%d" % (i % 5)},
+            "o": {"type": "literal", "value": str(i)},
+        })
+        for i in range(size)
+    ]
+    rand.shuffle(triples)
+    return triples
+
+
+def adjacent_groupby(triples):
+    return {
+        s: list(group)
+        for s, group in groupby(triples, lambda x: x.s)
+    }
+
+
+def sorted_groupby(triples):
+    return {
+        s: list(group)
+        for s, group in groupby(sorted(triples, key=lambda x: x.s.value),
+                                lambda x: x.s)
+    }
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    triples = make_triples(size)
+    for name, func in [
+        ("adjacent groupby", adjacent_groupby),
+        ("sorted groupby", sorted_groupby),
+        ("hash grouping", delta.groupby_subject),
+    ]:
+        kept = sum(len(x) for x in func(triples).values())
+        number = 5
+        best = min(timeit.repeat(lambda: func(triples), number=number,
+                                 repeat=3)) / number
+        print("%-20s %8.2f ms, %d/%d triples kept" % (
+            name, best * 1000, kept, size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Measure the requests per second of the SPARQL client against a local stand-in
+SPARQL endpoint that answers after a fixed latency: a new connection for
+every query, queries awaited one after another on a kept-alive connection
+(previous behavior) and queries issued concurrently through the connection
+pool.
+
+Usage: python benchmarks/sparql_client.py [number of queries] [latency in ms]
+"""
+import asyncio
+import json
+import sys
+import time
+from aiohttp import TCPConnector, web
+from aiosparql.client import SPARQLClient
+from aiosparql.syntax import IRI
+
+
+RESULT = json.dumps({
+    "head": {"vars": ["title"]},
+    "results": {"bindings": [
+        {"title": {"type": "literal", "value": "service1"}},
+    ]},
+})
+
+
+async def start_endpoint(latency, loop):
+    async def handler(request):
+        await request.post()
+        await asyncio.sleep(latency, loop=loop)
+        return web.Response(text=RESULT, content_type="application/json")
+
+    app = web.Application(loop=loop)
+    app.router.add_post("/sparql", handler)
+    server = await loop.create_server(app.make_handler(), "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    return server, "http://127.0.0.1:%d/sparql" % port
+
+
+async def run(endpoint, queries, concurrency, loop, **connector_options):
+    client = SPARQLClient(endpoint, graph=IRI("http://example.org"),
+                          loop=loop, connector=TCPConnector(
+                              loop=loop, **connector_options))
+    semaphore = asyncio.Semaphore(concurrency, loop=loop)
+
+    async def query(i):
+        async with semaphore:
+            await client.query("""
+                SELECT ?title
+                FROM {{graph}}
+                WHERE
+                {
+                    ?s mu:uuid {{}} ;
+                      dct:title ?title .
+                }
+                """, '"SERVICE%d"' % i)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[query(i) for i in range(queries)], loop=loop)
+    duration = time.perf_counter() - start
+    await client.close()
+    return queries / duration
+
+
+def main():
+    queries = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.002
+    loop = asyncio.get_event_loop()
+    server, endpoint = loop.run_until_complete(start_endpoint(latency, loop))
+    print("%d queries, endpoint latency of %.1f ms" % (
+        queries, latency * 1000))
+    for name, concurrency, options in [
+        ("new connection, sequential", 1, {"force_close": True}),
+        ("keep-alive, sequential", 1, {}),
+        ("pool of 8, concurrent", 8,
+         {"limit_per_host": 8, "keepalive_timeout": 15}),
+        ("pool of 32, concurrent", 32,
+         {"limit_per_host": 32, "keepalive_timeout": 15}),
+    ]:
+        rate = loop.run_until_complete(
+            run(endpoint, queries, concurrency, loop, **options))
+        print("%-28s %8.0f requests/s" % (name, rate))
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Measure the memory and the time needed to build an UpdateData from a large
+delta payload, with the former Triple (instance dict, new IRI for every
+term, hash of a tuple of hashes) and with the current one.
+
+Usage: python benchmarks/update_data.py [number of triples]
+"""
+import sys
+import timeit
+import tracemalloc
+from aiosparql.syntax import IRI, Literal
+from unittest import mock
+
+from muswarmadmin import delta
+from muswarmadmin.prefixes import Dct, Mu, SwarmUI
+
+
+class FormerTriple:
+    def __init__(self, data):
+        self.s = IRI(data['s']['value'])
+        self.p = IRI(data['p']['value'])
+        if data['o']['type'] == "uri":
+            self.o = IRI(data['o']['value'])
+        else:
+            self.o = Literal(data['o']['value'])
+
+    def __hash__(self):
+        return hash((hash(self.s), hash(self.p), hash(self.o)))
+
+    def __eq__(self, other):
+        if isinstance(other, FormerTriple):
+            return hash(self) == hash(other)
+        else:
+            return False
+
+
+def make_payload(size):
+    # NOTE: like a bulk import: 5 triples per service
+    base = "http://swarm-ui.big-data-europe.eu/resources/services/"
+    triples = []
+    for i in range(size // 5):
+        subject = {"type": "uri", "value": "%s%d" % (base, i)}
+        for p, o in [
+            (Mu.uuid, {"type": "literal", "value": str(i)}),
+            (Dct.title, {"type": "literal", "value": "service%d" % i}),
+            (SwarmUI.scaling, {"type": "literal", "value": "1"}),
+            (SwarmUI.status, {"type": "uri",
+                              "value": SwarmUI.Started.iri().value}),
+            (SwarmUI.requestedStatus, {"type": "uri",
+                                       "value": SwarmUI.Up.iri().value}),
+        ]:
+            triples.append({
+                "s": subject,
+                "p": {"type": "uri", "value": p.iri().value},
+                "o": o,
+            })
+    return {
+        "graph": "http://mu.semte.ch/application",
+        "inserts": triples,
+        "deletes": triples[:len(triples) // 10],
+    }
+
+
+def measure(payload):
+    tracemalloc.start()
+    data = delta.UpdateData(payload)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del data
+    best = min(timeit.repeat(lambda: delta.UpdateData(payload), number=1,
+                             repeat=5))
+    return current, peak, best
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    payload = make_payload(size)
+    print("%d triples inserted, %d deleted" % (
+        len(payload['inserts']), len(payload['deletes'])))
+    with mock.patch.object(delta, "Triple", FormerTriple):
+        results = [("former Triple", measure(payload))]
+    results.append(("current Triple", measure(payload)))
+    for name, (current, peak, best) in results:
+        print("%-16s %8.1f MiB retained, %8.1f MiB peak, %8.2f ms" % (
+            name, current / 2 ** 20, peak / 2 ** 20, best * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+import importlib
+import json
+import logging
+import os
+from aiosparql.syntax import IRI, PrefixedName
+from itertools import count
+
+
+logger = logging.getLogger(__name__)
+
+# NOTE: the journal is rewritten with the pending actions only when it has
+#       more lines than this and 4 times more lines than pending actions
+COMPACTION_LINES = 1000
+
+
+class ActionJournal:
+    """
+    Append-only journal of the actions queued in the action schedulers: an
+    action is written when it is queued and marked as done when it has been
+    executed or dropped, the actions still pending are loaded back at startup.
+    Only the actions that can be encoded are written: the functions of the
+    muswarmadmin package and the methods of the application, with arguments
+    that are the application, IRIs or JSON values
+    """
+    def __init__(self, path, app):
+        self.path = path
+        self.app = app
+        self.file = None
+        self.counter = count()
+        self.pending = {}
+        self.lines = 0
+
+    def encode_action(self, action):
+        if getattr(action, "__self__", None) is self.app:
+            return "app:%s" % action.__name__
+        module = getattr(action, "__module__", None) or ""
+        name = getattr(action, "__qualname__", "")
+        if not module.startswith("muswarmadmin.") or not name.isidentifier():
+            raise TypeError("can not encode action %r" % action)
+        return "%s:%s" % (module, name)
+
+    def decode_action(self, value):
+        module, name = value.split(":")
+        if module == "app":
+            return getattr(self.app, name)
+        if not module.startswith("muswarmadmin."):
+            raise ValueError("invalid action %r" % value)
+        return getattr(importlib.import_module(module), name)
+
+    def encode_value(self, value):
+        if value is self.app:
+            return {"app": True}
+        elif isinstance(value, PrefixedName):
+            return {"iri": value.iri().value}
+        elif isinstance(value, IRI):
+            return {"iri": value.value}
+        elif isinstance(value, list):
+            return [self.encode_value(x) for x in value]
+        elif value is None or isinstance(value, (bool, int, float, str)):
+            return value
+        raise TypeError("can not encode value %r" % value)
+
+    def decode_value(self, value):
+        if isinstance(value, dict):
+            if "app" in value:
+                return self.app
+            return IRI(value["iri"])
+        elif isinstance(value, list):
+            return [self.decode_value(x) for x in value]
+        return value
+
+    def write(self, record):
+        if self.file is None:
+            self.file = open(self.path, "a", buffering=1)
+        self.file.write(json.dumps(record) + "\n")
+        self.lines += 1
+
+    def put(self, scheduler, key, action, args, priority, supersede):
+        """
+        Write an action queued, return the identifier of its entry or None if
+        it can not be encoded
+        """
+        try:
+            record = {
+                "scheduler": scheduler,
+                "key": key,
+                "action": self.encode_action(action),
+                "args": [self.encode_value(x) for x in args],
+                "priority": priority,
+                "supersede": supersede,
+            }
+        except TypeError as exc:
+            logger.debug("Action not written in the journal: %s", exc)
+            return None
+        record["id"] = next(self.counter)
+        self.write(record)
+        self.pending[record["id"]] = record
+        return record["id"]
+
+    def done(self, entry):
+        """
+        Mark the action of an entry as done
+        """
+        del self.pending[entry]
+        self.write({"done": entry})
+        if self.lines > COMPACTION_LINES and \
+                self.lines > 4 * len(self.pending):
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrite the journal with the pending actions only
+        """
+        self.close()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as fh:
+            for record in self.pending.values():
+                fh.write(json.dumps(record) + "\n")
+        os.replace(tmp_path, self.path)
+        self.lines = len(self.pending)
+
+    def load(self):
+        """
+        Read the actions left pending by the previous run, the journal is
+        compacted. Return the records of the actions that can be decoded (the
+        action and its arguments are decoded) in the order they were queued
+        """
+        self.pending.clear()
+        if os.path.exists(self.path):
+            with open(self.path) as fh:
+                for line in fh:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # NOTE: the last line may have been written partially
+                        logger.warning("Invalid line in the journal: %r",
+                                       line)
+                        continue
+                    if "done" in record:
+                        self.pending.pop(record["done"], None)
+                    else:
+                        self.pending[record["id"]] = record
+        self.counter = count(max(self.pending, default=-1) + 1)
+        records = []
+        for record in list(self.pending.values()):
+            try:
+                records.append(dict(
+                    record, action=self.decode_action(record["action"]),
+                    args=[self.decode_value(x) for x in record["args"]]))
+            except (AttributeError, ImportError, KeyError, ValueError) as exc:
+                logger.error("Can not resume action %r: %s", record, exc)
+                del self.pending[record["id"]]
+        self.compact()
+        return records
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
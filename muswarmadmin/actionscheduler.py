@@ -1,9 +1,22 @@
 import asyncio
+import heapq
 import logging
+from itertools import count
+from time import monotonic
+
+from muswarmadmin import metrics
 
 
 logger = logging.getLogger(__name__)
 
+# NOTE: the classes of actions from the highest priority to the lowest. The
+#       pending actions of a class are executed before those of the next
+#       classes, the actions of a class are executed in order
+USER = "user"
+RECONCILIATION = "reconciliation"
+CLEANUP = "cleanup"
+PRIORITIES = (USER, RECONCILIATION, CLEANUP)
+
 
 class StopScheduler(Exception):
     """
@@ -12,23 +25,115 @@ class StopScheduler(Exception):
     pass
 
 
+class ConcurrencyLimit:
+    """
+    Limit the number of actions executed at the same time by the action
+    schedulers sharing it (no limit if concurrency is None). The free slots
+    are given by priority then in order of request. An action that waits for
+    the actions of another scheduler gives its slot back meanwhile
+    """
+    def __init__(self, concurrency=None, loop=None):
+        self.loop = asyncio.get_event_loop() if loop is None else loop
+        self.available = concurrency
+        self.waiters = []
+        self.counter = count()
+        self.holders = {}
+
+    @property
+    def running(self):
+        """
+        Number of actions being executed
+        """
+        return len(self.holders)
+
+    async def acquire(self, priority=USER):
+        """
+        Wait for a slot for the current task
+        """
+        if self.available is None:
+            pass
+        elif self.available > 0 and not self.waiters:
+            self.available -= 1
+        else:
+            waiter = self.loop.create_future()
+            heapq.heappush(self.waiters,
+                           (PRIORITIES.index(priority), next(self.counter),
+                            waiter))
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # NOTE: the slot may have been given already
+                if not waiter.cancelled():
+                    self._give()
+                raise
+        self.holders[asyncio.Task.current_task(loop=self.loop)] = priority
+
+    def release(self):
+        """
+        Give back the slot of the current task
+        """
+        del self.holders[asyncio.Task.current_task(loop=self.loop)]
+        if self.available is not None:
+            self._give()
+
+    def _give(self):
+        """
+        Give a free slot to the first waiter or keep it
+        """
+        while self.waiters:
+            waiter = heapq.heappop(self.waiters)[-1]
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.available += 1
+
+    async def wait(self, awaitable):
+        """
+        Await something, the slot of the current task (if it has one) is
+        given back in the meantime
+        """
+        priority = self.holders.get(asyncio.Task.current_task(loop=self.loop))
+        if priority is None:
+            return await awaitable
+        self.release()
+        try:
+            return await awaitable
+        finally:
+            await self.acquire(priority)
+
+
 class ActionScheduler:
     """
     The action scheduler is a way to get background task execution in the event
     loop executed serially. The actions are grouped by a key given when
     enqueueing the action. Every action is then executed one by one until the
-    end of its queue
+    end of its queue, the actions of a higher priority class first. An action
+    queued with a supersede key replaces the action pending with the same
+    key in the queue (which is dropped). The executers sharing a
+    ConcurrencyLimit execute at most its number of actions at the same time.
+    An executer idle for idle_ttl seconds is removed, it is created again by
+    the next action. The actions of the user and cleanup classes are written
+    in the ActionJournal given (if any) until they are done
     """
     executers = {}
+    checkpointing = False
 
     @classmethod
-    async def execute(cls, key, action, args, loop=None):
+    async def execute(cls, key, action, args, loop=None, limit=None,
+                      idle_ttl=None, journal=None, priority=USER,
+                      supersede=None, entry=None):
         """
         Enqueue an action to an executer, create one if it doesn't exist
         """
         if key not in cls.executers:
-            cls.executers[key] = cls(key, loop=loop)
-        await cls.executers[key].enqueue(action, args)
+            cls.executers[key] = cls(key, loop=loop, limit=limit,
+                                     idle_ttl=idle_ttl, journal=journal)
+            # NOTE: the actions queued by the actions finishing during a
+            #       checkpoint are resumed at the next startup
+            if cls.checkpointing:
+                cls.executers[key].stop()
+        await cls.executers[key].enqueue(action, args, priority=priority,
+                                         supersede=supersede, entry=entry)
 
     @classmethod
     async def graceful_cancel(cls):
@@ -40,15 +145,48 @@ class ActionScheduler:
         for executer in list(cls.executers.values()):
             await executer.cancel()
 
-    def __init__(self, name, loop=None):
+    @classmethod
+    async def checkpoint(cls):
+        """
+        Stop all the executers once their running action is finished, the
+        actions that have not started stay in the journal to be resumed at
+        the next startup
+        """
+        logger.debug("Stopping all action schedulers...")
+        cls.checkpointing = True
+        try:
+            while cls.executers:
+                executers = list(cls.executers.values())
+                for executer in executers:
+                    executer.stop()
+                # NOTE: an executer stopped before it started is cancelled
+                await asyncio.wait([x.executer for x in executers],
+                                   loop=executers[0].loop)
+                for executer in executers:
+                    executer.remove()
+        finally:
+            cls.checkpointing = False
+
+    def __init__(self, name, loop=None, limit=None, idle_ttl=None,
+                 journal=None):
         """
         Create an ActionScheduler instance, start a background task that will
-        consume the queue continuously one by one
+        consume the queue continuously one by one. The executer is never
+        removed when idle if idle_ttl is None
         """
         logger.debug("Registering new action scheduler %s", name)
         self.name = name
         self.loop = asyncio.get_event_loop() if loop is None else loop
-        self.queue = asyncio.Queue(loop=self.loop)
+        self.limit = ConcurrencyLimit(loop=self.loop) if limit is None \
+            else limit
+        self.idle_ttl = idle_ttl
+        self.journal = journal
+        self.queue = asyncio.PriorityQueue(loop=self.loop)
+        self.counter = count()
+        self.superseding = {}
+        self.superseded = set()
+        self.running = False
+        self.stopping = False
         self.executer = self.loop.create_task(self.executer())
 
     async def executer(self):
@@ -56,23 +194,70 @@ class ActionScheduler:
         The background task that execute the actions one by one
         """
         try:
-            while True:
-                action, args = await self.queue.get()
+            while not self.stopping:
+                try:
+                    rank, number, action, args, enqueued, supersede, \
+                        entry = await asyncio.wait_for(
+                            self.queue.get(), self.idle_ttl, loop=self.loop)
+                except asyncio.TimeoutError:
+                    # NOTE: an action may have been queued at the same time
+                    if self.queue.empty():
+                        logger.debug("Executer %s is idle", self.name)
+                        self.remove()
+                        return
+                    continue
+                if number in self.superseded:
+                    logger.debug("Executer %s: action %r superseded",
+                                 self.name, action)
+                    self.superseded.remove(number)
+                    self.queue.task_done()
+                    continue
+                if self.superseding.get(supersede, (None,))[0] == number:
+                    del self.superseding[supersede]
+                priority = PRIORITIES[rank]
+                try:
+                    await self.limit.acquire(priority)
+                except BaseException:
+                    self.queue.task_done()
+                    raise
+                started = monotonic()
+                metrics.ACTION_WAIT_DURATION.observe(
+                    started - enqueued, scheduler=type(self).__name__)
+                metrics.ACTION_CLASS_WAIT_DURATION.observe(
+                    started - enqueued, priority=priority)
                 logger.debug("Executer %s: running action %r with args: %r",
                              self.name, action, args)
+                self.running = True
                 try:
                     await action(*args)
+                except asyncio.CancelledError:
+                    if self.stopping:
+                        # NOTE: the action has been interrupted waiting for
+                        #       an executer stopped, it stays in the journal
+                        raise
+                    logger.exception("Action %r with arguments %r has been "
+                                     "cancelled", action, args)
                 except StopScheduler:
+                    self.forget(entry)
                     raise
                 except Exception:
                     logger.exception("Action %r with arguments %r failed",
                                      action, args)
                 finally:
+                    self.running = False
+                    self.limit.release()
                     self.queue.task_done()
+                    metrics.ACTION_CLASS_DURATION.observe(
+                        monotonic() - started, priority=priority)
+                self.forget(entry)
         except StopScheduler:
-            del type(self).executers[self.name]
+            self.remove()
+            # NOTE: the actions left in the queue are dropped
+            while not self.queue.empty():
+                self.forget(self.queue.get_nowait()[-1])
+                self.queue.task_done()
         except asyncio.CancelledError:
-            pass
+            self.remove()
         finally:
             logger.debug("Executer %s is finished", self.name)
 
@@ -82,18 +267,76 @@ class ActionScheduler:
         ActionScheduler itself
         """
         logger.debug("Cancelling action scheduler %s...", self.name)
-        await self.queue.join()
-        self.executer.cancel()
-        await self.executer
-        if self.name in type(self).executers:
+        join = self.loop.create_task(self.queue.join())
+        # NOTE: the caller may be an action of another executer
+        await self.limit.wait(asyncio.wait(
+            [join, self.executer], return_when=asyncio.FIRST_COMPLETED,
+            loop=self.loop))
+        if not join.done():
+            # NOTE: the executer has been stopped by a checkpoint, its
+            #       actions are resumed at the next startup
+            join.cancel()
+            raise asyncio.CancelledError()
+        self.stop()
+        await asyncio.wait([self.executer], loop=self.loop)
+        self.remove()
+
+    def stop(self):
+        """
+        Stop the background task once the action running (if any) is
+        finished, the actions left in the queue are not executed
+        """
+        self.stopping = True
+        if not self.running:
+            self.executer.cancel()
+
+    @property
+    def depth(self):
+        """
+        Number of actions pending (not superseded)
+        """
+        return self.queue.qsize() - len(self.superseded)
+
+    def forget(self, entry):
+        """
+        Mark the journal entry of an action as done
+        """
+        if entry is not None:
+            self.journal.done(entry)
+
+    def remove(self):
+        """
+        Remove the ActionScheduler from the executers (unless another one has
+        replaced it already)
+        """
+        if type(self).executers.get(self.name) is self:
             del type(self).executers[self.name]
 
-    async def enqueue(self, action, args):
+    async def enqueue(self, action, args, priority=USER, supersede=None,
+                      entry=None):
         """
-        Enqueue an action with arguments to this ActionScheduler
+        Enqueue an action with arguments to this ActionScheduler. If
+        supersede is given, the action pending with the same supersede key is
+        dropped. The action is written in the journal unless it comes from an
+        entry of the journal already
         """
-        logger.debug("Enqueue action %r with args: %r", action, args)
-        await self.queue.put((action, args))
+        logger.debug("Enqueue %s action %r with args: %r", priority, action,
+                     args)
+        # NOTE: the reconciliation is done again at startup anyway
+        if entry is None and self.journal is not None and \
+                priority != RECONCILIATION:
+            entry = self.journal.put(type(self).__name__, self.name, action,
+                                     args, priority, supersede)
+        number = next(self.counter)
+        if supersede is not None:
+            if supersede in self.superseding:
+                superseded, superseded_entry = self.superseding[supersede]
+                self.superseded.add(superseded)
+                self.forget(superseded_entry)
+                metrics.ACTIONS_SUPERSEDED.inc()
+            self.superseding[supersede] = (number, entry)
+        await self.queue.put((PRIORITIES.index(priority), number, action,
+                              args, monotonic(), supersede, entry))
 
 
 class OneActionScheduler(ActionScheduler):
@@ -104,8 +347,14 @@ class OneActionScheduler(ActionScheduler):
     """
     executers = {}
 
-    async def enqueue(self, action, args):
+    async def enqueue(self, action, args, priority=USER, supersede=None,
+                      entry=None):
         if not self.queue.empty():
             logger.debug("Ignore action %r with args: %r", action, args)
+            if entry is not None:
+                self.journal.done(entry)
             return
-        await super(OneActionScheduler, self).enqueue(action, args)
+        await super(OneActionScheduler, self).enqueue(action, args,
+                                                      priority=priority,
+                                                      supersede=supersede,
+                                                      entry=entry)
@@ -0,0 +1,363 @@
+import asyncio
+import hashlib
+import logging
+import os
+from compose import config, parallel
+from compose.cli.command import get_client, get_project_name
+from compose.config.environment import Environment
+from compose.const import API_VERSIONS
+from compose.parallel import ParallelStreamWriter
+from compose.project import OneOffFilter, Project
+from compose.service import ImageType
+from threading import Lock
+
+from muswarmadmin.identitycache import LRUCache
+
+
+logger = logging.getLogger(__name__)
+
+
+class LoggerStream:
+    """
+    File-like object that writes the lines of the progress of the Docker
+    Compose operations to the logger
+    """
+    def write(self, data):
+        for line in data.splitlines():
+            line = line.strip()
+            if line:
+                logger.info(line)
+
+    def flush(self):
+        pass
+
+
+class ComposeLogHandler(logging.Handler):
+    """
+    Forward the log records of Docker Compose to the logger
+    """
+    def emit(self, record):
+        logger.log(record.levelno, record.getMessage())
+
+
+def setup_output():
+    """
+    Write the progress and the logs of Docker Compose to the logger like the
+    output of the docker-compose processes (equivalent of docker-compose
+    --no-ansi). This changes the global state of Docker Compose, it must be
+    called once when the application starts
+    """
+    ParallelStreamWriter.set_noansi()
+    parallel.get_output_stream = lambda stream: LoggerStream()
+    compose_logger = logging.getLogger("compose")
+    if not any(isinstance(x, ComposeLogHandler)
+               for x in compose_logger.handlers):
+        compose_logger.addHandler(ComposeLogHandler())
+        compose_logger.setLevel(logging.INFO)
+        compose_logger.propagate = False
+
+
+class ComposeResult:
+    """
+    The result of a Docker Compose command executed in-process. It has the
+    same returncode attribute as the process objects returned by
+    Application.run_command
+    """
+    def __init__(self, returncode):
+        self.returncode = returncode
+
+    def __repr__(self):  # pragma: no cover
+        return "<%s returncode=%r>" % (self.__class__.__name__,
+                                       self.returncode)
+
+
+class ComposeEngine:
+    """
+    Execute Docker Compose commands in-process by driving a
+    compose.project.Project in an executor instead of forking a
+    docker-compose process. The projects are built from the configurations
+    of the ComposeConfigCache given in parameter. Only the commands and the
+    options used by the application are supported, get_command() returns None
+    for the others
+    """
+    # NOTE: options supported for every command
+    options = {
+        "up": {"-d", "--remove-orphans"},
+        "down": set(),
+        "start": set(),
+        "stop": set(),
+        "kill": set(),
+        "rm": {"-v", "-f", "-vf", "-fv"},
+        "restart": set(),
+        "scale": set(),
+        "pull": set(),
+    }
+
+    def __init__(self, configs, loop=None, executor=None):
+        self.configs = configs
+        self.loop = asyncio.get_event_loop() if loop is None else loop
+        self.executor = executor
+        self.clients = {}
+        self.lock = Lock()
+
+    def get_command(self, args):
+        """
+        Return the method that executes the arguments of a docker-compose
+        command line and its parameters or None if it is not supported
+        """
+        if not args or args[0] not in self.options:
+            return None
+        command, args = args[0], args[1:]
+        options = {x for x in args if x.startswith("-")}
+        if not options <= self.options[command]:
+            return None
+        arguments = [x for x in args if not x.startswith("-")]
+        return (getattr(self, "do_%s" % command), options, arguments)
+
+    async def run(self, project_dir, *args, timeout=None):
+        """
+        Execute a docker-compose command line in the project directory given
+        in parameter. Return a ComposeResult or None if the command is not
+        supported. A warning is logged if the command takes more than timeout
+        seconds but it is still awaited: the thread executing it can not be
+        interrupted and the next command of the project must not start before
+        it completes
+        """
+        command = self.get_command(args)
+        if command is None:
+            return None
+        method, options, arguments = command
+        future = self.loop.run_in_executor(
+            self.executor, self._execute, project_dir, method, options,
+            arguments)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout,
+                                          loop=self.loop)
+        except asyncio.TimeoutError:
+            logger.warning("Docker Compose command %r in %s awaited for too "
+                           "long, waiting for its completion...", args,
+                           project_dir)
+        return await future
+
+    def get_client(self, environment, version):
+        """
+        Return the Docker client for the API version of a configuration, the
+        clients are shared by the projects that use the same Docker daemon
+        """
+        api_version = environment.get('COMPOSE_API_VERSION',
+                                      API_VERSIONS[version])
+        key = (api_version, environment.get('DOCKER_HOST'),
+               environment.get('DOCKER_TLS_VERIFY'),
+               environment.get('DOCKER_CERT_PATH'))
+        with self.lock:
+            if key not in self.clients:
+                self.clients[key] = get_client(environment,
+                                               version=api_version)
+            return self.clients[key]
+
+    def get_project(self, project_dir):
+        """
+        Build the project of a directory from its cached configuration
+        """
+        environment = Environment.from_env_file(project_dir)
+        data = self.configs.get(project_dir)
+        return Project.from_config(
+            get_project_name(project_dir, environment=environment), data,
+            self.get_client(environment, data.version))
+
+    def _execute(self, project_dir, method, options, arguments):
+        """
+        Load the project and execute the command (in the executor)
+        """
+        try:
+            project = self.get_project(project_dir)
+            returncode = method(project, options, arguments or None)
+        except Exception:
+            logger.exception("Docker Compose command %s failed in %s",
+                             method.__name__[3:], project_dir)
+            return ComposeResult(1)
+        return ComposeResult(returncode or 0)
+
+    def do_up(self, project, options, service_names):
+        project.up(service_names=service_names, detached=True,
+                   remove_orphans=("--remove-orphans" in options))
+
+    def do_down(self, project, options, service_names):
+        project.down(ImageType.none, False)
+
+    def do_start(self, project, options, service_names):
+        if not project.start(service_names=service_names):
+            logger.error("No containers to start")
+            return 1
+
+    def do_stop(self, project, options, service_names):
+        project.stop(service_names=service_names)
+
+    def do_kill(self, project, options, service_names):
+        project.kill(service_names=service_names, signal="SIGKILL")
+
+    def do_rm(self, project, options, service_names):
+        project.remove_stopped(service_names=service_names,
+                               v=any("v" in x for x in options),
+                               one_off=OneOffFilter.include)
+
+    def do_restart(self, project, options, service_names):
+        if not project.restart(service_names=service_names):
+            logger.error("No containers to restart")
+            return 1
+
+    def do_scale(self, project, options, service_names):
+        for arg in service_names:
+            service_name, num = arg.split("=", 1)
+            project.get_service(service_name).scale(int(num))
+
+    def do_pull(self, project, options, service_names):
+        project.pull(service_names=service_names)
+
+
+class ComposeConfigCache:
+    """
+    Cache of the Docker Compose configurations loaded from the project
+    directories. An entry remains valid as long as the files it has been
+    loaded from (the Docker Compose files, the .env file, the files of the
+    extended services and the env_file of the services) keep the same
+    modification time and size, or the same content if they have been
+    touched. The configurations that read files that can not be determined
+    are not cached. The cache can be used from multiple threads
+    """
+    def __init__(self, maxsize=256):
+        self.entries = LRUCache(maxsize)
+        self.lock = Lock()
+
+    @staticmethod
+    def get_files(project_dir):
+        return config.config.get_default_config_files(project_dir) + [
+            os.path.join(project_dir, ".env"),
+        ]
+
+    @staticmethod
+    def get_signature(files):
+        """
+        The modification time and the size of the files
+        """
+        signature = []
+        for path in files:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                signature.append((path, None, None))
+            else:
+                signature.append((path, stat.st_mtime_ns, stat.st_size))
+        return signature
+
+    @staticmethod
+    def get_digest(files):
+        """
+        The hash of the content of the files
+        """
+        digest = hashlib.sha1()
+        for path in files:
+            digest.update(path.encode() + b"\0")
+            try:
+                with open(path, "rb") as fh:
+                    digest.update(fh.read())
+            except FileNotFoundError:
+                digest.update(b"\0")
+        return digest.hexdigest()
+
+    @staticmethod
+    def get_referenced_files(config_files):
+        """
+        The files read by Docker Compose besides the Docker Compose files of
+        the project: the files of the extended services and the env_file of
+        the services. Return None if they can not be determined (their path
+        uses variables)
+        """
+        files = []
+        pending = list(config_files)
+        seen = {x.filename for x in config_files}
+        while pending:
+            config_file = pending.pop(0)
+            working_dir = os.path.dirname(config_file.filename)
+            for service in config_file.get_service_dicts().values():
+                env_files = service.get('env_file') or []
+                if isinstance(env_files, str):
+                    env_files = [env_files]
+                extends = service.get('extends')
+                extends_files = [extends['file']] \
+                    if isinstance(extends, dict) and 'file' in extends else []
+                for path in env_files + extends_files:
+                    if not isinstance(path, str) or "$" in path:
+                        return None
+                for path in env_files:
+                    path = os.path.abspath(os.path.join(
+                        working_dir, os.path.expanduser(path)))
+                    if path not in seen:
+                        seen.add(path)
+                        files.append(path)
+                for path in extends_files:
+                    path = os.path.abspath(os.path.join(
+                        working_dir, os.path.expanduser(path)))
+                    if path not in seen:
+                        seen.add(path)
+                        files.append(path)
+                        pending.append(
+                            config.config.ConfigFile.from_filename(path))
+        return files
+
+    @classmethod
+    def load(cls, project_dir):
+        """
+        Use Docker Compose to load the configuration of a project directory.
+        Return the configuration and the other files it has been loaded from
+        (None if they can not be determined)
+        """
+        config_files = config.config.get_default_config_files(project_dir)
+        environment = Environment.from_env_file(project_dir)
+        config_details = config.find(project_dir, config_files, environment)
+        data = config.load(config_details)
+        return data, cls.get_referenced_files(config_details.config_files)
+
+    def get(self, project_dir):
+        """
+        Return the Docker Compose data of a project directory, load it if it
+        is not in the cache or if its files have changed
+        """
+        files = self.get_files(project_dir)
+        with self.lock:
+            entry = self.entries.get(project_dir)
+        if entry is not None:
+            signature = self.get_signature(files + entry['files'])
+            if entry['signature'] == signature:
+                return entry['data']
+            digest = (self.get_digest(files),
+                      self.get_digest(entry['files']))
+            if entry['digest'] == digest:
+                entry['signature'] = signature
+                return entry['data']
+        signature = self.get_signature(files)
+        digest = self.get_digest(files)
+        logger.debug("Loading Docker Compose configuration of %s",
+                     project_dir)
+        data, referenced_files = self.load(project_dir)
+        if referenced_files is None:
+            logger.debug("Docker Compose configuration of %s not cached: "
+                         "the files it reads can not be determined",
+                         project_dir)
+            return data
+        # NOTE: the files referenced are only known once the configuration
+        #       has been loaded
+        signature += self.get_signature(referenced_files)
+        digest = (digest, self.get_digest(referenced_files))
+        with self.lock:
+            self.entries.set(project_dir, {
+                'files': referenced_files,
+                'signature': signature,
+                'digest': digest,
+                'data': data,
+            })
+        return data
+
+    def invalidate(self, project_dir):
+        with self.lock:
+            self.entries.pop(project_dir)
@@ -1,14 +1,61 @@
+import asyncio
+import logging
 from aiohttp import web
-from aiosparql.syntax import IRI, Literal
-from itertools import groupby
+from aiosparql.syntax import all_prefixes, IRI, Literal, PrefixedName
+from itertools import chain
 
-from muswarmadmin import pipelines, repositories, services
+from muswarmadmin import metrics, pipelines, repositories, services
+from muswarmadmin.jsonstream import JSONStream, JSONStreamError
+
+
+logger = logging.getLogger(__name__)
+
+# NOTE: maximum number of distinct IRIs interned (the predicates)
+MAXIMUM_INTERNED_IRIS = 10000
+# NOTE: the resource types managed and the modules handling their updates, in
+#       the order the updates are processed
+RESOURCE_TYPES = [
+    ("stacks/", repositories),
+    ("pipeline-instances/", pipelines),
+    ("services/", services),
+]
+
+
+def get_vocabulary():
+    """
+    The IRIs of all the names of the namespaces declared (prefixes.py)
+    """
+    return {
+        x.iri().value: x.iri()
+        for namespace in all_prefixes.values()
+        for x in vars(namespace).values()
+        if isinstance(x, PrefixedName)
+    }
+
+
+_interned_iris = get_vocabulary()
+
+
+def intern_iri(value, add=True):
+    """
+    Return the same IRI object for the same IRI string. New IRIs are only
+    added if add is True and until MAXIMUM_INTERNED_IRIS is reached
+    """
+    iri = _interned_iris.get(value)
+    if iri is None:
+        iri = IRI(value)
+        if add and len(_interned_iris) < MAXIMUM_INTERNED_IRIS:
+            _interned_iris[value] = iri
+    return iri
 
 
 class Triple:
     """
-    A triple: subject (s), predicate (p) and object (o)
+    A triple: subject (s), predicate (p) and object (o). The predicates and
+    the IRIs of the vocabulary are interned
     """
+    __slots__ = ('s', 'p', 'o', '_hash')
+
     def __init__(self, data):
         assert isinstance(data, dict)
         assert "s" in data
@@ -18,24 +65,32 @@ class Triple:
         assert "o" in data
         assert isinstance(data['o'], dict)
         self.s = IRI(data['s']['value'])
-        self.p = IRI(data['p']['value'])
+        self.p = intern_iri(data['p']['value'])
         if data['o']['type'] == "uri":
-            self.o = IRI(data['o']['value'])
+            # NOTE: the objects are not added, they are as many as the
+            #       subjects
+            self.o = intern_iri(data['o']['value'], add=False)
         elif data['o']['type'] in ("literal", "typed-literal"):
             self.o = Literal(data['o']['value'])
         else:
             raise NotImplementedError("object type %s" % data['o']['type'])
+        self._hash = hash((self.s.value, self.p.value, self.o.__class__,
+                           self.o.value))
 
     def __repr__(self):  # pragma: no cover
         return "<%s s=%s p=%s o=%s>" % (
             self.__class__.__name__, self.s, self.p, self.o)
 
     def __hash__(self):
-        return hash((hash(self.s), hash(self.p), hash(self.o)))
+        return self._hash
 
     def __eq__(self, other):
         if isinstance(other, Triple):
-            return hash(self) == hash(other)
+            return (self._hash == other._hash and
+                    self.s.value == other.s.value and
+                    self.p.value == other.p.value and
+                    self.o.__class__ is other.o.__class__ and
+                    self.o == other.o)
         else:
             return False
 
@@ -49,8 +104,25 @@ class UpdateData:
         assert isinstance(data['inserts'], list)
         assert isinstance(data['deletes'], list)
         self.graph = data['graph']
-        inserts = set(map(Triple, data['inserts']))
-        deletes = set(map(Triple, data['deletes']))
+        self.set_triples(map(Triple, data['inserts']),
+                         map(Triple, data['deletes']))
+
+    @classmethod
+    def from_triples(cls, graph, inserts, deletes):
+        """
+        Create an UpdateData from triples already parsed
+        """
+        data = cls({"graph": graph, "inserts": [], "deletes": []})
+        data.set_triples(inserts, deletes)
+        return data
+
+    def set_triples(self, inserts, deletes):
+        """
+        Set the inserts and the deletes, the triples both inserted and deleted
+        are dropped
+        """
+        inserts = set(inserts)
+        deletes = set(deletes)
         null_operations = inserts & deletes
         self.inserts = list(inserts - null_operations)
         self.deletes = list(deletes - null_operations)
@@ -59,21 +131,29 @@ class UpdateData:
         return "<%s graph=%s inserts=%s deletes=%s>" % (
             self.__class__.__name__, self.graph, self.inserts, self.deletes)
 
-    def filter_inserts(self, func):
-        """
-        Filter inserts that func(x) match where x is a singe triple of the
-        update
-        """
-        assert callable(func)
-        return (x for x in self.inserts if func(x))
 
-    def filter_deletes(self, func):
-        """
-        Filter deletes that func(x) match where x is a singe triple of the
-        update
-        """
-        assert callable(func)
-        return (x for x in self.deletes if func(x))
+def merge_updates(updates):
+    """
+    Merge the UpdateData of the same graph into one net UpdateData, in their
+    order: a triple inserted then deleted by a later update (or the opposite)
+    is dropped
+    """
+    assert updates
+    inserts = {}
+    deletes = {}
+    for data in updates:
+        assert data.graph == updates[0].graph
+        for triple in data.deletes:
+            if triple in inserts:
+                del inserts[triple]
+            else:
+                deletes[triple] = None
+        for triple in data.inserts:
+            if triple in deletes:
+                del deletes[triple]
+            else:
+                inserts[triple] = None
+    return UpdateData.from_triples(updates[0].graph, inserts, deletes)
 
 
 def select_to_triples(result):
@@ -86,63 +166,151 @@ def select_to_triples(result):
 def groupby_subject(triples):
     """
     Group a list of triples by subject and return a dict where the keys are the
-    subjects and the values are lists of triples
+    subjects and the values are lists of triples. The triples don't need to be
+    sorted, the subjects and the triples of a subject keep their order
+    """
+    # NOTE: the IRI strings are hashed much faster than the IRI objects
+    groups = {}
+    for triple in triples:
+        group = groups.get(triple.s.value)
+        if group is None:
+            groups[triple.s.value] = [triple]
+        else:
+            group.append(triple)
+    return {group[0].s: group for group in groups.values()}
+
+
+def get_handlers(base_resource):
+    """
+    Index the handlers of the inserted triples by the IRI prefix of their
+    resource type and the IRI of their predicate. The value is the rank of
+    the resource type and the handler
     """
     return {
-        s: list(group)
-        for s, group in groupby(triples, lambda x: x.s)
+        ((base_resource + resource_type).value, predicate.iri().value):
+            (rank, handler)
+        for rank, (resource_type, module) in enumerate(RESOURCE_TYPES)
+        for predicate, handler in module.handlers.items()
     }
 
 
-def filter_updates(data, resource_type):
+def route(handlers, triples):
+    """
+    Find the handler of every triple in a single pass. Return a list of
+    (handler, triple) ordered by resource type then in the order of the
+    triples
+    """
+    routed = [[] for x in RESOURCE_TYPES]
+    for triple in triples:
+        subject = triple.s.value
+        entry = handlers.get(
+            (subject[:subject.rfind("/") + 1], triple.p.value))
+        if entry is not None:
+            routed[entry[0]].append((entry[1], triple))
+    return list(chain.from_iterable(routed))
+
+
+async def parse_update_data(stream, graph):
+    """
+    Read an entry of a Delta service payload from a JSONStream. Return an
+    UpdateData if it concerns the graph given in parameter, otherwise None.
+    The triples are built while they are read, the triples of the other
+    graphs are skipped without being decoded when the graph comes first
+    """
+    data = {}
+    async for key in stream.items():
+        if key == "graph":
+            data['graph'] = await stream.value()
+            assert isinstance(data['graph'], str)
+        elif key in ("inserts", "deletes") and \
+                data.get('graph', graph) == graph:
+            data[key] = [Triple(await stream.value())
+                         async for i in stream.elements()]
+        else:
+            await stream.skip()
+    if data.get('graph') != graph:
+        return None
+    assert "inserts" in data and "deletes" in data
+    return UpdateData.from_triples(data['graph'], data['inserts'],
+                                   data['deletes'])
+
+
+async def parse_payload(stream, graph):
     """
-    Filter updates for a resource type
+    Read a Delta service payload from a JSONStream and return the list of
+    UpdateData of the graph given in parameter
     """
-    inserts = groupby_subject(data.filter_inserts(
-        lambda x: x.s.value.startswith(resource_type.value)))
-    deletes = groupby_subject(data.filter_deletes(
-        lambda x: x.s.value.startswith(resource_type.value)))
-    return (inserts, deletes)
+    updates = None
+    async for key in stream.items():
+        if key == "delta":
+            entries = [await parse_update_data(stream, graph)
+                       async for i in stream.elements()]
+            updates = [x for x in entries if x is not None]
+        else:
+            await stream.skip()
+    await stream.end()
+    assert updates is not None, "missing key delta"
+    return updates
 
 
 async def update(request):
     """
-    The API entry point for the Delta service callback
+    The API entry point for the Delta service callback. The payload is parsed
+    while it is received, all the deltas of the application graph are merged
+    into one net delta which is queued and processed in the background, the
+    response is sent immediately
     """
     graph = request.app.sparql.graph
     try:
-        data = await request.json()
-    except Exception:
+        data = await parse_payload(JSONStream(request.content), graph)
+    except JSONStreamError:
         raise web.HTTPBadRequest(body="invalid json")
-    try:
-        data = [UpdateData(x) for x in data['delta']]
+    except asyncio.CancelledError:
+        # NOTE: the client has disconnected before the end of the payload
+        raise
     except Exception:
         request.app.logger.exception("Cannot parse delta payload")
         raise web.HTTPBadRequest(body="cannot parse deltas received")
-    try:
-        first_data = next(x for x in data if x.graph == graph)
-    except StopIteration:
+    metrics.DELTA_PAYLOADS.inc()
+    if not data:
         raise web.HTTPNoContent()
+    data = merge_updates(data)
+    if not data.inserts and not data.deletes:
+        raise web.HTTPNoContent()
+    try:
+        request.app.delta_queue.put_nowait(data)
+    except asyncio.QueueFull:
+        metrics.DELTA_REJECTED.inc()
+        raise web.HTTPServiceUnavailable(body="too many deltas pending")
+    metrics.DELTA_TRIPLES.inc(len(data.inserts), operation="insert")
+    metrics.DELTA_TRIPLES.inc(len(data.deletes), operation="delete")
+
+    request.app.identity_cache.invalidate_triples(data.inserts + data.deletes)
 
-    await repositories.update(
-        request.app,
-        *filter_updates(
-            first_data,
-            request.app.base_resource + "stacks/"))
+    raise web.HTTPNoContent()
 
-    await pipelines.update(
-        request.app,
-        *filter_updates(
-            first_data,
-            request.app.base_resource + "pipeline-instances/"))
 
-    await services.update(
-        request.app,
-        *filter_updates(
-            first_data,
-            request.app.base_resource + "services/"))
+async def process(app, data):
+    """
+    Dispatch the inserts of a delta to the handlers of the resources they
+    concern
+    """
+    for handler, triple in route(app.delta_handlers, data.inserts):
+        await handler(app, triple)
 
-    raise web.HTTPNoContent()
+
+async def worker(app):
+    """
+    The background task that processes the deltas queued one by one
+    """
+    while True:
+        data = await app.delta_queue.get()
+        try:
+            await process(app, data)
+        except Exception:
+            logger.exception("Cannot process delta %r", data)
+        finally:
+            app.delta_queue.task_done()
 
 
 async def startup(app):
@@ -1,22 +1,291 @@
 import asyncio
 import logging
+from aiohttp.client_exceptions import ClientError
+from aiosparql.syntax import escape_any, IRI
+from collections import deque, OrderedDict
+from copy import deepcopy
+from time import time
 
+from muswarmadmin.prefixes import SwarmUI
 
+
+RECONCILE_BATCH_SIZE = 200
 logger = logging.getLogger(__name__)
 
 
-async def watch(docker, handlers):
+class ServiceChange:
+    """
+    The net change of the containers of a service over a sequence of
+    container events.
+
+    A container started with the number n raises the scaling of the service
+    to at least n, a container died with the number n lowers it to at most
+    n - 1. Any sequence of these events clamps the scaling between a lowest
+    and a highest value, which can be applied with at most one operation of
+    each kind
+    """
+    def __init__(self):
+        self.lowest = None
+        self.highest = None
+        self.last_action = None
+        self.started = OrderedDict()
+        self.events = 0
+
+    def __repr__(self):  # pragma: no cover
+        return "<%s lowest=%s highest=%s last_action=%s started=%s>" % (
+            self.__class__.__name__, self.lowest, self.highest,
+            self.last_action, list(self.started))
+
+    def add(self, action, container_id, container_number):
+        """
+        Add a container event ("start" or "die") to the net change
+        """
+        if action == "start":
+            if self.lowest is None or self.lowest < container_number:
+                self.lowest = container_number
+            if self.highest is not None and self.highest < container_number:
+                self.highest = container_number
+            self.started[container_id] = container_number
+        elif action == "die":
+            scaling = container_number - 1
+            if self.highest is None or self.highest > scaling:
+                self.highest = scaling
+            if self.lowest is not None and self.lowest > scaling:
+                self.lowest = scaling
+            self.started.pop(container_id, None)
+        else:
+            raise ValueError("action %r not supported" % action)
+        self.last_action = action
+        self.events += 1
+
+    def operations(self):
+        """
+        Return the operations (action, container number) that have the same
+        net effect than all the events received. The last operation is of the
+        same kind than the last event received so the status is right
+        """
+        operations = []
+        if self.lowest is not None:
+            operations.append(("start", self.lowest))
+        if self.highest is not None:
+            operations.append(("die", self.highest + 1))
+        if self.last_action == "start":
+            operations.reverse()
+        return operations
+
+
+class ContainerEventCoalescer:
+    """
+    Accumulate the container events of every (project, service) received
+    during a time window, then hand over their net change to a callback
+    """
+    def __init__(self, window, callback, loop=None):
+        self.window = window
+        self.callback = callback
+        self.loop = asyncio.get_event_loop() if loop is None else loop
+        self.changes = {}
+        self.timers = {}
+
+    def add(self, project_id, service_name, action, container_id,
+            container_number):
+        """
+        Add a container event, the first event of a (project, service) starts
+        its time window
+        """
+        key = (project_id, service_name)
+        if key not in self.changes:
+            self.changes[key] = ServiceChange()
+            self.timers[key] = self.loop.call_later(
+                self.window, self._flush_later, key)
+        self.changes[key].add(action, container_id, container_number)
+
+    def _flush_later(self, key):
+        self.loop.create_task(self._flush(key))
+
+    async def _flush(self, key):
+        if key not in self.changes:
+            return
+        self.timers.pop(key).cancel()
+        change = self.changes.pop(key)
+        logger.debug("Coalesced %d events of %r: %r", change.events, key,
+                     change)
+        try:
+            await self.callback(*key, change)
+        except Exception:
+            logger.exception("Container events handler %r failed",
+                             self.callback)
+
+    async def flush(self):
+        """
+        Hand over all the changes immediately
+        """
+        for key in list(self.changes):
+            await self._flush(key)
+
+
+class EventDispatcher:
+    """
+    Dispatch the Docker events to their handlers in background tasks. The
+    events of a same Docker Compose project are handled in order, the events
+    of different projects are handled concurrently up to a limit. At most
+    maxsize events can be pending, adding an event blocks beyond that limit
+    """
+    def __init__(self, handlers, concurrency=10, maxsize=1000, loop=None):
+        self.handlers = handlers
+        self.loop = asyncio.get_event_loop() if loop is None else loop
+        self.concurrency = asyncio.Semaphore(concurrency, loop=self.loop)
+        self.slots = asyncio.Semaphore(maxsize, loop=self.loop)
+        self.backlogs = {}
+        self.tasks = {}
+        self.lag = 0.0
+
+    @property
+    def depth(self):
+        """
+        Number of events waiting to be handled
+        """
+        return sum(len(x) for x in self.backlogs.values())
+
+    @staticmethod
+    def get_key(event):
+        """
+        The key that determines the order of the events: the Docker Compose
+        project of the event's actor
+        """
+        return event.get("Actor", {}).get("Attributes", {}).get(
+            "com.docker.compose.project")
+
+    async def put(self, event):
+        """
+        Add an event to the backlog of its project and start a background task
+        to handle it if there is none
+        """
+        if event["Type"] not in self.handlers:
+            return
+        await self.slots.acquire()
+        key = self.get_key(event)
+        self.backlogs.setdefault(key, deque()).append(event)
+        if key not in self.tasks:
+            self.tasks[key] = self.loop.create_task(self._drain(key))
+
+    async def _drain(self, key):
+        """
+        The background task that handles the events of a project one by one
+        """
+        backlog = self.backlogs[key]
+        try:
+            while backlog:
+                event = backlog.popleft()
+                try:
+                    async with self.concurrency:
+                        await self.dispatch(event)
+                finally:
+                    self.slots.release()
+        finally:
+            del self.tasks[key]
+            del self.backlogs[key]
+
+    async def dispatch(self, event):
+        """
+        Call all the handlers of an event
+        """
+        if "timeNano" in event:
+            self.lag = max(0.0, time() - event["timeNano"] / 1e9)
+        for handler in self.handlers[event["Type"]]:
+            try:
+                await handler(event)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Event handler %r failed", handler)
+
+    async def join(self):
+        """
+        Wait for all the events received to be handled
+        """
+        while self.tasks:
+            await asyncio.wait(list(self.tasks.values()), loop=self.loop)
+
+
+class EventCursor:
+    """
+    The position in the Docker event stream: the time of the last event
+    received. It is used to resume the stream after a failure without
+    handling the same event twice
+    """
+    def __init__(self):
+        self.time_nano = None
+        self.last_events = set()
+
+    @property
+    def since(self):
+        """
+        The value of the "since" parameter to resume the event stream (the
+        Docker API has a precision of one second)
+        """
+        if self.time_nano is None:
+            return None
+        return self.time_nano // 1000000000
+
+    @staticmethod
+    def get_time_nano(event):
+        if "timeNano" in event:
+            return event["timeNano"]
+        return event.get("time", 0) * 1000000000
+
+    @staticmethod
+    def get_identity(event):
+        return (event.get("Type"), event.get("Action"),
+                event.get("Actor", {}).get("ID"))
+
+    def advance(self, event):
+        """
+        Move the cursor to an event. Return False if the event has already
+        been received
+        """
+        time_nano = self.get_time_nano(event)
+        identity = self.get_identity(event)
+        if self.time_nano is not None:
+            if time_nano < self.time_nano:
+                return False
+            if time_nano == self.time_nano:
+                if identity in self.last_events:
+                    return False
+                self.last_events.add(identity)
+                return True
+        self.time_nano = time_nano
+        self.last_events = {identity}
+        return True
+
+
+async def watch(docker, dispatcher, retries=10, retry_delay=1, loop=None):
+    """
+    Read the Docker event stream and hand over the events to the dispatcher.
+    If the stream fails, it is resumed from the last event received and the
+    events missed in-between are replayed. The application exits after too
+    many consecutive failures
+    """
+    cursor = EventCursor()
+    failures = 0
     try:
         logger.debug("Event monitor started")
-        async for event in docker.events(decode=True):
-            if event["Type"] in handlers:
-                for handler in handlers[event["Type"]]:
-                    try:
-                        await handler(event)
-                    except asyncio.CancelledError:
-                        raise
-                    except Exception:
-                        logger.exception("Event handler %r failed", handler)
+        while True:
+            try:
+                async for event in docker.events(since=cursor.since,
+                                                 decode=True):
+                    failures = 0
+                    if cursor.advance(event):
+                        await dispatcher.put(event)
+                logger.warning("Docker event stream closed")
+            except (ClientError, asyncio.TimeoutError) as exc:
+                logger.warning("Docker event stream failed: %s", exc)
+            failures += 1
+            if failures > retries:
+                raise Exception("Docker event stream failed %d times" %
+                                failures)
+            logger.info("Resuming Docker event stream since %s in %ss...",
+                        cursor.since, retry_delay * failures)
+            await asyncio.sleep(retry_delay * failures, loop=loop)
     except asyncio.CancelledError:
         pass
     except Exception:
@@ -24,21 +293,187 @@ async def watch(docker, handlers):
         # NOTE: gracefully exit the application
         exit(1)
     finally:
+        await dispatcher.join()
         logger.debug("Event monitor stopped")
 
 
+class PipelineState:
+    """
+    The state of a pipeline and its services in the database, modified
+    locally by replaying the container events on it
+    """
+    def __init__(self, iri, status):
+        self.iri = iri
+        self.status = status
+        self.services = []
+
+    def get_services(self, service_name):
+        return [x for x in self.services if x.name == service_name]
+
+    def container_started(self, service_name, container_number):
+        """
+        Same as Application.update_container_started
+        """
+        services = self.get_services(service_name)
+        for service in services:
+            if service.scaling is not None:
+                service.scaling = max(service.scaling, container_number)
+            if service.status not in (None, SwarmUI.Up, SwarmUI.Started):
+                service.status = SwarmUI.Started
+        if services and \
+                self.status not in (None, SwarmUI.Up, SwarmUI.Started):
+            self.status = SwarmUI.Started
+
+    def container_died(self, service_name, container_number):
+        """
+        Same as Application.update_container_died
+        """
+        services = self.get_services(service_name)
+        for service in services:
+            if service.scaling is not None:
+                service.scaling = min(service.scaling, container_number - 1)
+            if service.status not in (None, SwarmUI.Killed, SwarmUI.Stopped):
+                service.status = (
+                    SwarmUI.Started if container_number > 1
+                    else SwarmUI.Stopped
+                )
+        if services and \
+                self.status not in (None, SwarmUI.Down, SwarmUI.Stopped):
+            self.status = (
+                SwarmUI.Started
+                if any(x.status == SwarmUI.Started and x.name != service_name
+                       for x in self.services)
+                else SwarmUI.Stopped
+            )
+
+
+class ServiceState:
+    """
+    The state of a service in the database
+    """
+    def __init__(self, iri, name, scaling, status):
+        self.iri = iri
+        self.name = name
+        self.scaling = scaling
+        self.status = status
+
+
+def get_value(data, name, type_=str):
+    if name not in data:
+        return None
+    return type_(data[name]['value'])
+
+
+async def get_pipelines_state(app):
+    """
+    Get the state of all the pipelines and their services in a single query
+    """
+    result = await app.sparql.query(
+        """
+        SELECT ?pipeline ?projectid ?pipelinestatus
+          ?service ?name ?scaling ?status
+        FROM {{graph}}
+        WHERE {
+            ?pipeline a swarmui:Pipeline ;
+              mu:uuid ?projectid .
+
+            OPTIONAL { ?pipeline swarmui:status ?pipelinestatus } .
+
+            OPTIONAL {
+                ?pipeline swarmui:services ?service .
+
+                ?service a swarmui:Service ;
+                  dct:title ?name .
+
+                OPTIONAL { ?service swarmui:scaling ?scaling } .
+                OPTIONAL { ?service swarmui:status ?status } .
+            }
+        }
+        """)
+    pipelines = OrderedDict()
+    for data in result['results']['bindings']:
+        project_id = get_value(data, 'projectid')
+        if project_id not in pipelines:
+            pipelines[project_id] = PipelineState(
+                get_value(data, 'pipeline', IRI),
+                get_value(data, 'pipelinestatus', IRI))
+        if 'service' in data:
+            pipelines[project_id].services.append(ServiceState(
+                get_value(data, 'service', IRI), get_value(data, 'name'),
+                get_value(data, 'scaling', int),
+                get_value(data, 'status', IRI)))
+    return pipelines
+
+
+def get_changes(old_pipelines, new_pipelines):
+    """
+    Return the triples (subject, predicate, object) that have changed between
+    two states of the pipelines
+    """
+    changes = []
+    for project_id, new_pipeline in new_pipelines.items():
+        old_pipeline = old_pipelines[project_id]
+        if new_pipeline.status != old_pipeline.status:
+            changes.append(
+                (new_pipeline.iri, SwarmUI.status, new_pipeline.status))
+        for old, new in zip(old_pipeline.services, new_pipeline.services):
+            if new.scaling != old.scaling:
+                changes.append((new.iri, SwarmUI.scaling, new.scaling))
+            if new.status != old.status:
+                changes.append((new.iri, SwarmUI.status, new.status))
+    return changes
+
+
+async def apply_changes(app, changes):
+    """
+    Replace the object of the triples given in parameter in batches of
+    RECONCILE_BATCH_SIZE triples
+    """
+    for i in range(0, len(changes), RECONCILE_BATCH_SIZE):
+        values = "\n".join(
+            "(%s)" % " ".join(escape_any(x) for x in change)
+            for change in changes[i:i + RECONCILE_BATCH_SIZE]
+        )
+        await app.sparql.update(
+            """
+            WITH {{graph}}
+            DELETE {
+                ?s ?p ?oldvalue .
+            }
+            INSERT {
+                ?s ?p ?newvalue .
+            }
+            WHERE {
+                VALUES (?s ?p ?newvalue) {
+                    {{values}}
+                }
+
+                ?s ?p ?oldvalue .
+            }
+            """, values=values)
+
+
 async def startup(app):
     """
     Hook on the startup of the application that will call the Docker API to
-    check for existing running containers and call for container started event
-    on the application. When the application starts up, it will automatically
-    update the database based on actual running containers. It will also check
-    the information in the database and ensure that the containers exist and
-    are running. If they don't exist, call for container die event on the
-    application will be made.
-    """
-    running_services = {}
-    for container in await app.docker.containers():
+    check for existing running containers and reconcile the database with
+    them
+    """
+    await reconcile(app, await app.docker.containers())
+
+
+async def reconcile(app, containers):
+    """
+    Update the database based on actual running containers: the effect of a
+    container started event for every running container is computed locally
+    on the state of the pipelines fetched with a single query. Then the
+    services marked as started in the database with no running container get
+    the effect of container died events. The difference is written to the
+    database in batches
+    """
+    running_services = OrderedDict()
+    running_containers = []
+    for container in containers:
         project_name = container['Labels'].get("com.docker.compose.project")
         service_name = container['Labels'].get("com.docker.compose.service")
         if not (project_name and service_name):
@@ -46,34 +481,39 @@ async def startup(app):
         project_id = project_name.upper()
         container_number = int(
             container['Labels'].get("com.docker.compose.container-number", 0))
-        await app.event_container_started(
-            container['Id'], project_id, service_name, container_number)
-        if project_name and service_name:
-            running_services[(project_name, service_name)] = max(
-                running_services.get((project_name, service_name), 0),
-                container_number)
+        running_containers.append(
+            (container['Id'], project_id, service_name, container_number))
+        running_services[(project_id, service_name)] = max(
+            running_services.get((project_id, service_name), 0),
+            container_number)
 
-    result = await app.sparql.query(
-        """
-        SELECT *
-        FROM {{graph}}
-        WHERE {
-            ?service a swarmui:Service ;
-              mu:uuid ?uuid ;
-              dct:title ?name ;
-              swarmui:status swarmui:Started ;
-              swarmui:scaling ?scaling .
+    old_pipelines = await get_pipelines_state(app)
+    pipelines = deepcopy(old_pipelines)
 
-            ?pipeline a swarmui:Pipeline ;
-              swarmui:services ?service ;
-              mu:uuid ?projectid .
-        }
-        """)
-    for data in result['results']['bindings']:
-        project_id = data['projectid']['value']
-        service_name = data['name']['value']
-        project_name = project_id.lower()
-        scaling = int(data['scaling']['value'])
-        actual_scaling = running_services.get((project_name, service_name), 0)
-        for i in range(scaling, actual_scaling, -1):
-            await app.event_container_died(project_id, service_name, i)
+    for container_id, project_id, service_name, container_number in \
+            running_containers:
+        if project_id in pipelines:
+            pipelines[project_id].container_started(service_name,
+                                                    container_number)
+
+    for project_id, pipeline in pipelines.items():
+        for service in pipeline.services:
+            if service.status != SwarmUI.Started or service.scaling is None:
+                continue
+            actual_scaling = running_services.get((project_id, service.name),
+                                                  0)
+            for i in range(service.scaling, actual_scaling, -1):
+                pipeline.container_died(service.name, i)
+
+    changes = get_changes(old_pipelines, pipelines)
+    logger.info("Reconciling %d running containers: %d changes",
+                len(running_containers), len(changes))
+    await apply_changes(app, changes)
+
+    joined = False
+    for container_id, project_id, service_name, container_number in \
+            running_containers:
+        if project_id in pipelines:
+            joined = await app.join_public_network(container_id) or joined
+    if joined:
+        await app.enqueue_one_action("proxy", app.restart_proxy, [])
@@ -0,0 +1,77 @@
+import asyncio
+import hashlib
+import logging
+import os
+from shutil import rmtree
+from time import monotonic
+
+
+logger = logging.getLogger(__name__)
+
+
+class GitMirrors:
+    """
+    Local bare mirrors of the git repositories of the stacks, keyed by
+    location. A mirror is cloned once and fetched again at most every
+    refresh_interval seconds (unless a refresh is forced), the pipelines are
+    cloned from and updated with their mirror instead of the remote
+    repository
+    """
+    def __init__(self, run_command, root, refresh_interval, loop=None):
+        self.run_command = run_command
+        self.root = root
+        self.refresh_interval = refresh_interval
+        self.loop = asyncio.get_event_loop() if loop is None else loop
+        self.refreshed = {}
+        self.locks = {}
+
+    def get_path(self, location):
+        """
+        The path of the mirror of a repository
+        """
+        return os.path.join(
+            self.root, "%s.git" % hashlib.sha1(location.encode()).hexdigest())
+
+    async def update(self, location, force=False):
+        """
+        Create the mirror of a repository or refresh it if it has not been
+        refreshed in the last refresh_interval seconds (or if force is True).
+        Return the path of the mirror or None if it can not be fetched
+        """
+        lock = self.locks.setdefault(location, asyncio.Lock(loop=self.loop))
+        async with lock:
+            path = self.get_path(location)
+            exists = os.path.exists(path)
+            refreshed = self.refreshed.get(location)
+            if exists and refreshed is not None and not force and \
+                    monotonic() - refreshed < self.refresh_interval:
+                return path
+            if exists:
+                logger.info("Refreshing the mirror of %s", location)
+                proc = await self.run_command(
+                    "git", "remote", "update", "--prune", cwd=path)
+            else:
+                logger.info("Creating the mirror of %s", location)
+                os.makedirs(self.root, exist_ok=True)
+                proc = await self.run_command(
+                    "git", "clone", "--mirror", location, path)
+                if proc.returncode != 0 and os.path.exists(path):
+                    rmtree(path)
+            if proc.returncode != 0:
+                logger.error("Failed to fetch repository at %s", location)
+                return None
+            self.refreshed[location] = monotonic()
+            return path
+
+    async def remove(self, location):
+        """
+        Remove the mirror of a repository and forget about its location
+        """
+        lock = self.locks.setdefault(location, asyncio.Lock(loop=self.loop))
+        async with lock:
+            path = self.get_path(location)
+            if os.path.exists(path):
+                logger.info("Removing the mirror of %s", location)
+                rmtree(path)
+            self.refreshed.pop(location, None)
+        self.locks.pop(location, None)
@@ -0,0 +1,182 @@
+from collections import OrderedDict
+
+from muswarmadmin import metrics
+from muswarmadmin.prefixes import Dct, Mu, SwarmUI
+
+
+class LRUCache:
+    """
+    A bounded mapping that evicts the least recently used entry when it is
+    full. It counts the hits and the misses of its lookups
+    """
+    def __init__(self, maxsize):
+        assert maxsize > 0
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        """
+        Get the value of a key and mark it as the most recently used
+        """
+        try:
+            value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """
+        Set the value of a key, evict the least recently used entry if the
+        cache is full
+        """
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.data.pop(key, default)
+
+    def clear(self):
+        self.data.clear()
+
+
+class IdentityCache:
+    """
+    Cache of the identity of the resources managed by the application: the
+    mu:uuid of a subject IRI (and the opposite), the dct:title of a mu:uuid
+    and the pipeline mu:uuid of a service mu:uuid.
+
+    The cache is kept up-to-date by invalidating the entries whose identity
+    triples appear in the deltas received from the Delta service
+    """
+    def __init__(self, maxsize=4096):
+        self.resource_ids = LRUCache(maxsize)
+        self.resource_iris = LRUCache(maxsize)
+        self.titles = LRUCache(maxsize)
+        self.service_pipelines = LRUCache(maxsize)
+
+    @property
+    def caches(self):
+        return {
+            "resource_ids": self.resource_ids,
+            "resource_iris": self.resource_iris,
+            "titles": self.titles,
+            "service_pipelines": self.service_pipelines,
+        }
+
+    @property
+    def hits(self):
+        return sum(x.hits for x in self.caches.values())
+
+    @property
+    def misses(self):
+        return sum(x.misses for x in self.caches.values())
+
+    def stats(self):
+        """
+        Return the size, the hits and the misses of every cache
+        """
+        return {
+            name: {"size": len(cache), "hits": cache.hits,
+                   "misses": cache.misses}
+            for name, cache in self.caches.items()
+        }
+
+    def lookup(self, name, key):
+        """
+        Get the value of a key in one of the caches and count the hit or the
+        miss
+        """
+        value = self.caches[name].get(key)
+        if value is None:
+            metrics.IDENTITY_CACHE_MISSES.inc(cache=name)
+        else:
+            metrics.IDENTITY_CACHE_HITS.inc(cache=name)
+        return value
+
+    def get_resource_id(self, subject):
+        return self.lookup("resource_ids", subject)
+
+    def set_resource_id(self, subject, uuid):
+        self.resource_ids.set(subject, uuid)
+        self.resource_iris.set(uuid, subject)
+
+    def get_title(self, uuid):
+        return self.lookup("titles", uuid)
+
+    def set_title(self, uuid, title):
+        self.titles.set(uuid, title)
+
+    def get_service_pipeline(self, service_id):
+        return self.lookup("service_pipelines", service_id)
+
+    def set_service_pipeline(self, service_id, pipeline_id):
+        self.service_pipelines.set(service_id, pipeline_id)
+
+    def invalidate_uuid(self, uuid):
+        """
+        Remove all the entries related to a mu:uuid
+        """
+        subject = self.resource_iris.pop(uuid)
+        if subject is not None:
+            self.resource_ids.pop(subject)
+        self.titles.pop(uuid)
+        self.service_pipelines.pop(uuid)
+        # NOTE: the pipeline of a service is also stale when the pipeline
+        #       itself goes away
+        services = self.service_pipelines.data
+        for service_id in [k for k, v in services.items() if v == uuid]:
+            self.service_pipelines.pop(service_id)
+
+    def invalidate(self, subject):
+        """
+        Remove all the entries related to a subject IRI. Return False if the
+        subject is not known by the cache
+        """
+        uuid = self.resource_ids.pop(subject)
+        if uuid is None:
+            return False
+        self.resource_iris.pop(uuid)
+        self.invalidate_uuid(uuid)
+        return True
+
+    def invalidate_triples(self, triples):
+        """
+        Remove all the entries affected by a list of inserted or deleted
+        triples. Only the predicates that carry an identity (mu:uuid,
+        dct:title and swarmui:services) affect the cache
+        """
+        for triple in triples:
+            if triple.p == Mu.uuid:
+                self.invalidate_uuid(triple.o.value)
+                self.invalidate(triple.s)
+            elif triple.p == Dct.title:
+                # NOTE: if the subject is not known we can not know which
+                #       entry is affected by the change, we drop all of them
+                uuid = self.resource_ids.data.get(triple.s)
+                if uuid is None:
+                    self.titles.clear()
+                else:
+                    self.titles.pop(uuid)
+            elif triple.p == SwarmUI.services:
+                service_id = self.resource_ids.data.get(triple.o)
+                if service_id is None:
+                    self.service_pipelines.clear()
+                else:
+                    self.service_pipelines.pop(service_id)
+
+    def clear(self):
+        for cache in self.caches.values():
+            cache.clear()
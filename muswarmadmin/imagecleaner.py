@@ -0,0 +1,60 @@
+import aiodockerpy
+import asyncio
+import logging
+from collections import Counter
+
+from muswarmadmin import metrics
+from muswarmadmin.imagepuller import normalize_image
+
+
+logger = logging.getLogger(__name__)
+
+
+async def get_image_references(app, project_ids):
+    """
+    Count the references to the Docker images: the images of the services of
+    the projects given in parameter and the images of the containers running
+    (counted by reference and by identifier)
+    """
+    references = Counter()
+    for project_id in project_ids:
+        data = await app.load_compose_data(project_id)
+        references.update(normalize_image(x['image'])
+                          for x in data.services if 'image' in x)
+    for container in await app.docker.containers():
+        references[normalize_image(container['Image'])] += 1
+        references[container['ImageID']] += 1
+    return references
+
+
+async def remove_images(docker, images, references, concurrency=4,
+                        loop=None):
+    """
+    Remove the images that are not referenced, at most concurrency images at
+    the same time. Return the number of bytes reclaimed: the size of the
+    images deleted (not only untagged)
+    """
+    semaphore = asyncio.Semaphore(concurrency, loop=loop)
+
+    async def remove(image):
+        async with semaphore:
+            try:
+                info = await docker.inspect_image(image)
+                if references[info['Id']]:
+                    logger.debug("Image %s is still used", image)
+                    return 0
+                result = await docker.remove_image(image)
+            except aiodockerpy.errors.APIError as exc:
+                if exc.is_server_error():
+                    logger.error(str(exc))
+                return 0
+        metrics.IMAGES_REMOVED.inc()
+        if any(x.get('Deleted') == info['Id'] for x in result):
+            metrics.IMAGE_BYTES_RECLAIMED.inc(info['Size'])
+            return info['Size']
+        return 0
+
+    images = set(normalize_image(x) for x in images)
+    sizes = await asyncio.gather(
+        *[remove(x) for x in sorted(images) if not references[x]], loop=loop)
+    return sum(sizes)
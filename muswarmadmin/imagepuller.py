@@ -0,0 +1,119 @@
+import asyncio
+import logging
+from docker.utils import parse_repository_tag
+
+from muswarmadmin import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_image(image):
+    """
+    The repository and the tag of an image reference, the tag latest is used
+    when the reference has neither a tag nor a digest
+    """
+    if "@" in image:
+        return image
+    repository, tag = parse_repository_tag(image)
+    return "%s:%s" % (repository, tag or "latest")
+
+
+class PullError(Exception):
+    """
+    Exception raised when the Docker daemon fails to pull an image
+    """
+    pass
+
+
+class ImagePuller:
+    """
+    Pull Docker images with the Docker API. The callers pulling an image that
+    is being pulled already wait for the same pull, at most concurrency
+    distinct images are pulled at the same time. The progress of the layers
+    downloaded is kept for every image being pulled
+    """
+    def __init__(self, docker, concurrency=4, loop=None):
+        self.docker = docker
+        self.loop = asyncio.get_event_loop() if loop is None else loop
+        self.semaphore = asyncio.Semaphore(concurrency, loop=self.loop)
+        self.pulls = {}
+        self.layers = {}
+
+    @property
+    def progress(self):
+        """
+        The bytes downloaded and the total bytes of the layers of every image
+        being pulled (the total grows as the layers are discovered)
+        """
+        return {
+            image: (sum(x[0] for x in layers.values()),
+                    sum(x[1] for x in layers.values()))
+            for image, layers in self.layers.items()
+        }
+
+    async def pull(self, image):
+        """
+        Pull an image or wait for the pull in flight of the same image (the
+        tag latest is used when the image has none). Raise an exception if
+        the pull failed
+        """
+        image = normalize_image(image)
+        task = self.pulls.get(image)
+        if task is None:
+            task = self.pulls[image] = self.loop.create_task(
+                self._pull(image))
+            task.add_done_callback(self._pull_done)
+        else:
+            logger.debug("Image %s is being pulled already", image)
+            metrics.IMAGE_PULLS_SHARED.inc()
+        # NOTE: the pull continues for the other callers if this one is
+        #       cancelled
+        await asyncio.shield(task, loop=self.loop)
+
+    def _pull_done(self, task):
+        for image, pull in list(self.pulls.items()):
+            if pull is task:
+                del self.pulls[image]
+        # NOTE: mark the exception as retrieved if all the callers are gone
+        if not task.cancelled():
+            task.exception()
+
+    async def _pull(self, image):
+        async with self.semaphore:
+            logger.info("Pulling image %s", image)
+            repository, tag = parse_repository_tag(image)
+            layers = self.layers[image] = {}
+            try:
+                with metrics.IMAGE_PULL_DURATION.time():
+                    async for event in self.docker.pull(
+                            repository, tag=tag, stream=True, decode=True):
+                        if "error" in event:
+                            raise PullError("%s: %s" % (image,
+                                                        event["error"]))
+                        detail = event.get("progressDetail") or {}
+                        if "id" in event and "total" in detail:
+                            layers[event["id"]] = (detail.get("current", 0),
+                                                   detail["total"])
+                        elif event.get("status") == "Pull complete" and \
+                                event.get("id") in layers:
+                            total = layers[event["id"]][1]
+                            layers[event["id"]] = (total, total)
+            finally:
+                del self.layers[image]
+            logger.info("Image %s pulled", image)
+
+    async def pull_all(self, images):
+        """
+        Pull images concurrently. Return the list of the images that could not
+        be pulled
+        """
+        images = list(images)
+        results = await asyncio.gather(*[self.pull(x) for x in images],
+                                       loop=self.loop, return_exceptions=True)
+        failed = []
+        for image, result in zip(images, results):
+            if isinstance(result, Exception):
+                logger.error("Can not pull image %s: %s", image, result)
+                failed.append(image)
+        return failed
@@ -0,0 +1,172 @@
+import codecs
+import json
+import re
+
+
+WHITESPACE = " \t\n\r"
+DELIMITERS = WHITESPACE + ",]}"
+_decoder = json.JSONDecoder()
+_re_skip = re.compile(r'(?P<string>"[^"\\]*(?:\\.[^"\\]*)*")|'
+                      r'(?P<open>[\[{])|(?P<close>[\]}])|(?P<partial>")')
+
+
+class JSONStreamError(ValueError):
+    """
+    Exception raised when the stream is not a valid JSON document
+    """
+    pass
+
+
+class JSONStream:
+    """
+    Incremental reader of a JSON document from an asyncio stream. The objects
+    and the arrays are walked through member by member, only the values asked
+    are decoded and the others are skipped. Only the part of the document not
+    consumed yet is kept in memory
+    """
+    def __init__(self, reader, chunk_size=2 ** 16):
+        self.reader = reader
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    async def fill(self):
+        """
+        Read the next chunk of the stream and drop the part of the buffer
+        already consumed. Return False at the end of the stream
+        """
+        if self.eof:
+            return False
+        chunk = await self.reader.read(self.chunk_size)
+        self.eof = not chunk
+        try:
+            text = self.decoder.decode(chunk, final=self.eof)
+        except UnicodeDecodeError as exc:
+            raise JSONStreamError(str(exc))
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+        return not self.eof
+
+    async def peek(self):
+        """
+        Skip the whitespaces and return the next character or None at the end
+        of the stream
+        """
+        while True:
+            while self.pos < len(self.buffer) and \
+                    self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not await self.fill():
+                return None
+
+    async def expect(self, chars):
+        """
+        Consume the next character which must be one of chars
+        """
+        char = await self.peek()
+        if char is None or char not in chars:
+            raise JSONStreamError("expected one of %r, got %r" % (chars, char))
+        self.pos += 1
+        return char
+
+    async def value(self):
+        """
+        Decode the next value
+        """
+        await self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as exc:
+                if await self.fill():
+                    continue
+                raise JSONStreamError(str(exc))
+            # NOTE: a number may continue in the next chunk
+            if isinstance(value, (int, float)) and \
+                    not isinstance(value, bool) and \
+                    (end == len(self.buffer) or
+                     self.buffer[end] not in DELIMITERS) and \
+                    await self.fill():
+                continue
+            self.pos = end
+            return value
+
+    async def skip(self):
+        """
+        Skip the next value without decoding it. The content of the objects
+        and arrays skipped is not validated
+        """
+        char = await self.peek()
+        if char is None:
+            raise JSONStreamError("unexpected end of stream")
+        if char not in '[{"':
+            await self.value()
+            return
+        depth = 0
+        while True:
+            for match in _re_skip.finditer(self.buffer, self.pos):
+                kind = match.lastgroup
+                if kind == "partial":
+                    # NOTE: the end of the string is in the next chunk
+                    self.pos = match.start()
+                    break
+                self.pos = match.end()
+                if kind == "open":
+                    depth += 1
+                    continue
+                if kind == "close":
+                    depth -= 1
+                if depth == 0:
+                    return
+            else:
+                self.pos = len(self.buffer)
+            if not await self.fill():
+                raise JSONStreamError("unexpected end of stream")
+
+    async def items(self):
+        """
+        Walk through the members of the next object: yield the keys one by
+        one, the value of a key must be consumed (with value(), skip() or
+        recursively) before the next iteration
+        """
+        await self.expect("{")
+        if await self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = await self.value()
+            if not isinstance(key, str):
+                raise JSONStreamError("invalid object key: %r" % key)
+            await self.expect(":")
+            yield key
+            if await self.expect(",}") == "}":
+                return
+
+    async def elements(self):
+        """
+        Walk through the elements of the next array: yield the index of the
+        elements one by one, the element must be consumed before the next
+        iteration
+        """
+        await self.expect("[")
+        if await self.peek() == "]":
+            self.pos += 1
+            return
+        index = 0
+        while True:
+            yield index
+            if await self.expect(",]") == "]":
+                return
+            index += 1
+
+    async def end(self):
+        """
+        Check that nothing but whitespaces remains in the stream
+        """
+        char = await self.peek()
+        if char is not None:
+            raise JSONStreamError("unexpected data after the end: %r" % char)
@@ -4,17 +4,24 @@ import docker.utils.utils
 import logging
 import re
 import subprocess
-from aiohttp import web
+from aiohttp import TCPConnector, web
 from aiohttp.client_exceptions import ClientConnectionError
 from aiosparql.client import SPARQLClient
 from aiosparql.syntax import escape_string, IRI, Node, RDF, RDFTerm, Triples
-from compose import config
-from compose.config.environment import Environment
 from os import environ as ENV
+from textwrap import dedent
 from uuid import uuid4
 
-from muswarmadmin import delta, eventmonitor, services
-from muswarmadmin.actionscheduler import ActionScheduler, OneActionScheduler
+from muswarmadmin import (
+    composeengine, delta, eventmonitor, metrics, services)
+from muswarmadmin.actionjournal import ActionJournal
+from muswarmadmin.actionscheduler import (
+    ActionScheduler, ConcurrencyLimit, OneActionScheduler, RECONCILIATION,
+    USER)
+from muswarmadmin.composeengine import ComposeConfigCache, ComposeEngine
+from muswarmadmin.gitmirrors import GitMirrors
+from muswarmadmin.identitycache import IdentityCache
+from muswarmadmin.imagepuller import ImagePuller
 from muswarmadmin.prefixes import Dct, Mu, SwarmUI
 
 
@@ -34,10 +41,73 @@ class Application(web.Application):
     # NOTE: timeout allowed to docker-compose up command to proceed. If the
     #       time exceeds, the application is killed.
     compose_up_timeout = 1800
+    # NOTE: "subprocess" forks a docker-compose process for every command,
+    #       "inprocess" executes the Docker Compose commands in a thread of
+    #       the application. The commands executed in-process can not be
+    #       interrupted when they exceed their timeout. The commands that are
+    #       not supported in-process are always executed in a subprocess.
+    compose_engine = ENV.get("COMPOSE_ENGINE", "subprocess")
+    # NOTE: maximum number of Docker Compose configurations kept in memory
+    compose_config_cache_size = int(ENV.get("COMPOSE_CONFIG_CACHE_SIZE", 256))
+    # NOTE: directory of the bare mirrors of the git repositories of the
+    #       stacks and minimum time (in seconds) between two fetches of a
+    #       mirror
+    git_mirrors_path = "/data/.mirrors"
+    git_mirror_refresh_interval = float(
+        ENV.get("GIT_MIRROR_REFRESH_INTERVAL", 60))
+    # NOTE: maximum number of distinct Docker images pulled at the same time
+    image_pull_concurrency = int(ENV.get("IMAGE_PULL_CONCURRENCY", 4))
+    # NOTE: maximum number of Docker images removed at the same time
+    image_removal_concurrency = int(ENV.get("IMAGE_REMOVAL_CONCURRENCY", 4))
     # NOTE: base IRI used for all the resources managed by this service.
     base_resource = IRI("http://swarm-ui.big-data-europe.eu/resources/")
     # NOTE: override default timeout for SPARQL queries
     sparql_timeout = 60
+    # NOTE: connection pool of the SPARQL client: maximum number of
+    #       connections in total and to the endpoint (0 for no limit), time in
+    #       seconds an idle connection is kept alive and the DNS resolutions
+    #       are cached. The connections are always opened with TCP_NODELAY.
+    sparql_connection_limit = int(ENV.get("SPARQL_CONNECTION_LIMIT", 100))
+    sparql_connection_limit_per_host = \
+        int(ENV.get("SPARQL_CONNECTION_LIMIT_PER_HOST", 0))
+    sparql_keepalive_timeout = \
+        float(ENV.get("SPARQL_KEEPALIVE_TIMEOUT", 15))
+    sparql_dns_cache_ttl = int(ENV.get("SPARQL_DNS_CACHE_TTL", 10))
+    # NOTE: the Delta service may not handle multiple update operations in a
+    #       single HTTP request, send them one by one unless enabled.
+    sparql_combined_updates = \
+        ENV.get("SPARQL_COMBINED_UPDATES", "false").lower() == "true"
+    # NOTE: time window (in seconds) during which the container events of a
+    #       service are coalesced before updating the database. Disabled if 0.
+    container_events_window = float(ENV.get("CONTAINER_EVENTS_WINDOW", 0))
+    # NOTE: maximum number of Docker event handlers running concurrently (the
+    #       events of a same project are always handled in order)
+    event_handlers_concurrency = int(
+        ENV.get("EVENT_HANDLERS_CONCURRENCY", 10))
+    # NOTE: maximum number of Docker events waiting to be handled before the
+    #       event stream stops being read
+    event_queue_size = int(ENV.get("EVENT_QUEUE_SIZE", 1000))
+    # NOTE: number of consecutive failures of the Docker event stream allowed
+    #       before the application is killed. The stream is resumed from the
+    #       last event received after a delay that grows with each failure.
+    event_monitor_retries = int(ENV.get("EVENT_MONITOR_RETRIES", 10))
+    event_monitor_retry_delay = 1
+    # NOTE: maximum number of actions (Docker Compose commands, ...) executed
+    #       at the same time by all the action schedulers (the actions of a
+    #       same key are always executed in order)
+    action_concurrency = int(ENV.get("ACTION_CONCURRENCY", 4))
+    # NOTE: time (in seconds) after which an idle action scheduler is removed,
+    #       it is created again by the next action of its key
+    action_scheduler_ttl = float(ENV.get("ACTION_SCHEDULER_TTL", 300))
+    # NOTE: path of the journal of the actions queued. If set, the actions
+    #       pending at shutdown are not awaited but resumed at the next
+    #       startup. Disabled if empty.
+    action_journal_path = ENV.get("ACTION_JOURNAL", "")
+    # NOTE: maximum number of deltas waiting to be processed. The Delta
+    #       service receives a 503 when it is reached.
+    delta_queue_size = int(ENV.get("DELTA_QUEUE_SIZE", 100))
+    # NOTE: maximum number of entries kept in each map of the identity cache
+    identity_cache_size = int(ENV.get("IDENTITY_CACHE_SIZE", 4096))
 
     @property
     def sparql(self):
@@ -45,12 +115,81 @@ class Application(web.Application):
         The SPARQL client
         """
         if not hasattr(self, '_sparql'):
+            connector = TCPConnector(
+                limit=self.sparql_connection_limit,
+                limit_per_host=self.sparql_connection_limit_per_host,
+                keepalive_timeout=self.sparql_keepalive_timeout,
+                ttl_dns_cache=self.sparql_dns_cache_ttl, loop=self.loop)
             self._sparql = SPARQLClient(ENV['MU_SPARQL_ENDPOINT'],
                                         graph=IRI(ENV['MU_APPLICATION_GRAPH']),
-                                        loop=self.loop,
+                                        loop=self.loop, connector=connector,
                                         read_timeout=self.sparql_timeout)
         return self._sparql
 
+    @property
+    def identity_cache(self):
+        """
+        The cache of the identity of the resources (mu:uuid, dct:title and
+        pipeline of a service)
+        """
+        if not hasattr(self, '_identity_cache'):
+            self._identity_cache = IdentityCache(self.identity_cache_size)
+        return self._identity_cache
+
+    @property
+    def delta_queue(self):
+        """
+        The queue of the deltas received from the Delta service waiting to be
+        processed
+        """
+        if not hasattr(self, '_delta_queue'):
+            self._delta_queue = asyncio.Queue(maxsize=self.delta_queue_size,
+                                              loop=self.loop)
+        return self._delta_queue
+
+    @property
+    def action_limit(self):
+        """
+        The limit of actions executed at the same time by the action
+        schedulers
+        """
+        if not hasattr(self, '_action_limit'):
+            self._action_limit = ConcurrencyLimit(self.action_concurrency,
+                                                  loop=self.loop)
+        return self._action_limit
+
+    @property
+    def action_journal(self):
+        """
+        The journal of the actions queued (None if disabled)
+        """
+        if not hasattr(self, '_action_journal'):
+            self._action_journal = (
+                ActionJournal(self.action_journal_path, self)
+                if self.action_journal_path else None)
+        return self._action_journal
+
+    @property
+    def scheduler_options(self):
+        """
+        The options of the action schedulers of the application
+        """
+        return {
+            "loop": self.loop,
+            "limit": self.action_limit,
+            "idle_ttl": self.action_scheduler_ttl,
+            "journal": self.action_journal,
+        }
+
+    @property
+    def delta_handlers(self):
+        """
+        The handlers of the deltas indexed by resource type and predicate
+        """
+        if not hasattr(self, '_delta_handlers'):
+            self._delta_handlers = delta.get_handlers(self.base_resource)
+        return self._delta_handlers
+
     @property
     def docker(self):
         """
@@ -62,6 +201,59 @@ class Application(web.Application):
                 loop=self.loop, **docker_args)
         return self._docker
 
+    @property
+    def image_puller(self):
+        """
+        The coordinator of the pulls of the Docker images
+        """
+        if not hasattr(self, '_image_puller'):
+            self._image_puller = ImagePuller(
+                self.docker, concurrency=self.image_pull_concurrency,
+                loop=self.loop)
+        return self._image_puller
+
+    @property
+    def compose(self):
+        """
+        The in-process Docker Compose execution engine
+        """
+        if not hasattr(self, '_compose'):
+            self._compose = ComposeEngine(self.compose_configs,
+                                          loop=self.loop)
+        return self._compose
+
+    @property
+    def compose_configs(self):
+        """
+        The cache of the Docker Compose configurations of the projects
+        """
+        if not hasattr(self, '_compose_configs'):
+            self._compose_configs = ComposeConfigCache(
+                self.compose_config_cache_size)
+        return self._compose_configs
+
+    @property
+    def git_mirrors(self):
+        """
+        The local mirrors of the git repositories of the stacks
+        """
+        if not hasattr(self, '_git_mirrors'):
+            self._git_mirrors = GitMirrors(
+                self.run_command, self.git_mirrors_path,
+                self.git_mirror_refresh_interval, loop=self.loop)
+        return self._git_mirrors
+
+    @property
+    def container_events(self):
+        """
+        The coalescer of the Docker container events
+        """
+        if not hasattr(self, '_container_events'):
+            self._container_events = eventmonitor.ContainerEventCoalescer(
+                self.container_events_window, self.enqueue_service_changed,
+                loop=self.loop)
+        return self._container_events
+
     @property
     async def container(self):
         """
@@ -155,27 +347,35 @@ class Application(web.Application):
         """
         Get the mu:uuid of a subject IRI
         """
-        result = await self.sparql.query("""
-            SELECT ?o
-            FROM {{graph}}
-            WHERE
-            {
-                {{}} mu:uuid ?o .
-            }
-            """, subject)
+        cached = self.identity_cache.get_resource_id(subject)
+        if cached is not None:
+            return cached
+        with metrics.SPARQL_QUERY_DURATION.time(query="get_resource_id"):
+            result = await self.sparql.query("""
+                SELECT ?o
+                FROM {{graph}}
+                WHERE
+                {
+                    {{}} mu:uuid ?o .
+                }
+                """, subject)
         if not result['results']['bindings'] or \
                 not result['results']['bindings'][0]:
             raise KeyError("subject %r not found" % subject)
-        return result['results']['bindings'][0]['o']['value']
+        resource_id = result['results']['bindings'][0]['o']['value']
+        self.identity_cache.set_resource_id(subject, resource_id)
+        return resource_id
 
     async def ensure_resource_id_exists(self, resource_id):
         """
         Return True if the resource ID given in parameter exists in the
         database. Otherwise return False.
         """
-        result = await self.sparql.query("""
-            ASK FROM {{graph}} WHERE { ?s mu:uuid {{}} }
-            """, escape_string(resource_id))
+        with metrics.SPARQL_QUERY_DURATION.time(
+                query="ensure_resource_id_exists"):
+            result = await self.sparql.query("""
+                ASK FROM {{graph}} WHERE { ?s mu:uuid {{}} }
+                """, escape_string(resource_id))
         return False if result is None else result['boolean']
 
     def open_compose_data(self, project_id):
@@ -183,29 +383,34 @@ class Application(web.Application):
         Use Docker Compose to load the data of a project given in parameter.
         Return a Docker Compose data object.
         """
-        project_dir = '/data/%s' % project_id
-        config_files = config.config.get_default_config_files(project_dir)
-        environment = Environment.from_env_file(project_dir)
-        config_details = config.find(project_dir, config_files, environment)
-        return config.load(config_details)
+        return self.compose_configs.get('/data/%s' % project_id)
+
+    async def load_compose_data(self, project_id):
+        """
+        Same as open_compose_data but the data is loaded in an executor to
+        avoid blocking the event loop
+        """
+        return await self.loop.run_in_executor(
+            None, self.open_compose_data, project_id)
 
     async def update_state(self, uuid, state):
         """
         Helper that update the swarmui:status of a node given in parameter
         """
-        await self.sparql.update("""
-            WITH {{graph}}
-            DELETE {
-                ?s swarmui:status ?oldstate .
-            }
-            INSERT {
-                ?s swarmui:status {{new_state}} .
-            }
-            WHERE {
-                ?s mu:uuid {{uuid}} .
-                OPTIONAL { ?s swarmui:status ?oldstate } .
-            }
-            """, uuid=escape_string(uuid), new_state=state)
+        with metrics.SPARQL_QUERY_DURATION.time(query="update_state"):
+            await self.sparql.update("""
+                WITH {{graph}}
+                DELETE {
+                    ?s swarmui:status ?oldstate .
+                }
+                INSERT {
+                    ?s swarmui:status {{new_state}} .
+                }
+                WHERE {
+                    ?s mu:uuid {{uuid}} .
+                    OPTIONAL { ?s swarmui:status ?oldstate } .
+                }
+                """, uuid=escape_string(uuid), new_state=state)
 
     async def update_pipeline_services(self, subject):
         """
@@ -213,7 +418,7 @@ class Application(web.Application):
         project (pipeline) inside the database
         """
         project_id = await self.get_resource_id(subject)
-        data = self.open_compose_data(project_id)
+        data = await self.load_compose_data(project_id)
         triples = Triples()
         for service in data.services:
             service_id = uuid4()
@@ -226,104 +431,113 @@ class Application(web.Application):
                 RDF.type: SwarmUI.Service,
                 SwarmUI.status: SwarmUI.Stopped,
             }))
-        await self.sparql.update("""
-            WITH {{graph}}
-            DELETE {
-                {{pipeline}} swarmui:services ?service .
-
-                ?service ?p ?o .
-            }
-            WHERE {
-                {{pipeline}} swarmui:services ?service .
-
-                ?service ?p ?o .
-            }
-            """, pipeline=subject)
-        await self.sparql.update("""
-            PREFIX : {{services_iri}}
+        with metrics.SPARQL_QUERY_DURATION.time(
+                query="delete_pipeline_services"):
+            await self.sparql.update("""
+                WITH {{graph}}
+                DELETE {
+                    {{pipeline}} swarmui:services ?service .
+
+                    ?service ?p ?o .
+                }
+                WHERE {
+                    {{pipeline}} swarmui:services ?service .
 
-            INSERT DATA {
-                GRAPH {{graph}} {
-                    {{triples}}
+                    ?service ?p ?o .
                 }
-            }""", services_iri=(self.base_resource + "services/"),
-            triples=triples)
+                """, pipeline=subject)
+        with metrics.SPARQL_QUERY_DURATION.time(
+                query="insert_pipeline_services"):
+            await self.sparql.update("""
+                PREFIX : {{services_iri}}
+
+                INSERT DATA {
+                    GRAPH {{graph}} {
+                        {{triples}}
+                    }
+                }""", services_iri=(self.base_resource + "services/"),
+                triples=triples)
+
+    async def sparql_updates(self, queries, **kwargs):
+        """
+        Send multiple SPARQL update operations that share the same arguments.
+        The operations are sent in a single request when
+        sparql_combined_updates is enabled, otherwise they are sent one by one
+        """
+        if self.sparql_combined_updates:
+            await self.sparql.update(
+                " ;\n".join(dedent(x).strip() for x in queries), **kwargs)
+        else:
+            for query in queries:
+                await self.sparql.update(query, **kwargs)
 
     async def remove_triple(self, uuid, predicate):
         """
         Helper that removes a triple of a node identified by its mu:uuid
         """
-        await self.sparql.update("""
-            WITH {{graph}}
-            DELETE {
-                ?s {{predicate}} ?oldvalue .
-            }
-            WHERE {
-                ?s mu:uuid {{uuid}} ;
-                  {{predicate}} ?oldvalue .
-            }
-            """, uuid=escape_string(uuid), predicate=predicate)
+        with metrics.SPARQL_QUERY_DURATION.time(query="remove_triple"):
+            await self.sparql.update("""
+                WITH {{graph}}
+                DELETE {
+                    ?s {{predicate}} ?oldvalue .
+                }
+                WHERE {
+                    ?s mu:uuid {{uuid}} ;
+                      {{predicate}} ?oldvalue .
+                }
+                """, uuid=escape_string(uuid), predicate=predicate)
 
     async def get_dct_title(self, uuid):
         """
         Get the dct:title of a node
         """
-        result = await self.sparql.query("""
-            SELECT ?title
-            FROM {{graph}}
-            WHERE
-            {
-                ?s mu:uuid {{uuid}} ;
-                  dct:title ?title .
-            }
-            """, uuid=escape_string(uuid))
+        cached = self.identity_cache.get_title(uuid)
+        if cached is not None:
+            return cached
+        with metrics.SPARQL_QUERY_DURATION.time(query="get_dct_title"):
+            result = await self.sparql.query("""
+                SELECT ?title
+                FROM {{graph}}
+                WHERE
+                {
+                    ?s mu:uuid {{uuid}} ;
+                      dct:title ?title .
+                }
+                """, uuid=escape_string(uuid))
         if not result['results']['bindings'] or \
                 not result['results']['bindings'][0]:
             raise KeyError("resource %r not found" % uuid)
-        return result['results']['bindings'][0]['title']['value']
-
-    async def is_last_pipeline(self, pipeline_id):
-        """
-        Check if the pipeline is the last one for this repository
-        """
-        result = await self.sparql.query("""
-            ASK
-            FROM {{graph}}
-            WHERE
-            {
-                ?pipeline a swarmui:Pipeline ;
-                  mu:uuid {{uuid}} .
-
-                ?repository a doap:Stack ;
-                  swarmui:pipelines ?pipeline ;
-                  swarmui:pipelines ?otherpipeline .
-
-                FILTER(?otherpipeline != ?pipeline)
-            }
-            """, uuid=escape_string(pipeline_id))
-        return not result['boolean']
+        title = result['results']['bindings'][0]['title']['value']
+        self.identity_cache.set_title(uuid, title)
+        return title
 
     async def get_service_pipeline(self, service_id):
         """
         Get the pipeline ID of a service given in parameter
         """
-        result = await self.sparql.query("""
-            SELECT ?uuid
-            FROM {{graph}}
-            WHERE
-            {
-                ?service a swarmui:Service ;
-                  mu:uuid {{uuid}} .
-
-                ?pipeline a swarmui:Pipeline ;
-                  swarmui:services ?service ;
-                  mu:uuid ?uuid .
-            }
-            """, uuid=escape_string(service_id))
+        cached = self.identity_cache.get_service_pipeline(service_id)
+        if cached is not None:
+            return cached
+        with metrics.SPARQL_QUERY_DURATION.time(query="get_service_pipeline"):
+            result = await self.sparql.query("""
+                SELECT ?uuid
+                FROM {{graph}}
+                WHERE
+                {
+                    ?service a swarmui:Service ;
+                      mu:uuid {{uuid}} .
+
+                    ?pipeline a swarmui:Pipeline ;
+                      swarmui:services ?service ;
+                      mu:uuid ?uuid .
+                }
+                """, uuid=escape_string(service_id))
         if not result['results']['bindings'] or \
                 not result['results']['bindings'][0]:
             raise KeyError("service %r not found" % service_id)
-        return result['results']['bindings'][0]['uuid']['value']
+        pipeline_id = result['results']['bindings'][0]['uuid']['value']
+        self.identity_cache.set_service_pipeline(service_id, pipeline_id)
+        return pipeline_id
 
     async def run_command(self, *args, logging=True, timeout=None, **kwargs):
         """
@@ -332,32 +546,76 @@ class Application(web.Application):
         """
         if timeout is None:
             timeout = self.run_command_timeout
-        proc = await asyncio.create_subprocess_exec(
-            *args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            loop=self.loop, **kwargs)
-        try:
-            if logging:
-                await asyncio.wait_for(self._log_process_output(proc), timeout)
-            else:
-                await asyncio.wait_for(proc.wait(), timeout)
-        except asyncio.TimeoutError:
-            logger.warn(
-                "Child process %d awaited for too long, terminating...",
-                proc.pid)
+        with metrics.COMMAND_DURATION.time(
+                command=args[0], subcommand=metrics.get_subcommand(args[1:])):
+            proc = await asyncio.create_subprocess_exec(
+                *args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                loop=self.loop, **kwargs)
             try:
-                proc.terminate()
-            except Exception:
-                pass
-        await proc.wait()
+                if logging:
+                    await asyncio.wait_for(self._log_process_output(proc),
+                                           timeout)
+                else:
+                    await asyncio.wait_for(proc.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.warn(
+                    "Child process %d awaited for too long, terminating...",
+                    proc.pid)
+                try:
+                    proc.terminate()
+                except Exception:
+                    pass
+            await proc.wait()
         return proc
 
-    async def run_compose(self, *args, **kwargs):
+    async def run_compose(self, *args, cwd=None, timeout=None, **kwargs):
         """
-        Run a subprocess with Docker Compose, log the output, wait for its
-        execution to complete, timeout eventually. Return a process object.
+        Run a Docker Compose command, wait for its execution to complete,
+        timeout eventually. The command is executed in-process if
+        compose_engine is "inprocess" and the command is supported (it can not
+        be interrupted: it is awaited until it completes even after the
+        timeout), otherwise it is executed in a subprocess. The output is
+        logged. Return an object with the returncode of the command.
         """
-        return await self.run_command("docker-compose", "--no-ansi", *args,
-                                      **kwargs)
+        with metrics.COMPOSE_DURATION.time(
+                subcommand=metrics.get_subcommand(args)):
+            if self.compose_engine == "inprocess" and cwd is not None:
+                result = await self.compose.run(
+                    cwd, *args,
+                    timeout=(self.run_command_timeout if timeout is None
+                             else timeout))
+                if result is not None:
+                    return result
+            return await self.run_command(
+                "docker-compose", "--no-ansi", *args, cwd=cwd,
+                timeout=timeout, **kwargs)
+
+    def collect_metrics(self):
+        """
+        Update the metrics that reflect the current state of the application
+        """
+        metrics.ACTION_QUEUE_DEPTH.clear()
+        for scheduler in (ActionScheduler, OneActionScheduler):
+            metrics.ACTION_SCHEDULERS.set(len(scheduler.executers),
+                                          scheduler=scheduler.__name__)
+            for key, executer in scheduler.executers.items():
+                metrics.ACTION_QUEUE_DEPTH.set(
+                    executer.depth, scheduler=scheduler.__name__,
+                    key=key)
+        metrics.ACTIONS_RUNNING.set(self.action_limit.running)
+        metrics.IMAGE_PULL_DOWNLOADED_BYTES.clear()
+        metrics.IMAGE_PULL_TOTAL_BYTES.clear()
+        if hasattr(self, '_image_puller'):
+            for image, (downloaded, total) in \
+                    self.image_puller.progress.items():
+                metrics.IMAGE_PULL_DOWNLOADED_BYTES.set(downloaded,
+                                                        image=image)
+                metrics.IMAGE_PULL_TOTAL_BYTES.set(total, image=image)
+        metrics.DELTA_QUEUE_DEPTH.set(self.delta_queue.qsize())
+        if 'event_dispatcher' in self:
+            metrics.DOCKER_EVENT_LAG.set(self['event_dispatcher'].lag)
+            metrics.DOCKER_EVENT_QUEUE_DEPTH.set(
+                self['event_dispatcher'].depth)
 
     async def _log_streamreader(self, reader):
         """
@@ -378,13 +636,18 @@ class Application(web.Application):
         await asyncio.gather(self._log_streamreader(proc.stdout),
                              self._log_streamreader(proc.stderr))
 
-    async def enqueue_action(self, key, action, args):
+    async def enqueue_action(self, key, action, args, priority=USER,
+                             supersede=None):
         """
         Enqueue an action in the queue of an ActionScheduler. The
         ActionScheduler is determined by the key. The action will be executed
-        serially after all previous actions have finished.
+        serially after all previous actions of the same or of a higher
+        priority class have finished. The action replaces the action still
+        pending in the queue with the same supersede key (if given).
         """
-        await ActionScheduler.execute(key, action, args, loop=self.loop)
+        await ActionScheduler.execute(key, action, args, priority=priority,
+                                      supersede=supersede,
+                                      **self.scheduler_options)
 
     async def wait_action(self, key):
         """
@@ -400,7 +663,8 @@ class Application(web.Application):
         executed serially after any running action has completed. If an action
         already exists in the queue, the new action will be discarded.
         """
-        await OneActionScheduler.execute(key, action, args, loop=self.loop)
+        await OneActionScheduler.execute(key, action, args,
+                                         **self.scheduler_options)
 
     async def event_container(self, event):
         """
@@ -417,14 +681,31 @@ class Application(web.Application):
 
         project_id = project_name.upper()
 
-        if event["Action"] == "start":
+        if self.container_events_window > 0:
+            if event["Action"] in ("start", "die"):
+                self.container_events.add(project_id, service_name,
+                                          event["Action"], container_id,
+                                          container_number)
+        elif event["Action"] == "start":
             await self.enqueue_action(
                 project_id, self.event_container_started,
-                [container_id, project_id, service_name, container_number])
+                [container_id, project_id, service_name, container_number],
+                priority=RECONCILIATION)
         elif event["Action"] == "die":
             await self.enqueue_action(
                 project_id, self.event_container_died,
-                [project_id, service_name, container_number])
+                [project_id, service_name, container_number],
+                priority=RECONCILIATION)
+
+    async def enqueue_service_changed(self, project_id, service_name,
+                                      change):
+        """
+        Enqueue the net change of the containers of a service in the queue of
+        the ActionScheduler of its project
+        """
+        await self.enqueue_action(
+            project_id, self.event_service_changed,
+            [project_id, service_name, change], priority=RECONCILIATION)
 
     async def event_container_started(self, container_id, project_id,
                                       service_name, container_number):
@@ -433,9 +714,48 @@ class Application(web.Application):
         """
         if not await self.ensure_resource_id_exists(project_id):
             return
-        # NOTE: I don't think Delta service works with multiple updates queries
-        #       in a single HTTP request.
-        await self.sparql.update(
+        await self.update_container_started(project_id, service_name,
+                                            container_number)
+        if await self.join_public_network(container_id):
+            await self.enqueue_one_action("proxy", self.restart_proxy, [])
+
+    async def event_container_died(self, project_id, service_name,
+                                   container_number):
+        """
+        Watch for container "dying" event
+        """
+        if not await self.ensure_resource_id_exists(project_id):
+            return
+        await self.update_container_died(project_id, service_name,
+                                         container_number)
+
+    async def event_service_changed(self, project_id, service_name, change):
+        """
+        Apply the net change of the containers of a service accumulated by
+        the container events coalescer
+        """
+        if not await self.ensure_resource_id_exists(project_id):
+            return
+        for action, container_number in change.operations():
+            if action == "start":
+                await self.update_container_started(
+                    project_id, service_name, container_number)
+            else:
+                await self.update_container_died(
+                    project_id, service_name, container_number)
+        joined = False
+        for container_id in change.started:
+            joined = await self.join_public_network(container_id) or joined
+        if joined:
+            await self.enqueue_one_action("proxy", self.restart_proxy, [])
+
+    async def update_container_started(self, project_id, service_name,
+                                       container_number):
+        """
+        Update the scaling and the status of a service and its pipeline after
+        a container has started
+        """
+        queries = [
             """
             WITH {{graph}}
             DELETE {
@@ -456,10 +776,7 @@ class Application(web.Application):
                 BIND(IF(?oldscaling > {{scaling}},
                   ?oldscaling, {{scaling}}) AS ?newscaling) .
             }
-            """, project_id=escape_string(project_id),
-            service_name=escape_string(service_name),
-            scaling=container_number)
-        await self.sparql.update(
+            """,
             """
             WITH {{graph}}
             DELETE {
@@ -479,9 +796,7 @@ class Application(web.Application):
 
                 FILTER ( ?oldstatus NOT IN (swarmui:Up, swarmui:Started) )
             }
-            """, project_id=escape_string(project_id),
-            service_name=escape_string(service_name))
-        await self.sparql.update(
+            """,
             """
             WITH {{graph}}
             DELETE {
@@ -501,24 +816,25 @@ class Application(web.Application):
 
                 FILTER ( ?oldstatus NOT IN (swarmui:Up, swarmui:Started) )
             }
-            """, project_id=escape_string(project_id),
-            service_name=escape_string(service_name))
-        if await self.join_public_network(container_id):
-            await self.enqueue_one_action("proxy", self.restart_proxy, [])
-
-    async def event_container_died(self, project_id, service_name,
-                                   container_number):
+            """,
+        ]
+        with metrics.SPARQL_QUERY_DURATION.time(
+                query="update_container_started"):
+            await self.sparql_updates(
+                queries, project_id=escape_string(project_id),
+                service_name=escape_string(service_name),
+                scaling=container_number)
+
+    async def update_container_died(self, project_id, service_name,
+                                    container_number):
         """
-        Watch for container "dying" event
+        Update the scaling and the status of a service and its pipeline after
+        a container has died
         """
-        if not await self.ensure_resource_id_exists(project_id):
-            return
         service_status = (
             SwarmUI.Started if container_number > 1 else SwarmUI.Stopped
         )
-        # NOTE: I don't think Delta service works with multiple updates queries
-        #       in a single HTTP request.
-        await self.sparql.update(
+        queries = [
             """
             WITH {{graph}}
             DELETE {
@@ -540,10 +856,6 @@ class Application(web.Application):
                   ?oldscaling, {{scaling}}) AS ?newscaling) .
             }
             """,
-            project_id=escape_string(project_id),
-            service_name=escape_string(service_name),
-            scaling=(container_number - 1))
-        await self.sparql.update(
             """
             WITH {{graph}}
             DELETE {
@@ -564,10 +876,6 @@ class Application(web.Application):
                 FILTER ( ?oldstatus NOT IN (swarmui:Killed, swarmui:Stopped) )
             }
             """,
-            project_id=escape_string(project_id),
-            service_name=escape_string(service_name),
-            service_status=service_status)
-        await self.sparql.update(
             """
             WITH {{graph}}
             DELETE {
@@ -598,8 +906,14 @@ class Application(web.Application):
                   AS ?newstatus) .
             }
             """,
-            project_id=escape_string(project_id),
-            service_name=escape_string(service_name))
+        ]
+        with metrics.SPARQL_QUERY_DURATION.time(
+                query="update_container_died"):
+            await self.sparql_updates(
+                queries, project_id=escape_string(project_id),
+                service_name=escape_string(service_name),
+                scaling=(container_number - 1),
+                service_status=service_status)
 
 
 async def stop_cleanup(app):
@@ -610,27 +924,65 @@ async def stop_cleanup(app):
     await app.docker.close()
 
 
+async def setup_compose_engine(app):
+    """
+    Route the output of the Docker Compose commands executed in-process to
+    the logger
+    """
+    if app.compose_engine == "inprocess":
+        composeengine.setup_output()
+
+
+async def resume_actions(app):
+    """
+    Queue again the actions left pending in the journal by the previous run
+    """
+    if app.action_journal is None:
+        return
+    schedulers = {x.__name__: x for x in (ActionScheduler, OneActionScheduler)}
+    records = app.action_journal.load()
+    logger.info("Resuming %d actions from the journal", len(records))
+    for record in records:
+        await schedulers[record['scheduler']].execute(
+            record['key'], record['action'], record['args'],
+            priority=record['priority'], supersede=record['supersede'],
+            entry=record['id'], **app.scheduler_options)
+
+
 async def stop_action_schedulers(app):
     """
     Stop all action schedulers. This will wait for all actions to be completed
     before ending. All the actions in all ActionSchedulers queue will be
-    executed and awaited before leaving.
+    executed and awaited before leaving. If the journal is enabled, only the
+    actions running are awaited, the others are resumed at the next startup.
     """
-    await ActionScheduler.graceful_cancel()
-    await OneActionScheduler.graceful_cancel()
+    if app.action_journal is None:
+        await ActionScheduler.graceful_cancel()
+        await OneActionScheduler.graceful_cancel()
+    else:
+        await ActionScheduler.checkpoint()
+        await OneActionScheduler.checkpoint()
+        app.action_journal.close()
 
 
 async def start_event_monitor(app):
     """
     Start the Docker event monitor
     """
+    app['event_dispatcher'] = eventmonitor.EventDispatcher(
+        {"container": [app.event_container]},
+        concurrency=app.event_handlers_concurrency,
+        maxsize=app.event_queue_size, loop=app.loop)
     app['event_monitor'] = app.loop.create_task(
-        eventmonitor.watch(app.docker, {"container": [app.event_container]}))
+        eventmonitor.watch(app.docker, app['event_dispatcher'],
+                           retries=app.event_monitor_retries,
+                           retry_delay=app.event_monitor_retry_delay,
+                           loop=app.loop))
 
 
 async def stop_event_monitor(app):
     """
-    Cancel event monitor
+    Cancel event monitor and flush the container events being coalesced
     """
     if 'event_monitor' in app:
         app['event_monitor'].cancel()
@@ -638,6 +990,28 @@ async def stop_event_monitor(app):
             await app['event_monitor']
         except SystemExit:
             pass
+    if app.container_events_window > 0:
+        await app.container_events.flush()
+
+
+async def start_delta_worker(app):
+    """
+    Start the background task that processes the deltas
+    """
+    app['delta_worker'] = app.loop.create_task(delta.worker(app))
+
+
+async def stop_delta_worker(app):
+    """
+    Wait for the deltas queued to be processed then cancel the background task
+    """
+    if 'delta_worker' in app:
+        await app.delta_queue.join()
+        app['delta_worker'].cancel()
+        try:
+            await app['delta_worker']
+        except asyncio.CancelledError:
+            pass
 
 
 def startup_wrapper(coro):
@@ -654,11 +1028,16 @@ def startup_wrapper(coro):
 
 
 app = Application()
+app.on_startup.append(setup_compose_engine)
 app.on_startup.append(startup_wrapper(eventmonitor.startup))
+app.on_startup.append(resume_actions)
 app.on_startup.append(startup_wrapper(delta.startup))
+app.on_startup.append(start_delta_worker)
 app.on_startup.append(start_event_monitor)
 app.on_cleanup.append(stop_event_monitor)
+app.on_cleanup.append(stop_delta_worker)
 app.on_cleanup.append(stop_action_schedulers)
 app.on_cleanup.append(stop_cleanup)
 app.router.add_post("/update", delta.update)
+app.router.add_get("/metrics", metrics.handler)
 app.router.add_get("/services/{id}/logs", services.logs)
@@ -0,0 +1,252 @@
+from aiohttp import web
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import monotonic
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')
+                     .replace("\n", "\\n"))
+        for k, v in labels)
+
+
+class Metric:
+    """
+    A metric family: a name, a help text and a value for every combination of
+    its labels
+    """
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = OrderedDict()
+
+    def get_key(self, labels):
+        assert set(labels) == set(self.labelnames), \
+            "wrong labels for %s: %r" % (self.name, labels)
+        return tuple((x, labels[x]) for x in self.labelnames)
+
+    def remove(self, **labels):
+        self.values.pop(self.get_key(labels), None)
+
+    def clear(self):
+        self.values.clear()
+
+    def samples(self):
+        """
+        Return the samples of the metric: tuples (suffix, labels, value)
+        """
+        for key, value in self.values.items():
+            yield ("", key, value)
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.help),
+            "# TYPE %s %s" % (self.name, self.type),
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append("%s%s%s %s" % (self.name, suffix,
+                                        format_labels(labels),
+                                        format_value(value)))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        self.values[self.get_key(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self.get_key(labels)
+        if key not in self.values:
+            self.values[key] = {
+                "buckets": [0] * len(self.buckets),
+                "sum": 0.0,
+                "count": 0,
+            }
+        data = self.values[key]
+        data["buckets"][bisect_left(self.buckets, value)] += 1
+        data["sum"] += value
+        data["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe the duration of the block of code
+        """
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(monotonic() - start, **labels)
+
+    def samples(self):
+        for key, data in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, data["buckets"]):
+                cumulative += count
+                yield ("_bucket", key + (("le", format_value(bound)),),
+                       cumulative)
+            yield ("_sum", key, data["sum"])
+            yield ("_count", key, data["count"])
+
+
+class Registry:
+    """
+    A collection of metrics rendered in the Prometheus text format
+    """
+    def __init__(self):
+        self.metrics = OrderedDict()
+
+    def register(self, metric):
+        assert metric.name not in self.metrics, \
+            "metric %s already registered" % metric.name
+        self.metrics[metric.name] = metric
+        return metric
+
+    def clear(self):
+        for metric in self.metrics.values():
+            metric.clear()
+
+    def render(self):
+        return "".join(x.render() + "\n" for x in self.metrics.values())
+
+
+REGISTRY = Registry()
+
+SPARQL_QUERY_DURATION = REGISTRY.register(Histogram(
+    "muswarmadmin_sparql_query_duration_seconds",
+    "Duration of the SPARQL queries and updates",
+    ["query"]))
+COMMAND_DURATION = REGISTRY.register(Histogram(
+    "muswarmadmin_command_duration_seconds",
+    "Duration of the commands executed in a subprocess",
+    ["command", "subcommand"]))
+COMPOSE_DURATION = REGISTRY.register(Histogram(
+    "muswarmadmin_compose_duration_seconds",
+    "Duration of the Docker Compose commands",
+    ["subcommand"]))
+ACTION_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "muswarmadmin_action_queue_depth",
+    "Number of actions waiting in the queue of an action scheduler",
+    ["scheduler", "key"]))
+ACTION_WAIT_DURATION = REGISTRY.register(Histogram(
+    "muswarmadmin_action_wait_seconds",
+    "Time spent by the actions in the queue of an action scheduler",
+    ["scheduler"]))
+ACTION_CLASS_WAIT_DURATION = REGISTRY.register(Histogram(
+    "muswarmadmin_action_class_wait_seconds",
+    "Time spent by the actions of a priority class before their execution",
+    ["priority"]))
+ACTION_CLASS_DURATION = REGISTRY.register(Histogram(
+    "muswarmadmin_action_class_duration_seconds",
+    "Duration of the execution of the actions of a priority class",
+    ["priority"]))
+ACTIONS_SUPERSEDED = REGISTRY.register(Counter(
+    "muswarmadmin_actions_superseded_total",
+    "Number of pending actions replaced by a newer action"))
+ACTION_SCHEDULERS = REGISTRY.register(Gauge(
+    "muswarmadmin_action_schedulers",
+    "Number of action schedulers alive",
+    ["scheduler"]))
+ACTIONS_RUNNING = REGISTRY.register(Gauge(
+    "muswarmadmin_actions_running",
+    "Number of actions being executed by the action schedulers"))
+IMAGE_PULL_DURATION = REGISTRY.register(Histogram(
+    "muswarmadmin_image_pull_duration_seconds",
+    "Duration of the pulls of the Docker images"))
+IMAGE_PULLS_SHARED = REGISTRY.register(Counter(
+    "muswarmadmin_image_pulls_shared_total",
+    "Number of image pulls requested while the same image was being pulled"))
+IMAGE_PULL_DOWNLOADED_BYTES = REGISTRY.register(Gauge(
+    "muswarmadmin_image_pull_downloaded_bytes",
+    "Bytes downloaded of the layers of an image being pulled",
+    ["image"]))
+IMAGE_PULL_TOTAL_BYTES = REGISTRY.register(Gauge(
+    "muswarmadmin_image_pull_total_bytes",
+    "Total bytes of the layers of an image being pulled",
+    ["image"]))
+IMAGES_REMOVED = REGISTRY.register(Counter(
+    "muswarmadmin_images_removed_total",
+    "Number of Docker images removed or untagged"))
+IMAGE_BYTES_RECLAIMED = REGISTRY.register(Counter(
+    "muswarmadmin_image_reclaimed_bytes_total",
+    "Size of the Docker images deleted"))
+DOCKER_EVENT_LAG = REGISTRY.register(Gauge(
+    "muswarmadmin_docker_event_lag_seconds",
+    "Delay between the emission and the handling of the last Docker event"))
+DOCKER_EVENT_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "muswarmadmin_docker_event_queue_depth",
+    "Number of Docker events waiting to be handled"))
+DELTA_PAYLOADS = REGISTRY.register(Counter(
+    "muswarmadmin_delta_payloads_total",
+    "Number of payloads received from the Delta service"))
+DELTA_REJECTED = REGISTRY.register(Counter(
+    "muswarmadmin_delta_rejected_total",
+    "Number of payloads rejected because the delta queue was full"))
+DELTA_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "muswarmadmin_delta_queue_depth",
+    "Number of deltas waiting to be processed"))
+DELTA_TRIPLES = REGISTRY.register(Counter(
+    "muswarmadmin_delta_triples_total",
+    "Number of triples of the application graph received from the Delta "
+    "service",
+    ["operation"]))
+IDENTITY_CACHE_HITS = REGISTRY.register(Counter(
+    "muswarmadmin_identity_cache_hits_total",
+    "Number of hits of the identity cache",
+    ["cache"]))
+IDENTITY_CACHE_MISSES = REGISTRY.register(Counter(
+    "muswarmadmin_identity_cache_misses_total",
+    "Number of misses of the identity cache",
+    ["cache"]))
+
+
+def get_subcommand(args):
+    """
+    The first argument of a command line that is not an option
+    """
+    return next((x for x in args if not x.startswith("-")), "")
+
+
+async def handler(request):
+    """
+    API endpoint that exposes the metrics in the Prometheus text format
+    """
+    request.app.collect_metrics()
+    return web.Response(
+        body=REGISTRY.render().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
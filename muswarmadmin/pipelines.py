@@ -1,9 +1,11 @@
-import aiodockerpy
+import asyncio
 import logging
 import os
 from aiosparql.syntax import escape_string, IRI, Literal
 from shutil import rmtree
 
+import muswarmadmin.repositories
+from muswarmadmin.imagecleaner import get_image_references, remove_images
 from muswarmadmin.prefixes import SwarmUI
 from muswarmadmin.actionscheduler import StopScheduler
 
@@ -11,14 +13,34 @@ from muswarmadmin.actionscheduler import StopScheduler
 logger = logging.getLogger(__name__)
 
 
+def get_project_ids():
+    """
+    The identifiers of the projects of all the pipelines
+    """
+    return [x for x in os.listdir("/data")
+            if not x.startswith(".") and os.path.isdir("/data/%s" % x)]
+
+
 async def remove_docker_images(app, project_id):
-    data = app.open_compose_data(project_id)
-    for image in set([x['image'] for x in data.services]):
-        try:
-            await app.docker.remove_image(image)
-        except aiodockerpy.errors.APIError as exc:
-            if exc.is_server_error():
-                logger.error(str(exc))
+    """
+    Remove the images of a pipeline that are not used by the other pipelines
+    nor by a container running
+    """
+    data = await app.load_compose_data(project_id)
+    try:
+        references = await get_image_references(
+            app, [x for x in get_project_ids() if x != project_id])
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        logger.exception("Can not list the images used, the images of "
+                         "pipeline %s are kept", project_id)
+        return
+    reclaimed = await remove_images(
+        app.docker, [x['image'] for x in data.services if 'image' in x],
+        references, concurrency=app.image_removal_concurrency, loop=app.loop)
+    logger.info("Removed the images of pipeline %s, %d bytes reclaimed",
+                project_id, reclaimed)
 
 
 async def shutdown_and_cleanup_pipeline(app, project_id):
@@ -32,9 +54,9 @@ async def shutdown_and_cleanup_pipeline(app, project_id):
         raise StopScheduler()
     await app.update_state(project_id, SwarmUI.Removing)
     await app.run_compose("down", cwd="/data/%s" % project_id)
-    if await app.is_last_pipeline(project_id):
-        await remove_docker_images(app, project_id)
+    await remove_docker_images(app, project_id)
     rmtree(project_path)
+    app.compose_configs.invalidate(project_path)
     await app.sparql.update("""
         # NOTE: DELETE WHERE is not handled by the Delta service
         #DELETE WHERE {
@@ -121,7 +143,19 @@ async def update_action(app, project_id, pipeline):
     """
     logger.info("Updating pipeline %s", project_id)
     await app.update_state(project_id, SwarmUI.Updating)
-    proc = await app.run_command("git", "fetch", cwd="/data/%s" % project_id)
+    location = await muswarmadmin.repositories.get_repository_location(
+        app, pipeline)
+    # NOTE: the mirror is refreshed even if it has been fetched recently, the
+    #       user expects the latest commits of the repository
+    mirror = None if location is None else \
+        await app.git_mirrors.update(location, force=True)
+    if mirror is None:
+        proc = await app.run_command("git", "fetch",
+                                     cwd="/data/%s" % project_id)
+    else:
+        proc = await app.run_command(
+            "git", "fetch", mirror, "+refs/heads/*:refs/remotes/origin/*",
+            cwd="/data/%s" % project_id)
     if proc.returncode != 0:
         await app.update_state(project_id, SwarmUI.Error)
         return
@@ -130,8 +164,11 @@ async def update_action(app, project_id, pipeline):
     if proc.returncode != 0:
         await app.update_state(project_id, SwarmUI.Error)
         return
-    proc = await app.run_compose("pull", cwd="/data/%s" % project_id)
-    if proc.returncode is not 0:
+    # NOTE: the images shared with the pipelines being updated are pulled
+    #       only once
+    data = await app.load_compose_data(project_id)
+    if await app.image_puller.pull_all(
+            sorted(set(x['image'] for x in data.services if 'image' in x))):
         await app.update_state(project_id, SwarmUI.Error)
         return
     await app.update_pipeline_services(pipeline)
@@ -143,6 +180,88 @@ async def update_action(app, project_id, pipeline):
     # to be chaned by container events.
 
 
+async def requested_status(app, triple):
+    """
+    Handler of swarmui:requestedStatus: change the status of the pipeline
+    """
+    assert isinstance(triple.o, IRI), "wrong type: %r" % type(triple.o)
+    project_id = await app.get_resource_id(triple.s)
+    await app.enqueue_action(
+        project_id, app.remove_triple,
+        [project_id, SwarmUI.requestedStatus],
+        supersede="remove %s %s" % (project_id, SwarmUI.requestedStatus))
+    # NOTE: only the last status requested is applied
+    if triple.o == SwarmUI.Up:
+        await app.enqueue_action(project_id, up_action,
+                                 [app, project_id], supersede="status")
+    elif triple.o in _state_to_action:
+        args, pending_state = _state_to_action[triple.o]
+        await app.enqueue_action(
+            project_id, do_action,
+            [app, project_id, args, pending_state, triple.o],
+            supersede="status")
+    else:
+        logger.error("Requested status not implemented: %s",
+                     triple.o.value)
+
+
+async def restart_requested(app, triple):
+    """
+    Handler of swarmui:restartRequested: restart the pipeline
+    """
+    assert isinstance(triple.o, Literal), "wrong type: %r" % type(triple.o)
+    if not triple.o == "true":
+        return
+    project_id = await app.get_resource_id(triple.s)
+    await app.enqueue_action(
+        project_id, app.remove_triple,
+        [project_id, SwarmUI.restartRequested],
+        supersede="remove %s %s" % (project_id, SwarmUI.restartRequested))
+    await app.enqueue_action(project_id, restart_action,
+                             [app, project_id], supersede="restart")
+
+
+async def delete_requested(app, triple):
+    """
+    Handler of swarmui:deleteRequested: shutdown and remove the pipeline
+    """
+    assert isinstance(triple.o, Literal), "wrong type: %r" % type(triple.o)
+    if not triple.o == "true":
+        return
+    project_id = await app.get_resource_id(triple.s)
+    await app.enqueue_action(
+        project_id, app.remove_triple,
+        [project_id, SwarmUI.deleteRequested],
+        supersede="remove %s %s" % (project_id, SwarmUI.deleteRequested))
+    await app.enqueue_action(
+        project_id, shutdown_and_cleanup_pipeline,
+        [app, project_id])
+
+
+async def update_requested(app, triple):
+    """
+    Handler of swarmui:updateRequested: update the pipeline
+    """
+    assert isinstance(triple.o, Literal), "wrong type: %r" % type(triple.o)
+    if not triple.o == "true":
+        return
+    project_id = await app.get_resource_id(triple.s)
+    await app.enqueue_action(
+        project_id, app.remove_triple,
+        [project_id, SwarmUI.updateRequested],
+        supersede="remove %s %s" % (project_id, SwarmUI.updateRequested))
+    await app.enqueue_action(
+        project_id, update_action, [app, project_id, triple.s])
+
+
+handlers = {
+    SwarmUI.requestedStatus: requested_status,
+    SwarmUI.restartRequested: restart_requested,
+    SwarmUI.deleteRequested: delete_requested,
+    SwarmUI.updateRequested: update_requested,
+}
+
+
 async def update(app, inserts, deletes):
     """
     Handler for the updates of the pipelines received by the Delta service
@@ -150,62 +269,9 @@ async def update(app, inserts, deletes):
     logger.debug("Receiving updates: inserts=%r deletes=%r", inserts, deletes)
     for subject, triples in inserts.items():
         for triple in triples:
-
-            if triple.p == SwarmUI.requestedStatus:
-                assert isinstance(triple.o, IRI), \
-                    "wrong type: %r" % type(triple.o)
-                project_id = await app.get_resource_id(subject)
-                await app.enqueue_action(
-                    project_id, app.remove_triple,
-                    [project_id, SwarmUI.requestedStatus])
-                if triple.o == SwarmUI.Up:
-                    await app.enqueue_action(project_id, up_action,
-                                             [app, project_id])
-                elif triple.o in _state_to_action:
-                    args, pending_state = _state_to_action[triple.o]
-                    await app.enqueue_action(
-                        project_id, do_action,
-                        [app, project_id, args, pending_state, triple.o])
-                else:
-                    logger.error("Requested status not implemented: %s",
-                                 triple.o.value)
-
-            elif triple.p == SwarmUI.restartRequested:
-                assert isinstance(triple.o, Literal), \
-                    "wrong type: %r" % type(triple.o)
-                if not triple.o == "true":
-                    continue
-                project_id = await app.get_resource_id(subject)
-                await app.enqueue_action(
-                    project_id, app.remove_triple,
-                    [project_id, SwarmUI.restartRequested])
-                await app.enqueue_action(project_id, restart_action,
-                                         [app, project_id])
-
-            elif triple.p == SwarmUI.deleteRequested:
-                assert isinstance(triple.o, Literal), \
-                    "wrong type: %r" % type(triple.o)
-                if not triple.o == "true":
-                    continue
-                project_id = await app.get_resource_id(subject)
-                await app.enqueue_action(
-                    project_id, app.remove_triple,
-                    [project_id, SwarmUI.deleteRequested])
-                await app.enqueue_action(
-                    project_id, shutdown_and_cleanup_pipeline,
-                    [app, project_id])
-
-            elif triple.p == SwarmUI.updateRequested:
-                assert isinstance(triple.o, Literal), \
-                    "wrong type: %r" % type(triple.o)
-                if not triple.o == "true":
-                    continue
-                project_id = await app.get_resource_id(subject)
-                await app.enqueue_action(
-                    project_id, app.remove_triple,
-                    [project_id, SwarmUI.updateRequested])
-                await app.enqueue_action(
-                    project_id, update_action, [app, project_id, triple.s])
+            handler = handlers.get(triple.p)
+            if handler is not None:
+                await handler(app, triple)
 
 
 async def get_existing_updates(sparql):
@@ -1,9 +1,11 @@
+import asyncio
 import logging
 import os
 from aiosparql.syntax import IRI, Literal
 from shutil import rmtree
 
 import muswarmadmin.pipelines
+from muswarmadmin.actionscheduler import CLEANUP
 from muswarmadmin.prefixes import Doap, SwarmUI
 
 
@@ -26,6 +28,24 @@ async def repository_has_location(app, pipeline):
     return result['boolean']
 
 
+async def get_repository_location(app, pipeline):
+    """
+    Get the location (git url) of the repository associated with a given
+    Pipeline or None if it has none.
+    """
+    result = await app.sparql.query("""
+        SELECT ?location
+        FROM {{graph}}
+        WHERE {
+         ?repository swarmui:pipelines {{pipeline}} .
+         ?repository doap:location ?location .
+        }
+        """, pipeline=pipeline)
+    if not result['results']['bindings']:
+        return None
+    return result['results']['bindings'][0]['location']['value']
+
+
 async def get_repository_drc(app, pipeline):
     """
     Get DockerCompose file associated with a given Pipeline.
@@ -47,7 +67,8 @@ async def get_repository_drc(app, pipeline):
 async def initialize_pipeline(app, pipeline, project_id, location, branch):
     """
     Action triggered when a new pipeline appear in the database: clone the
-    sources, insert the triples for services
+    sources (from the local mirror of the repository), insert the triples for
+    services
     """
     logger.info("Initializing pipeline %s", project_id)
     project_path = "/data/%s" % project_id
@@ -57,13 +78,26 @@ async def initialize_pipeline(app, pipeline, project_id, location, branch):
     await app.update_state(project_id, SwarmUI.Initializing)
 
     if await repository_has_location(app, pipeline=pipeline):
-        proc = await app.run_command(
-            "git", "clone", location, "-b", (branch or "master"), project_id,
-            cwd="/data")
+        mirror = await app.git_mirrors.update(location)
+        if mirror is None:
+            proc = await app.run_command(
+                "git", "clone", location, "-b", (branch or "master"),
+                project_id, cwd="/data")
+        else:
+            # NOTE: a clone of the local mirror does not copy the objects, it
+            #       creates hard links to the files of the mirror
+            proc = await app.run_command(
+                "git", "clone", mirror, "-b", (branch or "master"),
+                project_id, cwd="/data")
+            if proc.returncode == 0:
+                proc = await app.run_command(
+                    "git", "remote", "set-url", "origin", location,
+                    cwd=project_path)
         if proc.returncode != 0:
             logger.error("Failed to clone repository at %s", location)
             if os.path.exists(project_path):
                 rmtree(project_path)
+            await app.update_state(project_id, SwarmUI.Error)
             return
     else:
         os.makedirs(project_path)
@@ -82,6 +116,28 @@ async def initialize_pipeline(app, pipeline, project_id, location, branch):
         await app.update_state(project_id, SwarmUI.Down)
 
 
+async def remove_repository_mirror(app, repository):
+    """
+    Remove the local mirror of the location of a repository unless another
+    repository has the same location
+    """
+    result = await app.sparql.query("""
+        SELECT ?location ?other
+        FROM {{graph}}
+        WHERE {
+            {{repository}} doap:location ?location .
+            OPTIONAL {
+                ?other doap:location ?location .
+                FILTER (?other != {{repository}})
+            }
+        }
+        """, repository=repository)
+    bindings = result['results']['bindings']
+    if not bindings or any('other' in x for x in bindings):
+        return
+    await app.git_mirrors.remove(bindings[0]['location']['value'])
+
+
 async def remove_repository(app, repository):
     """
     Remove a repository by shutting down and removing all the associated
@@ -100,6 +156,7 @@ async def remove_repository(app, repository):
     if not result['results']['bindings'] or \
             not result['results']['bindings'][0]:
         logger.debug("No pipeline for repository %s", repository)
+        await remove_repository_mirror(app, repository)
         return
     pipelines = [
         data['uuid']['value']
@@ -108,9 +165,10 @@ async def remove_repository(app, repository):
     for pipeline_id in pipelines:
         await app.enqueue_action(
             pipeline_id, muswarmadmin.pipelines.shutdown_and_cleanup_pipeline,
-            [app, pipeline_id])
+            [app, pipeline_id], priority=CLEANUP)
     for pipeline_id in pipelines:
         await app.wait_action(pipeline_id)
+    await remove_repository_mirror(app, repository)
     await app.sparql.update(
         """
         # NOTE: DELETE WHERE is not handled by the Delta service
@@ -124,6 +182,41 @@ async def remove_repository(app, repository):
         """, repository=repository)
 
 
+async def pipeline_added(app, triple):
+    """
+    Handler of swarmui:pipelines: initialize the new pipeline
+    """
+    assert isinstance(triple.o, IRI), "wrong type: %r" % type(triple.o)
+    result, _, project_id = await asyncio.gather(
+        app.sparql.query("DESCRIBE {{}} FROM {{graph}}", triple.s),
+        app.get_resource_id(triple.s), app.get_resource_id(triple.o),
+        loop=app.loop)
+    info, = tuple(result.values())
+    location = info.get(Doap.location, [{'value': ''}])[0]['value']
+    branch = info.get(SwarmUI.branch, [{'value': ''}])[0]['value']
+    await app.enqueue_action(project_id, initialize_pipeline, [
+        app, triple.o, project_id, location, branch,
+    ], supersede="initialize")
+
+
+async def delete_requested(app, triple):
+    """
+    Handler of swarmui:deleteRequested: remove the repository
+    """
+    assert isinstance(triple.o, Literal), "wrong type: %r" % type(triple.o)
+    if not triple.o == "true":
+        return
+    repository_id = await app.get_resource_id(triple.s)
+    await app.enqueue_action(repository_id, remove_repository,
+                             [app, triple.s])
+
+
+handlers = {
+    SwarmUI.pipelines: pipeline_added,
+    SwarmUI.deleteRequested: delete_requested,
+}
+
+
 async def update(app, inserts, deletes):
     """
     Handler for the updates of the repositories received by the Delta service
@@ -131,29 +224,9 @@ async def update(app, inserts, deletes):
     logger.debug("Receiving updates: inserts=%r deletes=%r", inserts, deletes)
     for subject, triples in inserts.items():
         for triple in triples:
-
-            if triple.p == SwarmUI.pipelines:
-                assert isinstance(triple.o, IRI), \
-                    "wrong type: %r" % type(triple.o)
-                result = await app.sparql.query("DESCRIBE {{}} FROM {{graph}}",
-                                                subject)
-                info, = tuple(result.values())
-                location = info.get(Doap.location, [{'value': ''}])[0]['value']
-                branch = info.get(SwarmUI.branch, [{'value': ''}])[0]['value']
-                repository_id = await app.get_resource_id(subject)
-                project_id = await app.get_resource_id(triple.o)
-                await app.enqueue_action(project_id, initialize_pipeline, [
-                    app, triple.o, project_id, location, branch,
-                ])
-
-            elif triple.p == SwarmUI.deleteRequested:
-                assert isinstance(triple.o, Literal), \
-                    "wrong type: %r" % type(triple.o)
-                if not triple.o == "true":
-                    continue
-                repository_id = await app.get_resource_id(subject)
-                await app.enqueue_action(repository_id, remove_repository,
-                                         [app, subject])
+            handler = handlers.get(triple.p)
+            if handler is not None:
+                await handler(app, triple)
 
 
 async def get_existing_updates(sparql):
@@ -1,11 +1,13 @@
 from aiohttp import web
 from aiosparql.syntax import IRI, Literal
+import asyncio
 import logging
 
 from muswarmadmin.prefixes import SwarmUI
 
 
 MAXIMUM_LINE_OF_LOGS = 1000
+LOGS_QUEUE_SIZE = 1000
 logger = logging.getLogger(__name__)
 
 
@@ -23,8 +25,9 @@ async def do_action(app, project_id, service_id,
     Action triggered for any change of swarmui:requestedStatus but swarmui:Up
     """
     logger.info("Changing service %s status to %s", service_id, end_state)
-    await app.update_state(service_id, pending_state)
-    service_name = await app.get_dct_title(service_id)
+    _, service_name = await asyncio.gather(
+        app.update_state(service_id, pending_state),
+        app.get_dct_title(service_id), loop=app.loop)
     all_args = list(args) + [service_name]
     proc = await app.run_compose(*all_args, cwd="/data/%s" % project_id)
     if proc.returncode is not 0:
@@ -38,8 +41,9 @@ async def up_action(app, project_id, service_id):
     Action triggered for a change of swarmui:requestedStatus to swarmui:Up
     """
     logger.info("Changing service %s status to %s", service_id, SwarmUI.Up)
-    await app.update_state(service_id, SwarmUI.Starting)
-    service_name = await app.get_dct_title(service_id)
+    _, service_name = await asyncio.gather(
+        app.update_state(service_id, SwarmUI.Starting),
+        app.get_dct_title(service_id), loop=app.loop)
     proc = await app.run_compose("up", "-d", service_name,
                                  cwd="/data/%s" % project_id)
     if proc.returncode is not 0:
@@ -53,8 +57,9 @@ async def restart_action(app, project_id, service_id):
     Action triggered when swarmui:restartRequested has become true
     """
     logger.info("Restarting service %s", service_id)
-    await app.update_state(service_id, SwarmUI.Restarting)
-    service_name = await app.get_dct_title(service_id)
+    _, service_name = await asyncio.gather(
+        app.update_state(service_id, SwarmUI.Restarting),
+        app.get_dct_title(service_id), loop=app.loop)
     await app.run_compose("restart", service_name, cwd="/data/%s" % project_id)
 
 
@@ -63,62 +68,89 @@ async def scaling_action(app, project_id, service_id, value):
     Action triggered when swarmui:requestedScaling change
     """
     logger.info("Scaling service %s to %s", service_id, value)
-    await app.update_state(service_id, SwarmUI.Scaling)
-    service_name = await app.get_dct_title(service_id)
+    _, service_name = await asyncio.gather(
+        app.update_state(service_id, SwarmUI.Scaling),
+        app.get_dct_title(service_id), loop=app.loop)
     await app.run_compose("scale", "%s=%d" % (service_name, value),
                           cwd="/data/%s" % project_id)
 
 
+async def requested_status(app, triple):
+    """
+    Handler of swarmui:requestedStatus: change the status of the service
+    """
+    assert isinstance(triple.o, IRI), "wrong type: %r" % type(triple.o)
+    service_id = await app.get_resource_id(triple.s)
+    project_id = await app.get_service_pipeline(service_id)
+    await app.enqueue_action(
+        project_id, app.remove_triple,
+        [service_id, SwarmUI.requestedStatus],
+        supersede="remove %s %s" % (service_id, SwarmUI.requestedStatus))
+    # NOTE: only the last status requested is applied
+    if triple.o == SwarmUI.Up:
+        await app.enqueue_action(project_id, up_action,
+                                 [app, project_id, service_id],
+                                 supersede="status %s" % service_id)
+    elif triple.o in _state_to_action:
+        args, pending_state = _state_to_action[triple.o]
+        await app.enqueue_action(
+            project_id, do_action,
+            [app, project_id, service_id, args, pending_state,
+             triple.o], supersede="status %s" % service_id)
+    else:
+        logger.error("Requested status not implemented: %s",
+                     triple.o.value)
+
+
+async def restart_requested(app, triple):
+    """
+    Handler of swarmui:restartRequested: restart the service
+    """
+    assert isinstance(triple.o, Literal), "wrong type: %r" % type(triple.o)
+    if not triple.o == "true":
+        return
+    service_id = await app.get_resource_id(triple.s)
+    project_id = await app.get_service_pipeline(service_id)
+    await app.enqueue_action(
+        project_id, app.remove_triple,
+        [service_id, SwarmUI.restartRequested],
+        supersede="remove %s %s" % (service_id, SwarmUI.restartRequested))
+    await app.enqueue_action(project_id, restart_action,
+                             [app, project_id, service_id],
+                             supersede="restart %s" % service_id)
+
+
+async def requested_scaling(app, triple):
+    """
+    Handler of swarmui:requestedScaling: scale the service
+    """
+    assert isinstance(triple.o, Literal), "wrong type: %r" % type(triple.o)
+    service_id = await app.get_resource_id(triple.s)
+    project_id = await app.get_service_pipeline(service_id)
+    # NOTE: only the last scaling requested is applied
+    await app.enqueue_action(
+        project_id, scaling_action,
+        [app, project_id, service_id, int(triple.o.value)],
+        supersede="scaling %s" % service_id)
+
+
+handlers = {
+    SwarmUI.requestedStatus: requested_status,
+    SwarmUI.restartRequested: restart_requested,
+    SwarmUI.requestedScaling: requested_scaling,
+}
+
+
 async def update(app, inserts, deletes):
     """
-    Handler for the updates of the pipelines received by the Delta service
+    Handler for the updates of the services received by the Delta service
     """
     logger.debug("Receiving updates: inserts=%r deletes=%r", inserts, deletes)
     for subject, triples in inserts.items():
         for triple in triples:
-
-            if triple.p == SwarmUI.requestedStatus:
-                assert isinstance(triple.o, IRI), \
-                    "wrong type: %r" % type(triple.o)
-                service_id = await app.get_resource_id(subject)
-                project_id = await app.get_service_pipeline(service_id)
-                await app.enqueue_action(
-                    project_id, app.remove_triple,
-                    [service_id, SwarmUI.requestedStatus])
-                if triple.o == SwarmUI.Up:
-                    await app.enqueue_action(project_id, up_action,
-                                             [app, project_id, service_id])
-                elif triple.o in _state_to_action:
-                    args, pending_state = _state_to_action[triple.o]
-                    await app.enqueue_action(
-                        project_id, do_action,
-                        [app, project_id, service_id, args, pending_state,
-                         triple.o])
-                else:
-                    logger.error("Requested status not implemented: %s",
-                                 triple.o.value)
-
-            elif triple.p == SwarmUI.restartRequested:
-                assert isinstance(triple.o, Literal), \
-                    "wrong type: %r" % type(triple.o)
-                if not triple.o == "true":
-                    continue
-                service_id = await app.get_resource_id(subject)
-                project_id = await app.get_service_pipeline(service_id)
-                await app.enqueue_action(
-                    project_id, app.remove_triple,
-                    [service_id, SwarmUI.restartRequested])
-                await app.enqueue_action(project_id, restart_action,
-                                         [app, project_id, service_id])
-
-            elif triple.p == SwarmUI.requestedScaling:
-                assert isinstance(triple.o, Literal), \
-                    "wrong type: %r" % type(triple.o)
-                service_id = await app.get_resource_id(subject)
-                project_id = await app.get_service_pipeline(service_id)
-                await app.enqueue_action(
-                    project_id, scaling_action,
-                    [app, project_id, service_id, int(triple.o.value)])
+            handler = handlers.get(triple.p)
+            if handler is not None:
+                await handler(app, triple)
 
 
 async def get_existing_updates(sparql):
@@ -139,21 +171,118 @@ async def get_existing_updates(sparql):
         """)
 
 
+def get_logs_options(query):
+    """
+    Parse the query parameters of the logs endpoint: tail (a number of lines
+    or "all"), since (a UNIX timestamp), follow and timestamps
+    """
+    tail = query.get("tail", str(MAXIMUM_LINE_OF_LOGS))
+    if tail != "all":
+        if not tail.isdigit():
+            raise web.HTTPBadRequest(text="invalid tail: %s" % tail)
+        tail = int(tail)
+    since = query.get("since")
+    if since is not None:
+        if not since.isdigit() or int(since) == 0:
+            raise web.HTTPBadRequest(text="invalid since: %s" % since)
+        since = int(since)
+    return {
+        "tail": tail,
+        "since": since,
+        "follow": query.get("follow", "false") in ("true", "1"),
+        "timestamps": query.get("timestamps", "false") in ("true", "1"),
+    }
+
+
+async def get_service_containers(app, project_id, service_name):
+    """
+    Get the containers of a service ordered by container number
+    """
+    containers = await app.docker.containers(
+        all=True,
+        filters={
+            'label': [
+                "com.docker.compose.project=" + project_id.lower(),
+                "com.docker.compose.service=" + service_name,
+                "com.docker.compose.oneoff=False",
+            ]
+        })
+    return sorted(containers, key=lambda x: int(
+        x['Labels'].get("com.docker.compose.container-number", 0)))
+
+
+async def read_container_logs(app, container_id, prefix, queue, options):
+    """
+    Read the log stream of a container and put its lines, prefixed, in the
+    queue. None is put in the queue when the stream ends
+    """
+    buffer = b""
+    try:
+        async for chunk in app.docker.logs(container_id, stream=True,
+                                           **options):
+            # NOTE: the log stream of a container with a TTY is not
+            #       multiplexed and yields strings
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            lines = (buffer + chunk).split(b"\n")
+            buffer = lines.pop()
+            for line in lines:
+                await queue.put(prefix + line + b"\n")
+        if buffer:
+            await queue.put(prefix + buffer + b"\n")
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        logger.exception("Can not read the logs of container %s",
+                         container_id)
+    await queue.put(None)
+
+
 async def logs(request):
     """
-    API endpoint to fetch the logs of a container
+    API endpoint to stream the logs of the containers of a service. The lines
+    of the containers are interleaved as they arrive and prefixed by the name
+    of the container like docker-compose logs does
     """
     service_id = request.match_info['id']
     try:
         project_id = await request.app.get_service_pipeline(service_id)
     except KeyError:
         raise web.HTTPNotFound(body="service %s not found" % service_id)
+    options = get_logs_options(request.query)
     service_name = await request.app.get_dct_title(service_id)
-    proc = await request.app.run_compose(
-        "logs", "--no-color", "--tail=%s" % MAXIMUM_LINE_OF_LOGS, service_name,
-        cwd="/data/%s" % project_id, logging=False)
-    if proc.returncode is None or proc.returncode < 0:
-        raise web.HTTPRequestTimeout()
-    else:
-        logs = await proc.stdout.read()
-        return web.Response(text=logs.decode())
+    containers = await get_service_containers(request.app, project_id,
+                                              service_name)
+    names = [
+        "%s_%s" % (service_name,
+                   x['Labels'].get("com.docker.compose.container-number", 0))
+        for x in containers
+    ]
+    width = max([len(x) for x in names], default=0)
+    response = web.StreamResponse(
+        headers={"Content-Type": "text/plain; charset=utf-8"})
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    queue = asyncio.Queue(maxsize=LOGS_QUEUE_SIZE, loop=request.app.loop)
+    tasks = [
+        request.app.loop.create_task(read_container_logs(
+            request.app, container['Id'],
+            ("%s | " % name.ljust(width)).encode(), queue, options))
+        for container, name in zip(containers, names)
+    ]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            # NOTE: the lines available are sent in a single chunk
+            lines = [await queue.get()]
+            while not queue.empty():
+                lines.append(queue.get_nowait())
+            remaining -= lines.count(None)
+            data = b"".join(x for x in lines if x is not None)
+            if data:
+                await response.write(data)
+    finally:
+        for task in tasks:
+            task.cancel()
+    await response.write_eof()
+    return response
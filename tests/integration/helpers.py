@@ -123,6 +123,7 @@ class IntegrationTestCase(AioHTTPTestCase):
     async def insert_triples(self, triples):
         await self.app.sparql.update(
             "INSERT DATA { GRAPH {{graph}} { {{}} } }", Triples(triples))
+        await self.app.delta_queue.join()
 
     async def prepare_node(self, node):
         await self.prepare_triples([node])
@@ -143,6 +144,7 @@ class IntegrationTestCase(AioHTTPTestCase):
             WHERE {
                 {{s}} {{p}} {{o}}
             }""", s=s, p=p, o=o)
+        await self.app.delta_queue.join()
 
     async def describe(self, subject):
         return await self.app.sparql.query("DESCRIBE {{}} FROM {{graph}}",
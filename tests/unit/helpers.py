@@ -1,11 +1,16 @@
+import json
+import rdflib
+import re
 import uuid
+from aiohttp import web
 from aiohttp.test_utils import AioHTTPTestCase, TestServer, unittest_run_loop
+from aiosparql.syntax import IRI
 from aiosparql.test_utils import TestSPARQLClient
 
 import muswarmadmin.main
-from muswarmadmin import delta
+from muswarmadmin import delta, metrics, services
 
-__all__ = ['UnitTestCase', 'unittest_run_loop']
+__all__ = ['FakeReader', 'GraphStore', 'UnitTestCase', 'unittest_run_loop']
 
 
 class Application(muswarmadmin.main.Application):
@@ -14,7 +19,7 @@ class Application(muswarmadmin.main.Application):
         if not hasattr(self, '_sparql'):
             self._sparql = TestSPARQLClient(TestServer(self),
                                             endpoint="/",
-                                            graph="http://example.org",
+                                            graph=IRI("http://example.org"),
                                             loop=self.loop)
         return self._sparql
 
@@ -23,14 +28,80 @@ class Application(muswarmadmin.main.Application):
         raise RuntimeError("Can not do Docker queries during unit test")
 
 
+class GraphStore:
+    """
+    An in-memory RDF store that evaluates the SPARQL queries and updates sent
+    to the application graph
+    """
+    re_from = re.compile(r"\bFROM\s+<[^>]*>", flags=re.I)
+
+    def __init__(self, graph):
+        self.dataset = rdflib.Dataset()
+        self.graph = self.dataset.graph(rdflib.URIRef(graph))
+
+    def query(self, query):
+        # NOTE: rdflib can not evaluate a FROM clause without downloading the
+        #       graph, the application graph is the only graph anyway
+        result = self.graph.query(self.re_from.sub("", query))
+        return json.loads(result.serialize(format="json").decode())
+
+    def update(self, query):
+        self.dataset.update(query)
+
+    def triples(self):
+        return set(self.graph)
+
+
+class FakeReader:
+    """
+    A stream that returns its data in chunks of the size given
+    """
+    def __init__(self, data, chunk_size):
+        self.data = data
+        self.chunk_size = chunk_size
+
+    async def read(self, n):
+        chunk = self.data[:self.chunk_size]
+        self.data = self.data[self.chunk_size:]
+        return chunk
+
+
 class UnitTestCase(AioHTTPTestCase):
     async def get_application(self):
         app = Application(loop=self.loop)
         app.router.add_post("/update", delta.update)
+        app.router.add_get("/metrics", metrics.handler)
+        app.router.add_get("/services/{id}/logs", services.logs)
+        app.router.add_post("/", self.sparql_endpoint)
+        self.sparql_queries = []
+        self.sparql_responses = []
+        self.graph_store = None
         await app.sparql.start_server()
+        await muswarmadmin.main.start_delta_worker(app)
         return app
 
+    async def sparql_endpoint(self, request):
+        """
+        A stand-in SPARQL endpoint: record the queries received and evaluate
+        them on self.graph_store if any, otherwise answer with the responses
+        prepared in self.sparql_responses (in order)
+        """
+        data = await request.post()
+        query = data.get('query') or data.get('update')
+        self.sparql_queries.append(query)
+        if self.graph_store is not None:
+            if 'update' in data:
+                self.graph_store.update(query)
+                return web.json_response({})
+            return web.json_response(self.graph_store.query(query))
+        if self.sparql_responses:
+            return web.json_response(self.sparql_responses.pop(0))
+        return web.json_response({"boolean": False,
+                                  "results": {"bindings": []}})
+
     def tearDown(self):
+        self.loop.run_until_complete(
+            muswarmadmin.main.stop_delta_worker(self.app))
         self.loop.run_until_complete(self.app.sparql.close())
         super().tearDown()
 
@@ -0,0 +1,229 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from aiohttp.test_utils import setup_test_loop, teardown_test_loop
+from aiosparql.syntax import IRI, Node, RDF, Triples
+from types import SimpleNamespace
+from unittest import mock
+
+import muswarmadmin.main
+from muswarmadmin import actionjournal, delta, pipelines
+from muswarmadmin.actionjournal import ActionJournal
+from muswarmadmin.actionscheduler import (
+    ActionScheduler, CLEANUP, RECONCILIATION)
+from muswarmadmin.eventmonitor import ServiceChange
+from muswarmadmin.prefixes import Mu, SwarmUI
+
+from tests.unit.helpers import GraphStore, UnitTestCase, unittest_run_loop
+
+
+class FakeApp:
+    def __init__(self, loop):
+        self.loop = loop
+        self.values = []
+        self.release = asyncio.Event(loop=loop)
+
+    async def record(self, value):
+        self.values.append(value)
+
+    async def block(self, value):
+        await self.release.wait()
+        self.values.append(value)
+
+    async def wait(self, key):
+        await ActionScheduler.executers[key].cancel()
+        self.values.append("waited %s" % key)
+
+
+class ActionJournalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = setup_test_loop()
+        self.app = FakeApp(self.loop)
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, "journal")
+        self.journal = ActionJournal(self.path, self.app)
+
+    def tearDown(self):
+        self.journal.close()
+        teardown_test_loop(self.loop)
+
+    def reload(self):
+        self.journal.close()
+        self.journal = ActionJournal(self.path, self.app)
+        return self.journal.load()
+
+    def test_resume_pending(self):
+        first = self.journal.put(
+            "ActionScheduler", "P1", pipelines.up_action,
+            [self.app, "P1", IRI("http://example.org/s"), SwarmUI.Up,
+             ["up", "-d"], 3], "user", "status")
+        self.journal.put("ActionScheduler", "P2", self.app.record, ["x"],
+                         "cleanup", None)
+        self.journal.done(first)
+        records = self.reload()
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['key'], "P2")
+        self.assertEqual(records[0]['action'], self.app.record)
+        self.assertEqual(records[0]['args'], ["x"])
+        self.assertEqual(records[0]['priority'], "cleanup")
+        # NOTE: the entries of the actions resumed are kept
+        records = self.reload()
+        self.assertEqual([x['key'] for x in records], ["P2"])
+        self.journal.done(records[0]['id'])
+        self.assertEqual(self.reload(), [])
+
+    def test_arguments(self):
+        args = [self.app, "P1", IRI("http://example.org/s"), SwarmUI.Up,
+                ["up", "-d"], 3, None, True]
+        self.journal.put("ActionScheduler", "P1", pipelines.up_action, args,
+                         "user", None)
+        record, = self.reload()
+        self.assertEqual(record['action'], pipelines.up_action)
+        self.assertIs(record['args'][0], self.app)
+        self.assertEqual(record['args'][1:3],
+                         ["P1", IRI("http://example.org/s")])
+        self.assertEqual(record['args'][3].value, SwarmUI.Up.iri().value)
+        self.assertEqual(record['args'][4:], [["up", "-d"], 3, None, True])
+
+    def test_not_encodable(self):
+        async def action():
+            pass
+
+        self.assertIsNone(self.journal.put(
+            "ActionScheduler", "P1", action, [], "user", None))
+        self.assertIsNone(self.journal.put(
+            "ActionScheduler", "P1", self.app.record, [ServiceChange()],
+            "user", None))
+        self.assertEqual(self.reload(), [])
+
+    def test_invalid_lines(self):
+        self.journal.put("ActionScheduler", "P1", self.app.record, [1],
+                         "user", None)
+        self.journal.put("ActionScheduler", "P1", self.app.record, [2],
+                         "user", None)
+        self.journal.close()
+        with open(self.path, "a") as fh:
+            fh.write('{"scheduler": "ActionSched')
+        with open(self.path) as fh:
+            content = fh.read().replace("app:record", "app:removed", 1)
+        with open(self.path, "w") as fh:
+            fh.write(content)
+        records = self.reload()
+        self.assertEqual([x['args'] for x in records], [[2]])
+
+    def test_compaction(self):
+        with mock.patch.object(actionjournal, "COMPACTION_LINES", 10):
+            for i in range(20):
+                entry = self.journal.put("ActionScheduler", "P1",
+                                         self.app.record, [i], "user", None)
+                if i != 5:
+                    self.journal.done(entry)
+            with open(self.path) as fh:
+                self.assertLessEqual(len(fh.readlines()), 12)
+        self.assertEqual([x['args'] for x in self.reload()], [[5]])
+
+    @unittest_run_loop
+    async def test_scheduler_checkpoint(self):
+        async def execute(action, value, **kwargs):
+            await ActionScheduler.execute("test", action, [value],
+                                          loop=self.loop,
+                                          journal=self.journal, **kwargs)
+
+        await execute(self.app.block, "running")
+        await asyncio.sleep(0, loop=self.loop)
+        await execute(self.app.record, "pending")
+        await execute(self.app.record, "superseded", supersede="status")
+        await execute(self.app.record, "event", priority=RECONCILIATION)
+        await execute(self.app.record, "cleanup", priority=CLEANUP,
+                      supersede="status")
+        # NOTE: the action running is finished before stopping
+        checkpoint = self.loop.create_task(ActionScheduler.checkpoint())
+        await asyncio.sleep(0.1, loop=self.loop)
+        self.assertFalse(checkpoint.done())
+        self.app.release.set()
+        await checkpoint
+        self.assertEqual(ActionScheduler.executers, {})
+        self.assertEqual(self.app.values, ["running"])
+
+        records = self.reload()
+        self.assertEqual([x['args'] for x in records],
+                         [["pending"], ["cleanup"]])
+        for record in records:
+            await ActionScheduler.execute(
+                record['key'], record['action'], record['args'],
+                loop=self.loop, journal=self.journal,
+                priority=record['priority'], supersede=record['supersede'],
+                entry=record['id'])
+        await ActionScheduler.graceful_cancel()
+        self.assertEqual(self.app.values, ["running", "pending", "cleanup"])
+        self.assertEqual(self.reload(), [])
+
+    @unittest_run_loop
+    async def test_checkpoint_waiting_action(self):
+        await ActionScheduler.execute("other", self.app.block, ["running"],
+                                      loop=self.loop, journal=self.journal)
+        await ActionScheduler.execute("other", self.app.record, ["pending"],
+                                      loop=self.loop, journal=self.journal)
+        await ActionScheduler.execute("test", self.app.wait, ["other"],
+                                      loop=self.loop, journal=self.journal)
+        await asyncio.sleep(0, loop=self.loop)
+        checkpoint = self.loop.create_task(ActionScheduler.checkpoint())
+        await asyncio.sleep(0, loop=self.loop)
+        self.app.release.set()
+        await asyncio.wait_for(checkpoint, 1, loop=self.loop)
+        # NOTE: the action waiting for a scheduler stopped is interrupted
+        self.assertEqual(self.app.values, ["running"])
+        self.assertEqual([x['args'] for x in self.reload()],
+                         [["pending"], ["other"]])
+
+
+class ResumeActionsTestCase(UnitTestCase):
+    async def scan(self):
+        """
+        Queue the actions of the pipeline requests found in the database like
+        delta.startup
+        """
+        result = await pipelines.get_existing_updates(self.app.sparql)
+        await pipelines.update(
+            self.app, delta.groupby_subject(delta.select_to_triples(result)),
+            {})
+
+    async def run_compose(self, *args, cwd=None, **kwargs):
+        self.commands.append(args)
+        return SimpleNamespace(returncode=0)
+
+    @unittest_run_loop
+    async def test_resume_then_scan(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.app.action_journal_path = os.path.join(tmpdir.name, "journal")
+        self.app.action_concurrency = 1
+        self.app.run_compose = self.run_compose
+        self.commands = []
+        self.graph_store = GraphStore(self.app.sparql.graph.value)
+        await self.app.sparql.update(
+            "INSERT DATA { GRAPH {{graph}} { {{}} } }", Triples([
+                Node(IRI("http://example.org/pipeline-instances/PIPELINE"), {
+                    RDF.type: SwarmUI.Pipeline,
+                    Mu.uuid: "PIPELINE",
+                    SwarmUI.restartRequested: "true",
+                }),
+            ]))
+
+        # NOTE: the restart requested is queued but not started at shutdown
+        await self.app.action_limit.acquire()
+        await self.scan()
+        await ActionScheduler.checkpoint()
+        self.app.action_journal.close()
+        del self.app._action_journal, self.app._action_limit
+
+        await self.app.action_limit.acquire()
+        await muswarmadmin.main.resume_actions(self.app)
+        await self.scan()
+        self.app.action_limit.release()
+        await ActionScheduler.graceful_cancel()
+        self.assertEqual(self.commands, [("restart",)])
+        self.assertEqual(self.app.action_journal.load(), [])
+        self.app.action_journal.close()
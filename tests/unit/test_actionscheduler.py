@@ -3,8 +3,10 @@ import unittest
 from aiohttp.test_utils import (
     setup_test_loop, teardown_test_loop, unittest_run_loop)
 
+from muswarmadmin import metrics
 from muswarmadmin.actionscheduler import (
-    ActionScheduler, OneActionScheduler, StopScheduler)
+    ActionScheduler, CLEANUP, ConcurrencyLimit, OneActionScheduler,
+    RECONCILIATION, StopScheduler, USER)
 
 
 class BaseActionSchedulerTestCase(unittest.TestCase):
@@ -27,10 +29,12 @@ class BaseActionSchedulerTestCase(unittest.TestCase):
         if side_effect is not None:
             raise side_effect
 
-    async def enqueue(self, value, side_effect=None, sleep=0):
+    async def enqueue(self, value, side_effect=None, sleep=0, priority=USER,
+                      supersede=None):
         await self.as_class.execute("test", self._job_test,
                                     [value, side_effect, sleep],
-                                    loop=self.loop)
+                                    loop=self.loop, priority=priority,
+                                    supersede=supersede)
 
     @property
     def executers(self):
@@ -80,6 +84,81 @@ class ActionSchedulerTestCase(BaseActionSchedulerTestCase):
         await self.as_class.graceful_cancel()
         self.assertEqual(len(self.executers), 0)
 
+    @unittest_run_loop
+    async def test_idle_executer_removed(self):
+        await self.as_class.execute("test", self._job_test, [1, None, 0],
+                                    loop=self.loop, idle_ttl=0.1)
+        executer = self.executers["test"]
+        await asyncio.sleep(0.05, loop=self.loop)
+        await self.as_class.execute("test", self._job_test, [2, None, 0.2],
+                                    loop=self.loop, idle_ttl=0.1)
+        self.assertIs(self.executers["test"], executer)
+        # NOTE: the executer is not idle while an action is running
+        await asyncio.sleep(0.15, loop=self.loop)
+        self.assertIn("test", self.executers)
+        await asyncio.wait_for(executer.executer, 1, loop=self.loop)
+        self.assertNotIn("test", self.executers)
+        # NOTE: the executer is created again by the next action
+        await self.enqueue(3)
+        self.assertIsNot(self.executers["test"], executer)
+        await self.cancel()
+        self.assertEqual(self.job_values, [1, 2, 3])
+
+    @unittest_run_loop
+    async def test_cancel_removed_executer(self):
+        await self.as_class.execute("test", self._job_test, [1, None, 0],
+                                    loop=self.loop, idle_ttl=0)
+        executer = self.executers["test"]
+        await executer.executer
+        await self.enqueue(2)
+        await executer.cancel()
+        self.assertIn("test", self.executers)
+        await self.cancel()
+        self.assertEqual(self.job_values, [1, 2])
+
+    @unittest_run_loop
+    async def test_priorities(self):
+        metrics.ACTION_CLASS_WAIT_DURATION.clear()
+        release = asyncio.Event(loop=self.loop)
+        await self.as_class.execute("test", release.wait, [], loop=self.loop)
+        await asyncio.sleep(0, loop=self.loop)
+        await self.enqueue("event1", priority=RECONCILIATION)
+        await self.enqueue("cleanup", priority=CLEANUP)
+        await self.enqueue("event2", priority=RECONCILIATION)
+        await self.enqueue("user1")
+        await self.enqueue("user2")
+        release.set()
+        await self.cancel()
+        self.assertEqual(self.job_values,
+                         ["user1", "user2", "event1", "event2", "cleanup"])
+        values = metrics.ACTION_CLASS_WAIT_DURATION.values
+        self.assertEqual(values[(("priority", RECONCILIATION),)]["count"], 2)
+
+    @unittest_run_loop
+    async def test_supersede(self):
+        release = asyncio.Event(loop=self.loop)
+        await self.as_class.execute("test", release.wait, [], loop=self.loop)
+        await asyncio.sleep(0, loop=self.loop)
+        await self.enqueue("scale 3", supersede="scaling")
+        await self.enqueue("up", supersede="status")
+        await self.enqueue("scale 5", supersede="scaling")
+        await self.enqueue("restart")
+        await self.enqueue("down", supersede="status")
+        await self.enqueue("scale 10", supersede="scaling")
+        self.assertEqual(self.executers["test"].depth, 3)
+        release.set()
+        await self.cancel()
+        self.assertEqual(self.job_values, ["restart", "down", "scale 10"])
+
+    @unittest_run_loop
+    async def test_supersede_running(self):
+        await self.enqueue("scale 3", sleep=0.1, supersede="scaling")
+        await asyncio.sleep(0.05, loop=self.loop)
+        await self.enqueue("scale 5", supersede="scaling")
+        await self.enqueue("scale 10", supersede="scaling")
+        await self.cancel()
+        self.assertEqual(self.job_values, ["scale 3", "scale 10"])
+
     @unittest_run_loop
     async def test_executers_are_resilient(self):
         await self.enqueue("foo")
@@ -88,6 +167,24 @@ class ActionSchedulerTestCase(BaseActionSchedulerTestCase):
         await self.cancel()
         self.assertEqual(self.job_values, ["foo", "bar", "baz"])
 
+    @unittest_run_loop
+    async def test_action_cancelled(self):
+        await self.enqueue("foo", side_effect=asyncio.CancelledError())
+        await self.enqueue("bar")
+        await self.cancel()
+        self.assertEqual(self.job_values, ["foo", "bar"])
+        self.assertNotIn("test", self.executers)
+
+    @unittest_run_loop
+    async def test_executer_cancelled(self):
+        await self.enqueue("foo", sleep=0.1)
+        await asyncio.sleep(0, loop=self.loop)
+        self.executer.cancel()
+        await asyncio.sleep(0, loop=self.loop)
+        self.executer.cancel()
+        await asyncio.wait([self.executer], loop=self.loop)
+        self.assertNotIn("test", self.executers)
+
 
 class OneActionSchedulerTestCase(BaseActionSchedulerTestCase):
     as_class = OneActionScheduler
@@ -99,3 +196,67 @@ class OneActionSchedulerTestCase(BaseActionSchedulerTestCase):
         await self.enqueue("baz", sleep=1)
         await self.cancel()
         self.assertEqual(self.job_values, ["foo"])
+
+
+class ConcurrencyLimitTestCase(BaseActionSchedulerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.limit = ConcurrencyLimit(2, loop=self.loop)
+        self.running = 0
+        self.max_running = 0
+
+    async def _job_count(self, key, value):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(0.01, loop=self.loop)
+        self.job_values.append((key, value))
+        self.running -= 1
+
+    @unittest_run_loop
+    async def test_limit_and_order(self):
+        for value in range(3):
+            for key in ("test1", "test2", "test3", "test4"):
+                await self.as_class.execute(key, self._job_count,
+                                            [key, value], loop=self.loop,
+                                            limit=self.limit)
+        await self.as_class.graceful_cancel()
+        self.assertEqual(self.max_running, 2)
+        self.assertEqual(len(self.job_values), 12)
+        for key in ("test1", "test2", "test3", "test4"):
+            self.assertEqual([x for k, x in self.job_values if k == key],
+                             [0, 1, 2])
+        self.assertEqual(self.limit.running, 0)
+
+    @unittest_run_loop
+    async def test_slots_by_priority(self):
+        limit = ConcurrencyLimit(1, loop=self.loop)
+        release = asyncio.Event(loop=self.loop)
+        await self.as_class.execute("test", release.wait, [], loop=self.loop,
+                                    limit=limit)
+        await asyncio.sleep(0, loop=self.loop)
+        for key, priority in [("test1", CLEANUP), ("test2", RECONCILIATION),
+                              ("test3", USER), ("test4", RECONCILIATION)]:
+            await self.as_class.execute(key, self._job_test,
+                                        [key, None, 0], loop=self.loop,
+                                        limit=limit, priority=priority)
+        await asyncio.sleep(0.01, loop=self.loop)
+        self.assertEqual(self.job_values, [])
+        release.set()
+        await self.as_class.graceful_cancel()
+        self.assertEqual(self.job_values, ["test3", "test2", "test4", "test1"])
+
+    @unittest_run_loop
+    async def test_wait_other_scheduler(self):
+        limit = ConcurrencyLimit(1, loop=self.loop)
+
+        async def wait_other():
+            await self.as_class.execute("test2", self._job_test,
+                                        ["other", None, 0], loop=self.loop,
+                                        limit=limit)
+            await self.as_class.executers["test2"].cancel()
+            self.job_values.append("waited")
+
+        await self.as_class.execute("test", wait_other, [], loop=self.loop,
+                                    limit=limit)
+        await asyncio.wait_for(self.cancel(), 1, loop=self.loop)
+        self.assertEqual(self.job_values, ["other", "waited"])
@@ -0,0 +1,230 @@
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from aiohttp.test_utils import (
+    setup_test_loop, teardown_test_loop, unittest_run_loop)
+from textwrap import dedent
+from unittest.mock import MagicMock, patch
+
+from muswarmadmin.composeengine import (
+    ComposeConfigCache, ComposeEngine, parallel, setup_output)
+
+
+class ComposeEngineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = setup_test_loop()
+        self.configs = MagicMock()
+        self.configs.get.return_value.version = "2.0"
+        self.engine = ComposeEngine(self.configs, loop=self.loop)
+        self.project = MagicMock()
+        for name, value in [("Project.from_config", self.project),
+                            ("get_client", MagicMock())]:
+            patcher = patch("muswarmadmin.composeengine.%s" % name,
+                            return_value=value)
+            setattr(self, name.split(".")[-1], patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        teardown_test_loop(self.loop)
+
+    def test_supported_commands(self):
+        self.assertIsNotNone(self.engine.get_command(["up", "-d"]))
+        self.assertIsNotNone(self.engine.get_command(
+            ["up", "-d", "--remove-orphans"]))
+        self.assertIsNotNone(self.engine.get_command(["rm", "-vf", "web"]))
+        self.assertIsNotNone(self.engine.get_command(["scale", "web=3"]))
+        self.assertIsNone(self.engine.get_command([]))
+        self.assertIsNone(self.engine.get_command(
+            ["logs", "--no-color", "--tail=1000", "web"]))
+        self.assertIsNone(self.engine.get_command(["up", "--build"]))
+
+    @unittest_run_loop
+    async def test_run(self):
+        result = await self.engine.run("/data/project", "up", "-d", "web")
+        self.assertEqual(result.returncode, 0)
+        self.configs.get.assert_called_once_with("/data/project")
+        self.from_config.assert_called_once_with(
+            "project", self.configs.get.return_value,
+            self.get_client.return_value)
+        self.project.up.assert_called_once_with(
+            service_names=["web"], detached=True, remove_orphans=False)
+
+    @unittest_run_loop
+    async def test_scale(self):
+        service = self.project.get_service.return_value
+        result = await self.engine.run("/data/project", "scale", "web=3")
+        self.assertEqual(result.returncode, 0)
+        self.project.get_service.assert_called_once_with("web")
+        service.scale.assert_called_once_with(3)
+
+    @unittest_run_loop
+    async def test_unsupported(self):
+        self.assertIsNone(await self.engine.run("/data/project", "logs"))
+        self.configs.get.assert_not_called()
+
+    @unittest_run_loop
+    async def test_shared_client(self):
+        await self.engine.run("/data/project1", "up", "-d")
+        await self.engine.run("/data/project2", "up", "-d")
+        self.assertEqual(self.from_config.call_count, 2)
+        self.get_client.assert_called_once()
+
+    @unittest_run_loop
+    async def test_failure(self):
+        self.project.restart.return_value = []
+        result = await self.engine.run("/data/project", "restart")
+        self.assertEqual(result.returncode, 1)
+        self.project.stop.side_effect = RuntimeError("test exception")
+        result = await self.engine.run("/data/project", "stop")
+        self.assertEqual(result.returncode, 1)
+
+    @unittest_run_loop
+    async def test_timeout(self):
+        self.project.pull.side_effect = lambda **kwargs: time.sleep(0.5)
+        with self.assertLogs("muswarmadmin.composeengine", "WARNING"):
+            result = await self.engine.run("/data/project", "pull",
+                                           timeout=0.1)
+        # NOTE: the command is awaited until it completes
+        self.assertEqual(result.returncode, 0)
+        self.project.pull.assert_called_once_with(service_names=None)
+
+    @unittest_run_loop
+    async def test_logging(self):
+        def up(**kwargs):
+            logging.getLogger("compose.service").info("Creating web_1")
+            parallel.parallel_execute(["web_1"], lambda x: None, str,
+                                      "Starting")
+
+        self.project.up.side_effect = up
+        setup_output()
+        with self.assertLogs("muswarmadmin.composeengine", "INFO") as cm:
+            await self.engine.run("/data/project", "up", "-d")
+        self.assertEqual([x.getMessage() for x in cm.records],
+                         ["Creating web_1", "Starting web_1 ...",
+                          "Starting web_1 ... done"])
+
+
+class CountingComposeConfigCache(ComposeConfigCache):
+    loads = 0
+
+    def load(self, project_dir):
+        self.loads += 1
+        return super().load(project_dir)
+
+
+class ComposeConfigCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.project_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.project_dir)
+        self.cache = CountingComposeConfigCache()
+
+    def write(self, content, mtime, filename="docker-compose.yml"):
+        path = os.path.join(self.project_dir, filename)
+        with open(path, "w") as fh:
+            fh.write(dedent(content))
+        os.utime(path, (mtime, mtime))
+
+    def services(self):
+        data = self.cache.get(self.project_dir)
+        return sorted(x['name'] for x in data.services)
+
+    def test_cache(self):
+        self.write("""\
+            version: "2"
+            services:
+              service1:
+                image: busybox
+            """, 1000)
+        self.assertEqual(self.services(), ["service1"])
+        self.assertEqual(self.services(), ["service1"])
+        self.assertEqual(self.cache.loads, 1)
+        # NOTE: touched but same content
+        self.write("""\
+            version: "2"
+            services:
+              service1:
+                image: busybox
+            """, 2000)
+        self.assertEqual(self.services(), ["service1"])
+        self.assertEqual(self.cache.loads, 1)
+        self.write("""\
+            version: "2"
+            services:
+              service1:
+                image: busybox
+              service2:
+                image: busybox
+            """, 3000)
+        self.assertEqual(self.services(), ["service1", "service2"])
+        self.assertEqual(self.cache.loads, 2)
+        with open(os.path.join(self.project_dir, ".env"), "w") as fh:
+            fh.write("FOO=bar\n")
+        self.assertEqual(self.services(), ["service1", "service2"])
+        self.assertEqual(self.cache.loads, 3)
+        self.cache.invalidate(self.project_dir)
+        self.assertEqual(self.services(), ["service1", "service2"])
+        self.assertEqual(self.cache.loads, 4)
+
+    def environment(self, service):
+        data = self.cache.get(self.project_dir)
+        service, = [x for x in data.services if x['name'] == service]
+        return service['environment']
+
+    def test_referenced_files(self):
+        os.makedirs(os.path.join(self.project_dir, "common"))
+        self.write("""\
+            version: "2"
+            services:
+              base:
+                image: busybox
+                env_file: base.env
+            """, 1000, filename="common/base.yml")
+        self.write("FOO=1\n", 1000, filename="common/base.env")
+        self.write("BAR=1\n", 1000, filename="service.env")
+        self.write("""\
+            version: "2"
+            services:
+              service1:
+                extends:
+                  file: common/base.yml
+                  service: base
+                env_file: service.env
+            """, 1000)
+        self.assertEqual(self.environment("service1"),
+                         {"FOO": "1", "BAR": "1"})
+        self.assertEqual(self.environment("service1"),
+                         {"FOO": "1", "BAR": "1"})
+        self.assertEqual(self.cache.loads, 1)
+        self.write("FOO=2\n", 2000, filename="common/base.env")
+        self.assertEqual(self.environment("service1"),
+                         {"FOO": "2", "BAR": "1"})
+        self.assertEqual(self.cache.loads, 2)
+        self.write("BAR=2\n", 2000, filename="service.env")
+        self.assertEqual(self.environment("service1"),
+                         {"FOO": "2", "BAR": "2"})
+        self.assertEqual(self.cache.loads, 3)
+        self.write("""\
+            version: "2"
+            services:
+              base:
+                image: busybox
+            """, 2000, filename="common/base.yml")
+        self.assertEqual(self.environment("service1"), {"BAR": "2"})
+        self.assertEqual(self.cache.loads, 4)
+
+    def test_unknown_files_not_cached(self):
+        self.write("FOO=1\n", 1000, filename="service.env")
+        self.write("ENV_FILE=service.env\n", 1000, filename=".env")
+        self.write("""\
+            version: "2"
+            services:
+              service1:
+                image: busybox
+                env_file: ${ENV_FILE}
+            """, 1000)
+        self.assertEqual(self.environment("service1"), {"FOO": "1"})
+        self.assertEqual(self.environment("service1"), {"FOO": "1"})
+        self.assertEqual(self.cache.loads, 2)
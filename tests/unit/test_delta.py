@@ -1,4 +1,19 @@
-from tests.unit.helpers import UnitTestCase, unittest_run_loop
+import asyncio
+import json
+import unittest
+from aiohttp.test_utils import setup_test_loop, teardown_test_loop
+from aiosparql.syntax import IRI
+from collections import Counter, OrderedDict
+from hypothesis import given, strategies as st
+from itertools import chain
+from unittest import mock
+
+from muswarmadmin import delta, pipelines, repositories, services
+from muswarmadmin.jsonstream import JSONStream
+from muswarmadmin.prefixes import Mu, SwarmUI
+
+from tests.unit.helpers import (
+    Application, FakeReader, UnitTestCase, unittest_run_loop)
 
 
 class DeltaTestCase(UnitTestCase):
@@ -19,3 +34,290 @@ class DeltaTestCase(UnitTestCase):
         async with self.client.post("/update",
                                     json={"delta": []}) as request:
             self.assertEqual(request.status, 204)
+
+    @unittest_run_loop
+    async def test_client_disconnected(self):
+        request = mock.Mock(app=self.app)
+        with mock.patch.object(delta, "parse_payload",
+                               side_effect=asyncio.CancelledError), \
+                mock.patch.object(self.app.logger, "exception") as exception:
+            with self.assertRaises(asyncio.CancelledError):
+                await delta.update(request)
+        exception.assert_not_called()
+
+
+class DeltaQueueTestCase(UnitTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(Application, "delta_queue_size", 1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.processed = []
+        patcher = mock.patch.object(delta, "process", self.process)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super().setUp()
+        self.release = asyncio.Event(loop=self.loop)
+
+    async def process(self, app, data):
+        await self.release.wait()
+        self.processed.append(data)
+
+    async def post_delta(self, subject):
+        async with self.client.post("/update", json={"delta": [{
+            "graph": "http://example.org",
+            "inserts": [{
+                "s": {"type": "uri", "value": subject},
+                "p": {"type": "uri", "value": "http://example.org/p"},
+                "o": {"type": "literal", "value": "o"},
+            }],
+            "deletes": [],
+        }]}) as response:
+            return response.status
+
+    @unittest_run_loop
+    async def test_background_processing(self):
+        self.assertEqual(await self.post_delta("http://example.org/1"), 204)
+        # NOTE: the worker is busy with the first delta, the second one fills
+        #       the queue and the third one is rejected
+        await asyncio.sleep(0.1, loop=self.loop)
+        self.assertEqual(await self.post_delta("http://example.org/2"), 204)
+        self.assertEqual(await self.post_delta("http://example.org/3"), 503)
+        self.assertEqual(self.processed, [])
+        self.assertEqual(self.app.delta_queue.qsize(), 1)
+        self.release.set()
+        await self.app.delta_queue.join()
+        self.assertEqual([x.inserts[0].s.value for x in self.processed],
+                         ["http://example.org/1", "http://example.org/2"])
+
+    @unittest_run_loop
+    async def test_entries_merged(self):
+        self.release.set()
+
+        def status(value):
+            return {
+                "s": {"type": "uri", "value": "http://example.org/s"},
+                "p": {"type": "uri",
+                      "value": SwarmUI.requestedStatus.iri().value},
+                "o": {"type": "uri", "value": value.iri().value},
+            }
+        # NOTE: the status requested flips up, down then up again
+        async with self.client.post("/update", json={"delta": [
+            {"graph": "http://example.org", "inserts": [status(SwarmUI.Up)],
+             "deletes": []},
+            {"graph": "http://other.org", "inserts": [], "deletes": []},
+            {"graph": "http://example.org",
+             "inserts": [status(SwarmUI.Down)],
+             "deletes": [status(SwarmUI.Up)]},
+            {"graph": "http://example.org", "inserts": [status(SwarmUI.Up)],
+             "deletes": [status(SwarmUI.Down)]},
+        ]}) as response:
+            self.assertEqual(response.status, 204)
+        await self.app.delta_queue.join()
+        self.assertEqual(len(self.processed), 1)
+        self.assertEqual([x.o for x in self.processed[0].inserts],
+                         [SwarmUI.Up.iri()])
+        self.assertEqual(self.processed[0].deletes, [])
+
+
+class RouteTestCase(UnitTestCase):
+    def triple(self, resource, predicate):
+        return delta.Triple({
+            "s": {"type": "uri",
+                  "value": (Application.base_resource + resource).value},
+            "p": {"type": "uri", "value": predicate.iri().value},
+            "o": {"type": "literal", "value": "true"},
+        })
+
+    def test_route(self):
+        triples = [
+            self.triple("services/1", SwarmUI.requestedScaling),
+            self.triple("stacks/1", SwarmUI.deleteRequested),
+            self.triple("services/1", Mu.uuid),
+            self.triple("other/1", SwarmUI.deleteRequested),
+            self.triple("pipeline-instances/1", SwarmUI.deleteRequested),
+            self.triple("services/2", SwarmUI.restartRequested),
+            self.triple("stacks/1", SwarmUI.requestedScaling),
+        ]
+        routed = delta.route(delta.get_handlers(Application.base_resource),
+                             triples)
+        self.assertEqual(routed, [
+            (repositories.delete_requested, triples[1]),
+            (pipelines.delete_requested, triples[4]),
+            (services.requested_scaling, triples[0]),
+            (services.restart_requested, triples[5]),
+        ])
+
+
+def make_triple(s, p, o):
+    return delta.Triple({
+        "s": {"type": "uri", "value": "http://example.org/s%d" % s},
+        "p": {"type": "uri", "value": "http://example.org/p%d" % p},
+        "o": {"type": "literal", "value": str(o)},
+    })
+
+
+triples_strategy = st.lists(
+    st.builds(make_triple, st.integers(0, 10), st.integers(0, 3),
+              st.integers(0, 3)),
+    max_size=200)
+
+
+class GroupBySubjectTestCase(unittest.TestCase):
+    def test_interleaved_subjects(self):
+        triples = [make_triple(1, 0, 0), make_triple(2, 0, 0),
+                   make_triple(1, 1, 0)]
+        self.assertEqual(delta.groupby_subject(triples), {
+            triples[0].s: [triples[0], triples[2]],
+            triples[1].s: [triples[1]],
+        })
+
+    @given(triples_strategy)
+    def test_no_triple_lost(self, triples):
+        groups = delta.groupby_subject(triples)
+        self.assertEqual(sum(len(x) for x in groups.values()), len(triples))
+        self.assertEqual(Counter(chain.from_iterable(groups.values())),
+                         Counter(triples))
+
+    @given(triples_strategy)
+    def test_groups(self, triples):
+        groups = delta.groupby_subject(triples)
+        # NOTE: the subjects are in the order of their first triple
+        self.assertEqual(list(groups),
+                         list(OrderedDict.fromkeys(x.s for x in triples)))
+        for subject, group in groups.items():
+            self.assertEqual(group, [x for x in triples if x.s == subject])
+
+
+class TripleTestCase(unittest.TestCase):
+    def make(self, s, p, o, o_type="literal"):
+        return delta.Triple({
+            "s": {"type": "uri", "value": s},
+            "p": {"type": "uri", "value": p},
+            "o": {"type": o_type, "value": o},
+        })
+
+    def test_compact(self):
+        triple = self.make("http://example.org/s", "http://example.org/p",
+                           "o")
+        self.assertFalse(hasattr(triple, "__dict__"))
+
+    def test_interned(self):
+        status = SwarmUI.status.iri().value
+        up = SwarmUI.Up.iri().value
+        triple1 = self.make("http://example.org/s1", status, up, "uri")
+        triple2 = self.make("http://example.org/s2", status, up, "uri")
+        self.assertIs(triple1.p, triple2.p)
+        self.assertIs(triple1.o, triple2.o)
+        self.assertEqual(triple1.o, SwarmUI.Up)
+        triple1 = self.make("http://example.org/s1", status,
+                            "http://example.org/o", "uri")
+        triple2 = self.make("http://example.org/s2", status,
+                            "http://example.org/o", "uri")
+        self.assertIsNot(triple1.o, triple2.o)
+
+    def test_equality(self):
+        triple = self.make("http://example.org/s", "http://example.org/p",
+                           "http://example.org/o", "uri")
+        same = self.make("http://example.org/s", "http://example.org/p",
+                         "http://example.org/o", "uri")
+        literal = self.make("http://example.org/s", "http://example.org/p",
+                            "http://example.org/o")
+        self.assertEqual(triple, same)
+        self.assertEqual(hash(triple), hash(same))
+        self.assertNotEqual(triple, literal)
+        self.assertEqual(len({triple, same, literal}), 2)
+
+
+class MergeUpdatesTestCase(unittest.TestCase):
+    def update(self, inserts, deletes):
+        return delta.UpdateData.from_triples(
+            "http://example.org",
+            [make_triple(*x) for x in inserts],
+            [make_triple(*x) for x in deletes])
+
+    def test_net_changes(self):
+        data = delta.merge_updates([
+            self.update([(1, 1, 1), (2, 2, 2)], [(3, 3, 3)]),
+            self.update([(3, 3, 3), (4, 4, 4)], [(1, 1, 1), (5, 5, 5)]),
+            self.update([(5, 5, 6)], []),
+        ])
+        self.assertEqual(data.graph, "http://example.org")
+        self.assertEqual(sorted(x.s.value for x in data.inserts),
+                         ["http://example.org/s2", "http://example.org/s4",
+                          "http://example.org/s5"])
+        self.assertEqual([x.s.value for x in data.deletes],
+                         ["http://example.org/s5"])
+
+    def test_cancelled(self):
+        data = delta.merge_updates([
+            self.update([(1, 1, 1)], []),
+            self.update([], [(1, 1, 1)]),
+            self.update([(1, 1, 1)], []),
+            self.update([], [(1, 1, 1)]),
+        ])
+        self.assertEqual((data.inserts, data.deletes), ([], []))
+
+
+class ParsePayloadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = setup_test_loop()
+
+    def tearDown(self):
+        teardown_test_loop(self.loop)
+
+    def triple(self, s, o_type="literal"):
+        return {
+            "s": {"type": "uri", "value": "http://example.org/%s" % s},
+            "p": {"type": "uri", "value": "http://example.org/p"},
+            "o": {"type": o_type, "value": "o"},
+        }
+
+    async def parse(self, payload, chunk_size=7):
+        stream = JSONStream(FakeReader(json.dumps(payload).encode(),
+                                       chunk_size))
+        return await delta.parse_payload(stream, IRI("http://example.org"))
+
+    @unittest_run_loop
+    async def test_other_graphs_skipped(self):
+        # NOTE: the triples of the other graphs can not be built, they would
+        #       fail if they were decoded
+        updates = await self.parse({"delta": [
+            {"graph": "http://other.org",
+             "inserts": [self.triple("a", "bnode")],
+             "deletes": [self.triple("b", "bnode")]},
+            {"graph": "http://example.org",
+             "inserts": [self.triple("c"), self.triple("d")],
+             "deletes": [self.triple("c"), self.triple("e")]},
+            {"graph": "http://other.org",
+             "inserts": [self.triple("f", "bnode")],
+             "deletes": []},
+        ]})
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(updates[0].graph, "http://example.org")
+        self.assertEqual([x.s.value for x in updates[0].inserts],
+                         ["http://example.org/d"])
+        self.assertEqual([x.s.value for x in updates[0].deletes],
+                         ["http://example.org/e"])
+
+    @unittest_run_loop
+    async def test_graph_after_triples(self):
+        updates = await self.parse({"delta": [
+            OrderedDict([("inserts", [self.triple("a")]),
+                         ("deletes", []),
+                         ("graph", "http://other.org")]),
+            OrderedDict([("inserts", [self.triple("b")]),
+                         ("deletes", []),
+                         ("graph", "http://example.org")]),
+        ]})
+        self.assertEqual([x.inserts[0].s.value for x in updates],
+                         ["http://example.org/b"])
+
+    @unittest_run_loop
+    async def test_invalid_payloads(self):
+        for payload in [
+                [None],
+                {},
+                {"delta": [{"graph": "http://example.org", "inserts": []}]},
+                {"delta": [{"graph": 1}]}]:
+            with self.assertRaises(Exception, msg=payload):
+                await self.parse(payload)
@@ -0,0 +1,350 @@
+import asyncio
+import unittest
+from aiohttp.client_exceptions import ClientConnectionError
+from aiohttp.test_utils import (
+    setup_test_loop, teardown_test_loop, unittest_run_loop)
+from aiosparql.syntax import IRI, Node, RDF, Triples
+
+from muswarmadmin.eventmonitor import (
+    ContainerEventCoalescer, EventCursor, EventDispatcher, ServiceChange,
+    reconcile, watch)
+from muswarmadmin.prefixes import Dct, Mu, SwarmUI
+
+from tests.unit.helpers import GraphStore, UnitTestCase
+
+
+def apply_events(scaling, events):
+    for action, container_number in events:
+        if action == "start":
+            scaling = max(scaling, container_number)
+        else:
+            scaling = min(scaling, container_number - 1)
+    return scaling
+
+
+class ServiceChangeTestCase(unittest.TestCase):
+    sequences = [
+        [("start", 1)],
+        [("die", 1)],
+        [("start", 1), ("start", 2), ("start", 3)],
+        [("start", 3), ("die", 3), ("start", 3), ("die", 3)],
+        [("die", 2), ("start", 1), ("start", 4), ("die", 3)],
+        [("die", 5), ("die", 1), ("start", 2)],
+    ]
+
+    def test_net_scaling(self):
+        for events in self.sequences:
+            change = ServiceChange()
+            for action, container_number in events:
+                change.add(action, "container%d" % container_number,
+                           container_number)
+            operations = change.operations()
+            self.assertLessEqual(len(operations), 2)
+            self.assertEqual(operations[-1][0], events[-1][0])
+            for scaling in range(6):
+                self.assertEqual(apply_events(scaling, operations),
+                                 apply_events(scaling, events),
+                                 "events: %r" % events)
+
+    def test_started_containers(self):
+        change = ServiceChange()
+        change.add("start", "a", 1)
+        change.add("start", "b", 2)
+        change.add("die", "a", 1)
+        change.add("start", "c", 1)
+        self.assertEqual(list(change.started), ["b", "c"])
+
+
+class ContainerEventCoalescerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = setup_test_loop()
+        self.changes = []
+
+    def tearDown(self):
+        teardown_test_loop(self.loop)
+
+    async def callback(self, project_id, service_name, change):
+        self.changes.append((project_id, service_name, change.operations()))
+
+    @unittest_run_loop
+    async def test_coalesce_window(self):
+        coalescer = ContainerEventCoalescer(0.1, self.callback,
+                                            loop=self.loop)
+        for i in range(10):
+            coalescer.add("PROJECT", "service1", "start", "a", 1)
+            coalescer.add("PROJECT", "service1", "die", "a", 1)
+        coalescer.add("PROJECT", "service1", "start", "a", 1)
+        coalescer.add("PROJECT", "service2", "start", "b", 2)
+        self.assertEqual(self.changes, [])
+        await asyncio.sleep(0.2, loop=self.loop)
+        self.assertEqual(sorted(self.changes), [
+            ("PROJECT", "service1", [("die", 2), ("start", 1)]),
+            ("PROJECT", "service2", [("start", 2)]),
+        ])
+
+    @unittest_run_loop
+    async def test_flush(self):
+        coalescer = ContainerEventCoalescer(10, self.callback, loop=self.loop)
+        coalescer.add("PROJECT", "service1", "start", "a", 1)
+        await coalescer.flush()
+        self.assertEqual(self.changes,
+                         [("PROJECT", "service1", [("start", 1)])])
+        self.assertEqual(coalescer.changes, {})
+
+
+def make_event(project, value):
+    return {
+        "Type": "container",
+        "Action": "start",
+        "Actor": {"Attributes": {"com.docker.compose.project": project}},
+        "value": value,
+    }
+
+
+class EventDispatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = setup_test_loop()
+        self.handled = []
+
+    def tearDown(self):
+        teardown_test_loop(self.loop)
+
+    async def handler(self, event):
+        await asyncio.sleep(event["value"], loop=self.loop)
+        self.handled.append((self.get_project(event), event["value"]))
+
+    @staticmethod
+    def get_project(event):
+        return event["Actor"]["Attributes"]["com.docker.compose.project"]
+
+    @unittest_run_loop
+    async def test_order_per_project(self):
+        dispatcher = EventDispatcher({"container": [self.handler]},
+                                     loop=self.loop)
+        await dispatcher.put(make_event("A", 0.3))
+        await dispatcher.put(make_event("A", 0.1))
+        await dispatcher.put(make_event("B", 0.2))
+        self.assertEqual(dispatcher.depth, 3)
+        await asyncio.sleep(0.05, loop=self.loop)
+        self.assertEqual(dispatcher.depth, 1)
+        await dispatcher.join()
+        self.assertEqual(self.handled, [("B", 0.2), ("A", 0.3), ("A", 0.1)])
+        self.assertEqual(dispatcher.depth, 0)
+        self.assertEqual(dispatcher.tasks, {})
+
+    @unittest_run_loop
+    async def test_concurrency_limit(self):
+        dispatcher = EventDispatcher({"container": [self.handler]},
+                                     concurrency=1, loop=self.loop)
+        await dispatcher.put(make_event("A", 0.2))
+        await dispatcher.put(make_event("B", 0.1))
+        await dispatcher.join()
+        self.assertEqual(self.handled, [("A", 0.2), ("B", 0.1)])
+
+    @unittest_run_loop
+    async def test_bounded_queue(self):
+        dispatcher = EventDispatcher({"container": [self.handler]},
+                                     maxsize=2, loop=self.loop)
+        await dispatcher.put(make_event("A", 0.1))
+        await dispatcher.put(make_event("A", 0.1))
+        put = self.loop.create_task(dispatcher.put(make_event("A", 0.1)))
+        await asyncio.sleep(0.05, loop=self.loop)
+        self.assertFalse(put.done())
+        await put
+        await dispatcher.join()
+        self.assertEqual(len(self.handled), 3)
+
+    @unittest_run_loop
+    async def test_ignored_event_types(self):
+        dispatcher = EventDispatcher({"container": [self.handler]},
+                                     loop=self.loop)
+        await dispatcher.put({"Type": "network"})
+        self.assertEqual(dispatcher.tasks, {})
+
+
+class FakeDocker:
+    """
+    A Docker client whose event stream fails after each batch of events
+    """
+    def __init__(self, batches):
+        self.batches = list(batches)
+        self.since = []
+
+    async def events(self, since=None, decode=False):
+        self.since.append(since)
+        if not self.batches:
+            raise ClientConnectionError("connection refused")
+        for event in self.batches.pop(0):
+            yield event
+        raise ClientConnectionError("connection lost")
+
+
+def make_timed_event(container_id, time_nano):
+    return {"Type": "container", "Action": "start", "timeNano": time_nano,
+            "Actor": {"ID": container_id, "Attributes": {}}}
+
+
+class WatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = setup_test_loop()
+        self.handled = []
+
+    def tearDown(self):
+        teardown_test_loop(self.loop)
+
+    async def handler(self, event):
+        self.handled.append(event["Actor"]["ID"])
+
+    def test_cursor(self):
+        cursor = EventCursor()
+        self.assertIsNone(cursor.since)
+        self.assertTrue(cursor.advance(make_timed_event("a", 1500000000)))
+        self.assertTrue(cursor.advance(make_timed_event("b", 1500000000)))
+        self.assertFalse(cursor.advance(make_timed_event("a", 1500000000)))
+        self.assertFalse(cursor.advance(make_timed_event("c", 1400000000)))
+        self.assertTrue(cursor.advance(make_timed_event("c", 2100000000)))
+        self.assertEqual(cursor.since, 2)
+
+    @unittest_run_loop
+    async def test_resume_after_failure(self):
+        docker = FakeDocker([
+            [make_timed_event("a", 1000000000),
+             make_timed_event("b", 2500000000)],
+            # NOTE: the stream is resumed from the second 2
+            [make_timed_event("b", 2500000000),
+             make_timed_event("c", 2600000000),
+             make_timed_event("d", 3000000000)],
+        ])
+        dispatcher = EventDispatcher({"container": [self.handler]},
+                                     loop=self.loop)
+        with self.assertRaises(SystemExit):
+            await watch(docker, dispatcher, retries=1, retry_delay=0,
+                        loop=self.loop)
+        self.assertEqual(self.handled, ["a", "b", "c", "d"])
+        self.assertEqual(docker.since, [None, 2, 3])
+
+
+class ReconcileTestCase(UnitTestCase):
+    containers = [
+        # NOTE: service1 of pipeline 1 runs 2 containers, service2 and
+        #       service3 none
+        ("c1", "PIPELINE1", "service1", 1),
+        ("c2", "PIPELINE1", "service1", 2),
+        # NOTE: pipeline 2 is Up and service1 runs more containers than known
+        ("c3", "PIPELINE2", "service1", 3),
+        # NOTE: not in the database
+        ("c4", "UNKNOWN", "service1", 1),
+    ]
+
+    async def prepare_graph(self):
+        self.graph_store = GraphStore(self.app.sparql.graph.value)
+        base = IRI("http://example.org/")
+        nodes = []
+        for project_id, status, services in [
+                ("PIPELINE1", SwarmUI.Stopped, [
+                    ("service1", 0, SwarmUI.Stopped),
+                    ("service2", 3, SwarmUI.Started),
+                    ("service3", 1, SwarmUI.Killed),
+                ]),
+                ("PIPELINE2", SwarmUI.Up, [
+                    ("service1", 1, SwarmUI.Up),
+                    ("service2", 2, SwarmUI.Started),
+                ]),
+                ("PIPELINE3", SwarmUI.Started, [
+                    ("service1", 2, SwarmUI.Started),
+                ])]:
+            pipeline_iri = base + "pipeline-instances/%s" % project_id
+            nodes.append(Node(pipeline_iri, {
+                RDF.type: SwarmUI.Pipeline,
+                Mu.uuid: project_id,
+                SwarmUI.status: status,
+            }))
+            for name, scaling, service_status in services:
+                service_id = "%s_%s" % (project_id, name)
+                service_iri = base + "services/%s" % service_id
+                nodes.append((pipeline_iri, SwarmUI.services, service_iri))
+                nodes.append(Node(service_iri, {
+                    RDF.type: SwarmUI.Service,
+                    Mu.uuid: service_id,
+                    Dct.title: name,
+                    SwarmUI.scaling: scaling,
+                    SwarmUI.status: service_status,
+                }))
+        await self.app.sparql.update(
+            "INSERT DATA { GRAPH {{graph}} { {{}} } }", Triples(nodes))
+        self.sparql_queries.clear()
+
+    async def join_public_network(self, container_id):
+        self.joined.append(container_id)
+        return False
+
+    async def reconcile_one_by_one(self):
+        """
+        The reconciliation done with one event per container
+        """
+        running_services = {}
+        for container_id, project_id, service_name, container_number in \
+                self.containers:
+            await self.app.event_container_started(
+                container_id, project_id, service_name, container_number)
+            running_services[(project_id, service_name)] = max(
+                running_services.get((project_id, service_name), 0),
+                container_number)
+        result = await self.app.sparql.query(
+            """
+            SELECT *
+            FROM {{graph}}
+            WHERE {
+                ?service a swarmui:Service ;
+                  mu:uuid ?uuid ;
+                  dct:title ?name ;
+                  swarmui:status swarmui:Started ;
+                  swarmui:scaling ?scaling .
+
+                ?pipeline a swarmui:Pipeline ;
+                  swarmui:services ?service ;
+                  mu:uuid ?projectid .
+            }
+            """)
+        for data in result['results']['bindings']:
+            project_id = data['projectid']['value']
+            service_name = data['name']['value']
+            scaling = int(data['scaling']['value'])
+            actual_scaling = running_services.get((project_id, service_name),
+                                                  0)
+            for i in range(scaling, actual_scaling, -1):
+                await self.app.event_container_died(project_id, service_name,
+                                                    i)
+
+    @unittest_run_loop
+    async def test_same_graph_state(self):
+        self.joined = []
+        self.app.join_public_network = self.join_public_network
+        containers = [
+            {
+                "Id": container_id,
+                "Labels": {
+                    "com.docker.compose.project": project_id.lower(),
+                    "com.docker.compose.service": service_name,
+                    "com.docker.compose.container-number":
+                        str(container_number),
+                },
+            }
+            for container_id, project_id, service_name, container_number
+            in self.containers
+        ]
+        containers.append({"Id": "c5", "Labels": {}})
+
+        await self.prepare_graph()
+        await self.reconcile_one_by_one()
+        expected_state = self.graph_store.triples()
+        expected_joined = self.joined
+        one_by_one_queries = len(self.sparql_queries)
+
+        self.joined = []
+        await self.prepare_graph()
+        await reconcile(self.app, containers)
+        self.assertEqual(self.graph_store.triples(), expected_state)
+        self.assertEqual(self.joined, expected_joined)
+        self.assertEqual(len(self.sparql_queries), 2)
+        self.assertGreater(one_by_one_queries, 10)
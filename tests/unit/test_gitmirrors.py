@@ -0,0 +1,100 @@
+import asyncio
+import os
+import subprocess
+import tempfile
+import unittest
+from aiohttp.test_utils import (
+    setup_test_loop, teardown_test_loop, unittest_run_loop)
+from types import SimpleNamespace
+
+from muswarmadmin.gitmirrors import GitMirrors
+
+
+GIT_ENV = dict(os.environ, GIT_AUTHOR_NAME="test",
+               GIT_AUTHOR_EMAIL="test@example.org", GIT_COMMITTER_NAME="test",
+               GIT_COMMITTER_EMAIL="test@example.org")
+
+
+def git(*args, cwd):
+    return subprocess.check_output(("git",) + args, cwd=cwd,
+                                   env=GIT_ENV).decode().strip()
+
+
+class GitMirrorsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = setup_test_loop()
+        # NOTE: the subprocesses need a child watcher attached to the loop
+        watcher = asyncio.SafeChildWatcher()
+        watcher.attach_loop(self.loop)
+        asyncio.get_event_loop_policy().set_child_watcher(watcher)
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+        self.location = os.path.join(self.tmpdir, "origin")
+        os.makedirs(self.location)
+        git("init", "-q", cwd=self.location)
+        self.commit()
+        self.commands = []
+        self.mirrors = GitMirrors(self.run_command,
+                                  os.path.join(self.tmpdir, "mirrors"), 60,
+                                  loop=self.loop)
+
+    def tearDown(self):
+        asyncio.get_event_loop_policy().set_child_watcher(None)
+        teardown_test_loop(self.loop)
+
+    def commit(self):
+        git("commit", "-q", "--allow-empty", "-m", "commit",
+            cwd=self.location)
+        return git("rev-parse", "HEAD", cwd=self.location)
+
+    async def run_command(self, *args, cwd=None):
+        self.commands.append(args[:2])
+        proc = await asyncio.create_subprocess_exec(
+            *args, cwd=cwd, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL, env=GIT_ENV, loop=self.loop)
+        await proc.wait()
+        return SimpleNamespace(returncode=proc.returncode)
+
+    @unittest_run_loop
+    async def test_refresh_interval(self):
+        path, same_path = await asyncio.gather(
+            self.mirrors.update(self.location),
+            self.mirrors.update(self.location), loop=self.loop)
+        self.assertEqual(path, same_path)
+        self.assertEqual(self.commands, [("git", "clone")])
+        head = self.commit()
+        self.assertEqual(await self.mirrors.update(self.location), path)
+        self.assertEqual(len(self.commands), 1)
+        self.assertNotEqual(git("rev-parse", "HEAD", cwd=path), head)
+        self.mirrors.refresh_interval = 0
+        self.assertEqual(await self.mirrors.update(self.location), path)
+        self.assertEqual(self.commands[1:], [("git", "remote")])
+        self.assertEqual(git("rev-parse", "HEAD", cwd=path), head)
+
+    @unittest_run_loop
+    async def test_failure(self):
+        location = os.path.join(self.tmpdir, "does_not_exist")
+        self.assertIsNone(await self.mirrors.update(location))
+        self.assertFalse(os.path.exists(self.mirrors.get_path(location)))
+        self.assertIsNone(await self.mirrors.update(location))
+        self.assertEqual(len(self.commands), 2)
+
+    @unittest_run_loop
+    async def test_force(self):
+        path = await self.mirrors.update(self.location)
+        head = self.commit()
+        self.assertEqual(await self.mirrors.update(self.location, force=True),
+                         path)
+        self.assertEqual(self.commands, [("git", "clone"), ("git", "remote")])
+        self.assertEqual(git("rev-parse", "HEAD", cwd=path), head)
+
+    @unittest_run_loop
+    async def test_remove(self):
+        path = await self.mirrors.update(self.location)
+        await self.mirrors.remove(self.location)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.mirrors.refreshed, {})
+        self.assertEqual(self.mirrors.locks, {})
+        self.assertEqual(await self.mirrors.update(self.location), path)
+        self.assertEqual(self.commands, [("git", "clone"), ("git", "clone")])
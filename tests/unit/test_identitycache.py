@@ -0,0 +1,150 @@
+from aiosparql.syntax import IRI, PrefixedName
+
+from muswarmadmin.delta import Triple
+from muswarmadmin.identitycache import IdentityCache, LRUCache
+from muswarmadmin.prefixes import Dct, Mu, SwarmUI
+
+from tests.unit.helpers import UnitTestCase, unittest_run_loop
+
+
+def term(x):
+    if isinstance(x, PrefixedName):
+        x = x.iri()
+    if isinstance(x, IRI):
+        return {"type": "uri", "value": x.value}
+    return {"type": "literal", "value": x}
+
+
+def triple(s, p, o):
+    return Triple({"s": term(s), "p": term(p), "o": term(o)})
+
+
+def bindings(**values):
+    return {"results": {"bindings": [
+        {k: {"type": "literal", "value": v} for k, v in values.items()}
+    ]}}
+
+
+class LRUCacheTestCase(UnitTestCase):
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3)
+        self.assertNotIn("b", cache)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+
+class IdentityCacheTestCase(UnitTestCase):
+    subject = IRI("http://example.org/pipeline-instances/PIPELINE")
+    service = IRI("http://example.org/services/SERVICE")
+
+    def make_cache(self):
+        cache = IdentityCache()
+        cache.set_resource_id(self.subject, "PIPELINE")
+        cache.set_resource_id(self.service, "SERVICE")
+        cache.set_title("SERVICE", "service1")
+        cache.set_service_pipeline("SERVICE", "PIPELINE")
+        return cache
+
+    def test_invalidate_title(self):
+        cache = self.make_cache()
+        cache.invalidate_triples([
+            triple(self.service, Dct.title, "service2"),
+        ])
+        self.assertIsNone(cache.get_title("SERVICE"))
+        self.assertEqual(cache.get_resource_id(self.service), "SERVICE")
+        self.assertEqual(cache.get_service_pipeline("SERVICE"), "PIPELINE")
+
+    def test_invalidate_services(self):
+        cache = self.make_cache()
+        cache.invalidate_triples([
+            triple(self.subject, SwarmUI.services, self.service),
+        ])
+        self.assertIsNone(cache.get_service_pipeline("SERVICE"))
+        self.assertEqual(cache.get_resource_id(self.service), "SERVICE")
+        self.assertEqual(cache.get_title("SERVICE"), "service1")
+
+    def test_other_predicates_kept(self):
+        cache = self.make_cache()
+        cache.invalidate_triples([
+            triple(self.subject, SwarmUI.requestedStatus, SwarmUI.Up),
+            triple(self.service, SwarmUI.status, SwarmUI.Started),
+            triple(self.service, SwarmUI.scaling, "2"),
+        ])
+        self.assertEqual(cache.get_resource_id(self.subject), "PIPELINE")
+        self.assertEqual(cache.get_resource_id(self.service), "SERVICE")
+        self.assertEqual(cache.get_title("SERVICE"), "service1")
+        self.assertEqual(cache.get_service_pipeline("SERVICE"), "PIPELINE")
+
+    def test_invalidate_pipeline(self):
+        cache = self.make_cache()
+        cache.invalidate_triples([
+            triple(self.subject, Mu.uuid, "PIPELINE"),
+        ])
+        self.assertIsNone(cache.get_resource_id(self.subject))
+        self.assertIsNone(cache.get_service_pipeline("SERVICE"))
+        self.assertEqual(cache.get_title("SERVICE"), "service1")
+
+    def test_invalidate_unknown_subject(self):
+        cache = self.make_cache()
+        cache.invalidate_triples([
+            triple(IRI("http://example.org/services/OTHER"), Dct.title,
+                   "service2"),
+        ])
+        self.assertIsNone(cache.get_title("SERVICE"))
+        self.assertEqual(cache.get_service_pipeline("SERVICE"), "PIPELINE")
+
+    @unittest_run_loop
+    async def test_lookups_are_cached(self):
+        self.sparql_responses.extend([
+            bindings(o="PIPELINE"),
+            bindings(title="service1"),
+            bindings(uuid="PIPELINE"),
+        ])
+        for i in range(3):
+            self.assertEqual(await self.app.get_resource_id(self.subject),
+                             "PIPELINE")
+            self.assertEqual(await self.app.get_dct_title("SERVICE"),
+                             "service1")
+            self.assertEqual(await self.app.get_service_pipeline("SERVICE"),
+                             "PIPELINE")
+        self.assertEqual(len(self.sparql_queries), 3)
+        self.assertEqual(self.app.identity_cache.hits, 6)
+        self.assertEqual(self.app.identity_cache.misses, 3)
+
+    @unittest_run_loop
+    async def test_delta_invalidates_cache(self):
+        self.app.identity_cache.set_resource_id(self.subject, "PIPELINE")
+        async with self.client.post("/update", json={"delta": [{
+            "graph": "http://example.org",
+            "inserts": [],
+            "deletes": [{
+                "s": term(self.subject),
+                "p": term(Mu.uuid),
+                "o": term("PIPELINE"),
+            }],
+        }]}) as response:
+            self.assertEqual(response.status, 204)
+        self.assertIsNone(
+            self.app.identity_cache.get_resource_id(self.subject))
+
+    @unittest_run_loop
+    async def test_requested_status_keeps_uuid(self):
+        self.app.identity_cache.set_resource_id(self.subject, "PIPELINE")
+        async with self.client.post("/update", json={"delta": [{
+            "graph": "http://example.org",
+            "inserts": [{
+                "s": term(self.subject),
+                "p": term(SwarmUI.requestedStatus),
+                "o": term(SwarmUI.Up),
+            }],
+            "deletes": [],
+        }]}) as response:
+            self.assertEqual(response.status, 204)
+        self.assertEqual(
+            self.app.identity_cache.get_resource_id(self.subject), "PIPELINE")
@@ -0,0 +1,109 @@
+import aiodockerpy
+import aiohttp
+import asyncio
+import unittest
+from aiohttp.test_utils import (
+    setup_test_loop, teardown_test_loop, unittest_run_loop)
+from types import SimpleNamespace
+
+from muswarmadmin.imagecleaner import get_image_references, remove_images
+
+
+IMAGES = {
+    "busybox:latest": {"Id": "sha256:1", "Size": 1000},
+    "busybox:1.0": {"Id": "sha256:1", "Size": 1000},
+    "nginx:latest": {"Id": "sha256:2", "Size": 2000},
+    "redis:latest": {"Id": "sha256:3", "Size": 3000},
+    "postgres:latest": {"Id": "sha256:4", "Size": 4000},
+}
+
+
+class FakeDocker:
+    def __init__(self, loop):
+        self.loop = loop
+        self.images = dict(IMAGES)
+        self.removed = []
+        self.running = 0
+        self.max_running = 0
+
+    def not_found(self, image):
+        exc = aiohttp.ClientResponseError(None, (), code=404,
+                                          message="Not Found")
+        return aiodockerpy.errors.ImageNotFound(
+            exc, explanation="No such image: %s" % image)
+
+    async def containers(self):
+        return [{"Image": "redis", "ImageID": "sha256:3"}]
+
+    async def inspect_image(self, image):
+        if image not in self.images:
+            raise self.not_found(image)
+        return self.images[image]
+
+    async def remove_image(self, image):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(0.01, loop=self.loop)
+        self.running -= 1
+        info = self.images.pop(image)
+        self.removed.append(image)
+        result = [{"Untagged": image}]
+        if info['Id'] not in [x['Id'] for x in self.images.values()]:
+            result.append({"Deleted": info['Id']})
+        return result
+
+
+class FakeApp:
+    def __init__(self, loop):
+        self.loop = loop
+        self.docker = FakeDocker(loop)
+        self.projects = {
+            "P1": ["busybox", "nginx:latest", "redis", "postgres"],
+            "P2": [None, "nginx"],
+        }
+
+    async def load_compose_data(self, project_id):
+        return SimpleNamespace(services=[
+            {} if x is None else {"image": x}
+            for x in self.projects[project_id]
+        ])
+
+
+class ImageCleanerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = setup_test_loop()
+        self.app = FakeApp(self.loop)
+
+    def tearDown(self):
+        teardown_test_loop(self.loop)
+
+    @unittest_run_loop
+    async def test_references(self):
+        references = await get_image_references(self.app, ["P1", "P2"])
+        self.assertEqual(references["nginx:latest"], 2)
+        self.assertEqual(references["redis:latest"], 2)
+        self.assertEqual(references["sha256:3"], 1)
+        self.assertEqual(references["postgres:latest"], 1)
+        self.assertEqual(references["sha256:4"], 0)
+
+    @unittest_run_loop
+    async def test_remove_unreferenced(self):
+        references = await get_image_references(self.app, ["P2"])
+        images = self.app.projects["P1"] + ["unknown"]
+        reclaimed = await remove_images(self.app.docker, images, references,
+                                        loop=self.loop)
+        self.assertEqual(sorted(self.app.docker.removed),
+                         ["busybox:latest", "postgres:latest"])
+        # NOTE: busybox:latest is only untagged, busybox:1.0 is the same image
+        self.assertEqual(reclaimed, 4000)
+
+    @unittest_run_loop
+    async def test_concurrency(self):
+        references = await get_image_references(self.app, [])
+        del self.app.docker.images["busybox:1.0"]
+        reclaimed = await remove_images(
+            self.app.docker, list(self.app.docker.images), references,
+            concurrency=2, loop=self.loop)
+        self.assertEqual(self.app.docker.max_running, 2)
+        self.assertEqual(len(self.app.docker.removed), 3)
+        self.assertEqual(reclaimed, 7000)
@@ -0,0 +1,90 @@
+import asyncio
+import unittest
+from aiohttp.test_utils import (
+    setup_test_loop, teardown_test_loop, unittest_run_loop)
+
+from muswarmadmin.imagepuller import ImagePuller
+
+
+class FakeDocker:
+    def __init__(self, loop):
+        self.loop = loop
+        self.pulls = []
+        self.running = 0
+        self.max_running = 0
+        self.release = asyncio.Event(loop=loop)
+
+    async def pull(self, repository, tag=None, stream=False, decode=False):
+        self.pulls.append("%s:%s" % (repository, tag))
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            yield {"status": "Pulling from %s" % repository, "id": tag}
+            yield {"status": "Downloading", "id": "layer1",
+                   "progressDetail": {"current": 10, "total": 100}}
+            yield {"status": "Downloading", "id": "layer2",
+                   "progressDetail": {"current": 5, "total": 50}}
+            await self.release.wait()
+            if repository == "broken":
+                yield {"error": "manifest unknown"}
+            yield {"status": "Pull complete", "id": "layer1"}
+        finally:
+            self.running -= 1
+
+
+class ImagePullerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = setup_test_loop()
+        self.docker = FakeDocker(self.loop)
+        self.puller = ImagePuller(self.docker, concurrency=2, loop=self.loop)
+
+    def tearDown(self):
+        teardown_test_loop(self.loop)
+
+    async def settle(self):
+        for i in range(10):
+            await asyncio.sleep(0, loop=self.loop)
+
+    @unittest_run_loop
+    async def test_shared_pull(self):
+        first = self.loop.create_task(self.puller.pull("busybox"))
+        second = self.loop.create_task(self.puller.pull("busybox:latest"))
+        third = self.loop.create_task(self.puller.pull("busybox"))
+        await self.settle()
+        self.assertEqual(self.puller.progress, {"busybox:latest": (15, 150)})
+        self.docker.release.set()
+        await asyncio.gather(first, second, third, loop=self.loop)
+        self.assertEqual(self.docker.pulls, ["busybox:latest"])
+        self.assertEqual(self.puller.pulls, {})
+        self.assertEqual(self.puller.progress, {})
+
+    @unittest_run_loop
+    async def test_concurrency(self):
+        task = self.loop.create_task(
+            self.puller.pull_all(["a", "b", "c", "d"]))
+        await self.settle()
+        self.assertEqual(self.docker.running, 2)
+        self.docker.release.set()
+        self.assertEqual(await task, [])
+        self.assertEqual(self.docker.max_running, 2)
+        self.assertEqual(len(self.docker.pulls), 4)
+
+    @unittest_run_loop
+    async def test_errors(self):
+        self.docker.release.set()
+        self.assertEqual(await self.puller.pull_all(["a", "broken:1.0"]),
+                         ["broken:1.0"])
+        self.assertEqual(self.puller.pulls, {})
+        self.assertEqual(self.puller.progress, {})
+
+    @unittest_run_loop
+    async def test_caller_cancelled(self):
+        first = self.loop.create_task(self.puller.pull("busybox"))
+        second = self.loop.create_task(self.puller.pull("busybox"))
+        await self.settle()
+        first.cancel()
+        await self.settle()
+        self.docker.release.set()
+        await second
+        self.assertTrue(first.cancelled())
+        self.assertEqual(self.docker.pulls, ["busybox:latest"])
@@ -0,0 +1,78 @@
+import json
+import unittest
+from aiohttp.test_utils import (
+    setup_test_loop, teardown_test_loop, unittest_run_loop)
+
+from muswarmadmin.jsonstream import JSONStream, JSONStreamError
+
+from tests.unit.helpers import FakeReader
+
+
+DOCUMENT = {
+    "a": [1, 2.5, -3e2, True, False, None, "x"],
+    "b": {"c": "éè \\\"quoted\\\" [not] {an} \"array\"", "d": []},
+    "e": {},
+    "☃": [[{"f": "g"}], 1234567890],
+}
+
+
+async def load(stream):
+    """
+    Decode a value by walking through it
+    """
+    char = await stream.peek()
+    if char == "{":
+        result = {}
+        async for key in stream.items():
+            result[key] = await load(stream)
+        return result
+    elif char == "[":
+        return [await load(stream) async for i in stream.elements()]
+    else:
+        return await stream.value()
+
+
+def make_stream(document, chunk_size):
+    return JSONStream(FakeReader(document.encode(), chunk_size))
+
+
+class JSONStreamTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = setup_test_loop()
+
+    def tearDown(self):
+        teardown_test_loop(self.loop)
+
+    @unittest_run_loop
+    async def test_walk(self):
+        text = json.dumps(DOCUMENT, ensure_ascii=False, indent=1)
+        for chunk_size in range(1, 10):
+            stream = make_stream(text, chunk_size)
+            self.assertEqual(await load(stream), DOCUMENT)
+            await stream.end()
+
+    @unittest_run_loop
+    async def test_skip(self):
+        text = json.dumps(DOCUMENT, ensure_ascii=False)
+        for chunk_size in range(1, 10):
+            stream = make_stream(text, chunk_size)
+            keys = []
+            async for key in stream.items():
+                keys.append(key)
+                await stream.skip()
+            await stream.end()
+            self.assertEqual(keys, list(DOCUMENT))
+
+    @unittest_run_loop
+    async def test_number_split(self):
+        stream = make_stream("[12345, 6]", 3)
+        self.assertEqual(await load(stream), [12345, 6])
+
+    @unittest_run_loop
+    async def test_invalid(self):
+        for text in ["", "{", '{"a" 1}', '{"a": [1, 2}', '{"a": 1} 2',
+                     "[1,]", '{"a": "\\x"}', '{1: 2}']:
+            with self.assertRaises(JSONStreamError, msg=text):
+                stream = make_stream(text, 2)
+                await load(stream)
+                await stream.end()
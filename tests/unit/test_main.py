@@ -0,0 +1,134 @@
+from aiosparql.syntax import IRI, Node, RDF, Triples
+
+from muswarmadmin.eventmonitor import ServiceChange
+from muswarmadmin.prefixes import Dct, Mu, SwarmUI
+
+from tests.unit.helpers import GraphStore, UnitTestCase, unittest_run_loop
+
+
+class ContainerEventsTestCase(UnitTestCase):
+    async def prepare_graph(self):
+        self.graph_store = GraphStore(self.app.sparql.graph.value)
+        self.pipeline_id = "PIPELINE"
+        pipeline_iri = IRI("http://example.org/pipeline-instances/PIPELINE")
+        service1_iri = IRI("http://example.org/services/SERVICE1")
+        service2_iri = IRI("http://example.org/services/SERVICE2")
+        await self.app.sparql.update(
+            "INSERT DATA { GRAPH {{graph}} { {{}} } }", Triples([
+                Node(pipeline_iri, {
+                    RDF.type: SwarmUI.Pipeline,
+                    Mu.uuid: self.pipeline_id,
+                    SwarmUI.status: SwarmUI.Stopped,
+                }),
+                (pipeline_iri, SwarmUI.services, service1_iri),
+                (pipeline_iri, SwarmUI.services, service2_iri),
+                Node(service1_iri, {
+                    RDF.type: SwarmUI.Service,
+                    Mu.uuid: "SERVICE1",
+                    Dct.title: "service1",
+                    SwarmUI.scaling: 0,
+                    SwarmUI.status: SwarmUI.Stopped,
+                }),
+                Node(service2_iri, {
+                    RDF.type: SwarmUI.Service,
+                    Mu.uuid: "SERVICE2",
+                    Dct.title: "service2",
+                    SwarmUI.scaling: 1,
+                    SwarmUI.status: SwarmUI.Started,
+                }),
+            ]))
+        self.sparql_queries.clear()
+
+    async def join_public_network(self, container_id):
+        return False
+
+    async def run_events(self):
+        self.app.join_public_network = self.join_public_network
+        await self.app.event_container_started(
+            "container1", self.pipeline_id, "service1", 1)
+        await self.app.event_container_started(
+            "container2", self.pipeline_id, "service1", 2)
+        await self.app.event_container_died(self.pipeline_id, "service1", 2)
+        await self.app.event_container_died(self.pipeline_id, "service2", 1)
+        await self.app.event_container_started(
+            "container3", self.pipeline_id, "service2", 1)
+        await self.app.event_container_died(self.pipeline_id, "service1", 1)
+
+    @unittest_run_loop
+    async def test_combined_updates_same_graph_state(self):
+        self.app.sparql_combined_updates = False
+        await self.prepare_graph()
+        await self.run_events()
+        separate_updates = len(self.sparql_queries)
+        separate_state = self.graph_store.triples()
+
+        self.app.sparql_combined_updates = True
+        await self.prepare_graph()
+        await self.run_events()
+        combined_updates = len(self.sparql_queries)
+        combined_state = self.graph_store.triples()
+
+        self.assertEqual(separate_state, combined_state)
+        # NOTE: one ASK and one update per event instead of three updates
+        self.assertEqual(separate_updates, 6 * 4)
+        self.assertEqual(combined_updates, 6 * 2)
+
+        result = await self.app.sparql.query(
+            """
+            SELECT ?name ?scaling ?status ?pipelinestatus
+            FROM {{graph}}
+            WHERE {
+                ?pipeline swarmui:services ?service ;
+                  swarmui:status ?pipelinestatus .
+
+                ?service dct:title ?name ;
+                  swarmui:scaling ?scaling ;
+                  swarmui:status ?status .
+            }
+            """)
+        state = {
+            x['name']['value']: (int(x['scaling']['value']),
+                                 x['status']['value'],
+                                 x['pipelinestatus']['value'])
+            for x in result['results']['bindings']
+        }
+        self.assertEqual(state, {
+            "service1": (0, SwarmUI.Stopped.iri().value,
+                         SwarmUI.Started.iri().value),
+            "service2": (1, SwarmUI.Started.iri().value,
+                         SwarmUI.Started.iri().value),
+        })
+
+    @unittest_run_loop
+    async def test_coalesced_events_same_graph_state(self):
+        self.app.join_public_network = self.join_public_network
+        events = [
+            ("start", "container1", 1),
+            ("start", "container2", 2),
+            ("die", "container2", 2),
+            ("start", "container2", 2),
+            ("die", "container2", 2),
+            ("die", "container1", 1),
+            ("start", "container1", 1),
+        ]
+
+        await self.prepare_graph()
+        for action, container_id, container_number in events:
+            if action == "start":
+                await self.app.event_container_started(
+                    container_id, self.pipeline_id, "service1",
+                    container_number)
+            else:
+                await self.app.event_container_died(
+                    self.pipeline_id, "service1", container_number)
+        expected_state = self.graph_store.triples()
+
+        await self.prepare_graph()
+        change = ServiceChange()
+        for event in events:
+            change.add(*event)
+        await self.app.event_service_changed(self.pipeline_id, "service1",
+                                             change)
+        self.assertEqual(self.graph_store.triples(), expected_state)
+        # NOTE: one ASK and at most two operations of three updates
+        self.assertLessEqual(len(self.sparql_queries), 7)
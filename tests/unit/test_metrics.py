@@ -0,0 +1,82 @@
+import asyncio
+
+from muswarmadmin import metrics
+from muswarmadmin.actionscheduler import ActionScheduler
+from muswarmadmin.prefixes import Mu
+
+from tests.unit.helpers import UnitTestCase, unittest_run_loop
+from tests.unit.test_identitycache import bindings, term
+
+
+class MetricsTestCase(UnitTestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.REGISTRY.clear()
+
+    def test_histogram(self):
+        histogram = metrics.Histogram("test", "A test", ["query"],
+                                      buckets=[0.1, 1])
+        histogram.observe(0.05, query="a")
+        histogram.observe(0.5, query="a")
+        histogram.observe(5, query="a")
+        self.assertEqual(histogram.render().splitlines(), [
+            "# HELP test A test",
+            "# TYPE test histogram",
+            'test_bucket{query="a",le="0.1"} 1.0',
+            'test_bucket{query="a",le="1.0"} 2.0',
+            'test_bucket{query="a",le="+Inf"} 3.0',
+            'test_sum{query="a"} 5.55',
+            'test_count{query="a"} 3.0',
+        ])
+
+    def test_counter(self):
+        counter = metrics.Counter("test_total", "A test", ["name"])
+        counter.inc(name='with "quotes"')
+        counter.inc(2, name='with "quotes"')
+        self.assertEqual(counter.render().splitlines()[-1],
+                         'test_total{name="with \\"quotes\\""} 3.0')
+
+    def test_get_subcommand(self):
+        self.assertEqual(metrics.get_subcommand(["--no-ansi", "up", "-d"]),
+                         "up")
+        self.assertEqual(metrics.get_subcommand(["--version"]), "")
+
+    @unittest_run_loop
+    async def test_endpoint(self):
+        self.sparql_responses.append(bindings(title="service1"))
+        await self.app.get_dct_title("SERVICE")
+        await self.app.get_dct_title("SERVICE")
+        async with self.client.post("/update", json={"delta": [{
+            "graph": "http://example.org",
+            "inserts": [{
+                "s": term(self.app.base_resource + "stacks/1"),
+                "p": term(Mu.uuid),
+                "o": term("1"),
+            }],
+            "deletes": [],
+        }]}) as response:
+            self.assertEqual(response.status, 204)
+        await ActionScheduler.execute("key", asyncio.sleep, [0],
+                                      loop=self.loop)
+        await asyncio.sleep(0.1, loop=self.loop)
+        async with self.client.get("/metrics") as response:
+            self.assertEqual(response.status, 200)
+            self.assertTrue(
+                response.headers['Content-Type'].startswith("text/plain"))
+            text = await response.text()
+        self.assertIn('muswarmadmin_sparql_query_duration_seconds_count'
+                      '{query="get_dct_title"} 1.0', text)
+        self.assertIn("muswarmadmin_delta_payloads_total 1.0", text)
+        self.assertIn('muswarmadmin_delta_triples_total{operation="insert"} '
+                      '1.0', text)
+        self.assertIn('muswarmadmin_identity_cache_hits_total'
+                      '{cache="titles"} 1.0', text)
+        self.assertIn('muswarmadmin_identity_cache_misses_total'
+                      '{cache="titles"} 1.0', text)
+        self.assertIn('muswarmadmin_action_schedulers'
+                      '{scheduler="ActionScheduler"} 1.0', text)
+        self.assertIn('muswarmadmin_action_queue_depth'
+                      '{scheduler="ActionScheduler",key="key"}', text)
+        self.assertIn('muswarmadmin_action_wait_seconds_count'
+                      '{scheduler="ActionScheduler"} 1.0', text)
+        await ActionScheduler.executers["key"].cancel()
@@ -0,0 +1,117 @@
+from types import SimpleNamespace
+from unittest import mock
+
+from muswarmadmin.pipelines import update_action
+from muswarmadmin.prefixes import SwarmUI
+from muswarmadmin.repositories import (
+    initialize_pipeline, remove_repository_mirror)
+
+from tests.unit.helpers import UnitTestCase, unittest_run_loop
+from tests.unit.test_identitycache import bindings
+
+
+LOCATION = "https://example.org/repo.git"
+MIRROR = "/data/.mirrors/repo.git"
+
+
+class RepositoriesTestCase(UnitTestCase):
+    def patch(self, mirror, returncodes={}):
+        """
+        Record the commands executed, the states set and the mirrors updated
+        or removed. The commands succeed unless a return code is given for
+        their subcommand
+        """
+        self.commands = []
+        self.states = []
+        self.mirrors = []
+
+        async def update(location, force=False):
+            self.mirrors.append(("update", location, force))
+            return mirror
+
+        async def remove(location):
+            self.mirrors.append(("remove", location))
+
+        async def run_command(*args, **kwargs):
+            self.commands.append(args)
+            return SimpleNamespace(returncode=returncodes.get(args[1], 0))
+
+        async def update_state(uuid, state):
+            self.states.append((uuid, state))
+
+        for obj, attr, value in [(self.app, "run_command", run_command),
+                                 (self.app, "update_state", update_state),
+                                 (self.app.git_mirrors, "update", update),
+                                 (self.app.git_mirrors, "remove", remove)]:
+            patcher = mock.patch.object(obj, attr, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @unittest_run_loop
+    async def test_initialize_from_mirror(self):
+        project_id = self.uuid4()
+        self.patch(MIRROR)
+        self.sparql_responses.append({"boolean": True})
+        # NOTE: the pipeline has no Docker Compose file, the initialization
+        #       stops once the sources are cloned
+        with self.assertRaises(KeyError):
+            await initialize_pipeline(self.app, "pipeline", project_id,
+                                      LOCATION, None)
+        self.assertEqual(self.mirrors, [("update", LOCATION, False)])
+        self.assertEqual(self.commands, [
+            ("git", "clone", MIRROR, "-b", "master", project_id),
+            ("git", "remote", "set-url", "origin", LOCATION),
+        ])
+
+    @unittest_run_loop
+    async def test_mirror_failure(self):
+        project_id = self.uuid4()
+        self.patch(None, {"clone": 128})
+        self.sparql_responses.append({"boolean": True})
+        await initialize_pipeline(self.app, "pipeline", project_id, LOCATION,
+                                  None)
+        self.assertEqual(self.commands, [
+            ("git", "clone", LOCATION, "-b", "master", project_id),
+        ])
+        self.assertEqual(self.states, [
+            (project_id, SwarmUI.Initializing),
+            (project_id, SwarmUI.Error),
+        ])
+
+    @unittest_run_loop
+    async def test_clone_failure(self):
+        project_id = self.uuid4()
+        self.patch(MIRROR, {"clone": 128})
+        self.sparql_responses.append({"boolean": True})
+        await initialize_pipeline(self.app, "pipeline", project_id, LOCATION,
+                                  "develop")
+        self.assertEqual(self.commands, [
+            ("git", "clone", MIRROR, "-b", "develop", project_id),
+        ])
+        self.assertEqual(self.states[-1], (project_id, SwarmUI.Error))
+
+    @unittest_run_loop
+    async def test_update_from_mirror(self):
+        project_id = self.uuid4()
+        self.patch(MIRROR, {"reset": 1})
+        self.sparql_responses.append(bindings(location=LOCATION))
+        await update_action(self.app, project_id, "pipeline")
+        # NOTE: the mirror is refreshed for every update requested
+        self.assertEqual(self.mirrors, [("update", LOCATION, True)])
+        self.assertEqual(self.commands, [
+            ("git", "fetch", MIRROR, "+refs/heads/*:refs/remotes/origin/*"),
+            ("git", "reset", "--hard", "origin/master"),
+        ])
+        self.assertEqual(self.states[-1], (project_id, SwarmUI.Error))
+
+    @unittest_run_loop
+    async def test_remove_mirror(self):
+        self.patch(MIRROR)
+        self.sparql_responses.extend([
+            bindings(location=LOCATION, other="http://example.org/other"),
+            bindings(location=LOCATION),
+        ])
+        await remove_repository_mirror(self.app, "repository")
+        self.assertEqual(self.mirrors, [])
+        await remove_repository_mirror(self.app, "repository")
+        self.assertEqual(self.mirrors, [("remove", LOCATION)])
@@ -0,0 +1,103 @@
+import asyncio
+from unittest import mock
+
+from muswarmadmin import services
+
+from tests.unit.helpers import Application, UnitTestCase, unittest_run_loop
+
+
+class FakeDocker:
+    """
+    A Docker client that streams the logs given for every container
+    """
+    def __init__(self, logs):
+        self.logs_data = logs
+        self.filters = []
+        self.options = []
+
+    async def containers(self, all=False, filters=None):
+        self.filters.append(filters)
+        return [
+            {"Id": container_id,
+             "Labels": {"com.docker.compose.container-number": str(i)}}
+            for i, container_id in enumerate(self.logs_data, 1)
+        ]
+
+    async def logs(self, container_id, stream=False, **options):
+        self.options.append(options)
+        for chunk in self.logs_data[container_id]:
+            # NOTE: let the other streams run
+            await asyncio.sleep(0)
+            yield chunk
+
+
+class LogsTestCase(UnitTestCase):
+    async def get_application(self):
+        app = await super().get_application()
+        app.identity_cache.set_service_pipeline("service1", "PROJECT1")
+        app.identity_cache.set_title("service1", "web")
+        return app
+
+    def set_docker(self, logs):
+        self.docker = FakeDocker(logs)
+        patcher = mock.patch.object(Application, "docker", self.docker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @unittest_run_loop
+    async def test_interleaved_containers(self):
+        self.set_docker({
+            "a": [b"first ", b"line\nsecond line\n"],
+            "b": [b"other line\n", b"no newline"],
+        })
+        async with self.client.get("/services/service1/logs") as response:
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.headers['Transfer-Encoding'], "chunked")
+            lines = (await response.text()).splitlines()
+        self.assertEqual(
+            [x for x in lines if x.startswith("web_1")],
+            ["web_1 | first line", "web_1 | second line"])
+        self.assertEqual(
+            [x for x in lines if x.startswith("web_2")],
+            ["web_2 | other line", "web_2 | no newline"])
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(self.docker.filters[0]['label'][:2], [
+            "com.docker.compose.project=project1",
+            "com.docker.compose.service=web",
+        ])
+        self.assertEqual(self.docker.options[0], {
+            "tail": services.MAXIMUM_LINE_OF_LOGS,
+            "since": None,
+            "follow": False,
+            "timestamps": False,
+        })
+
+    @unittest_run_loop
+    async def test_options(self):
+        self.set_docker({"a": [b"line\n"]})
+        async with self.client.get("/services/service1/logs", params={
+                "tail": "all", "since": "1500000000", "follow": "true"}) \
+                as response:
+            self.assertEqual(response.status, 200)
+            self.assertEqual(await response.text(), "web_1 | line\n")
+        self.assertEqual(self.docker.options[0], {
+            "tail": "all",
+            "since": 1500000000,
+            "follow": True,
+            "timestamps": False,
+        })
+
+    @unittest_run_loop
+    async def test_invalid_options(self):
+        self.set_docker({"a": [b"line\n"]})
+        for params in [{"tail": "-1"}, {"tail": "x"}, {"since": "0"}]:
+            async with self.client.get("/services/service1/logs",
+                                       params=params) as response:
+                self.assertEqual(response.status, 400)
+        self.assertEqual(self.docker.options, [])
+
+    @unittest_run_loop
+    async def test_service_not_found(self):
+        self.set_docker({})
+        async with self.client.get("/services/invalid/logs") as response:
+            self.assertEqual(response.status, 404)